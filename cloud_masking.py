@@ -19,11 +19,9 @@
  ***************************************************************************/
 """
 import os.path
-import platform
 import shutil
 import tempfile
 from datetime import datetime
-from subprocess import call
 from osgeo import gdal
 
 from qgis.PyQt.QtCore import QSettings, QTranslator, QCoreApplication, Qt, pyqtSlot, QLocale
@@ -38,9 +36,11 @@ from qgis.utils import iface
 from . import resources
 
 from CloudMasking.core import cloud_filters, color_stack
+from CloudMasking.core.cache import CACHE_MAX_SIZE, ProductsCache, default_cache_dir
 from CloudMasking.core.utils import apply_symbology, get_prefer_name, update_process_bar, get_extent, \
     load_and_select_filepath_in, get_file_path_of_layer, get_nodata_value_from_file, wait_process, error_handler
-from CloudMasking.libs import gdal_calc, gdal_merge
+from CloudMasking.core.raster_ops import build_stack, calc, unset_nodata
+from CloudMasking.libs import gdal_merge
 from CloudMasking.gui.cloud_masking_dockwidget import CloudMaskingDockWidget
 from CloudMasking.gui.about_dialog import AboutDialog
 
@@ -77,6 +77,10 @@ class CloudMasking:
         self.menu_name_plugin = self.tr("&Cloud masking for Landsat products")
         self.pluginIsActive = False
         self.dockwidget = None
+        # persistent cache of the intermediate products
+        self._products_cache = None
+        # id of the last Fmask preview layer
+        self.preview_rlayer_id = None
 
         # Obtaining the map canvas
         self.canvas = iface.mapCanvas()
@@ -98,6 +102,40 @@ class CloudMasking:
         # noinspection PyTypeChecker,PyArgumentList,PyCallByClass
         return QCoreApplication.translate('CloudMasking', message)
 
+    @staticmethod
+    def materialize_stacks():
+        """Write the bands stacks as GeoTIFF files instead of virtual rasters (VRT)
+        referencing the bands, set by the 'CloudMasking/materialize_stacks' setting
+        """
+        return QSettings().value('CloudMasking/materialize_stacks', False, type=bool)
+
+    @staticmethod
+    def rios_workers():
+        """Number of RIOS read and compute workers (threads) for the Fmask passes through the
+        images, set by the 'CloudMasking/rios_read_workers' and 'CloudMasking/rios_compute_workers'
+        settings, by default one read worker and a compute worker by CPU
+        """
+        settings = QSettings()
+        read_workers = settings.value('CloudMasking/rios_read_workers', 1, type=int)
+        compute_workers = settings.value('CloudMasking/rios_compute_workers', os.cpu_count() or 1, type=int)
+        return read_workers, compute_workers
+
+    def products_cache(self):
+        """Persistent cache of the intermediate products, reused across runs and QGIS sessions,
+        set by the 'CloudMasking/cache_products', 'CloudMasking/cache_dir' and
+        'CloudMasking/cache_max_size' (MB) settings. Return None if it's disabled
+        """
+        settings = QSettings()
+        if not settings.value('CloudMasking/cache_products', True, type=bool):
+            return None
+        cache_dir = settings.value('CloudMasking/cache_dir', '', type=str) or default_cache_dir()
+        max_size = settings.value('CloudMasking/cache_max_size', CACHE_MAX_SIZE, type=int)
+
+        if self._products_cache is None or self._products_cache.cache_dir != cache_dir:
+            self._products_cache = ProductsCache(cache_dir, max_size)
+        self._products_cache.max_size = max_size
+        return self._products_cache
+
     def initGui(self):
         ### Main dockwidget
         # Create action that will start plugin configuration
@@ -229,6 +267,8 @@ class CloudMasking:
         self.dockwidget.button_processLoadStack.clicked.connect(lambda: self.load_stack())
         # call to process mask
         self.dockwidget.button_processMask.clicked.connect(lambda: self.process_mask())
+        # call to process the Fmask preview
+        self.dockwidget.button_previewMask.clicked.connect(lambda: self.process_mask(preview=True))
         # save simple mask
         self.dockwidget.button_SimpleSaveMask.clicked.connect(lambda: self.fileDialog_exportSimpleMask())
         # save multi mask
@@ -327,7 +367,7 @@ class CloudMasking:
                                                         self.dockwidget.mtl_file,
                                                         bands,
                                                         self.dockwidget.tmp_dir)
-        self.color_stack_scene.do_color_stack()
+        self.color_stack_scene.do_color_stack(materialize=self.materialize_stacks())
         self.color_stack_scene.load_color_stack()
         update_process_bar(self.dockwidget.bar_progressLoadStack, 100,
                            self.dockwidget.status_processLoadStack, self.tr("DONE"))
@@ -339,9 +379,14 @@ class CloudMasking:
             # load to qgis and update combobox list
             load_and_select_filepath_in(combo_box, file_path)
 
+    def preview_factor(self):
+        """Decimation factor of the Fmask preview selected, e.g. 4 for 1/4 of the resolution"""
+        return int(self.dockwidget.comboBox_PreviewFactor.currentText().split("/")[1])
+
     @wait_process
-    def process_mask(self):
-        """Make the process
+    def process_mask(self, preview=False):
+        """Make the process. With preview only the Fmask filter is made, in a
+        low resolution for tune its parameters, and loaded as a temporary layer
         """
         # initialize the symbology
         enable_symbology = [False, False, False, False, False, False, False, False, False]
@@ -358,11 +403,18 @@ class CloudMasking:
             self.dockwidget.status_processMask.setText(
                 self.tr("Error: no filters enabled for apply"))
             return
+        if preview and not self.dockwidget.checkBox_FMask.isChecked():
+            self.dockwidget.status_processMask.setText(
+                self.tr("Error: the preview is only for the Fmask filter"))
+            return
 
         # create the masking result instance if not exist
         if (not isinstance(self.masking_result, cloud_filters.CloudMaskingResult) or
                 not self.masking_result.landsat_scene == self.dockwidget.mtl_file['LANDSAT_SCENE_ID'] or
                 not self.masking_result.collection == int(self.dockwidget.mtl_file['COLLECTION_NUMBER'])):
+            # delete the kept Fmask stages of the previous scene
+            if isinstance(self.masking_result, cloud_filters.CloudMaskingResult):
+                self.masking_result.fmask_stages.clear()
             # create a new instance of cloud masking result
             self.masking_result = cloud_filters.CloudMaskingResult(self.dockwidget.mtl_path,
                                                                    self.dockwidget.mtl_file,
@@ -372,6 +424,13 @@ class CloudMasking:
 
         # re-init the result masking files
         self.masking_result.cloud_masking_files = []
+        self.masking_result.mask_sources = []
+        self.masking_result.histogram_files = []
+        # evaluate the filters by blocks in the blending, without intermediate files
+        self.masking_result.fused = True
+        self.masking_result.materialize_stacks = self.materialize_stacks()
+        self.masking_result.products_cache = self.products_cache()
+        self.masking_result.rios_read_workers, self.masking_result.rios_compute_workers = self.rios_workers()
 
         ########################################
         ## Set the extent selector
@@ -464,8 +523,26 @@ class CloudMasking:
                 swir2_water_test=float(self.dockwidget.doubleSpinBox_S2WT.value()),
                 nir_snow_thresh=float(self.dockwidget.doubleSpinBox_NST.value()),
                 green_snow_thresh=float(self.dockwidget.doubleSpinBox_GST.value()),
+                preview_factor=self.preview_factor() if preview else None,
             )
 
+        if preview:
+            # if memory/scratch layer was used
+            if self.dockwidget.checkBox_ShapeSelector.isChecked() and \
+                    not os.path.isfile(get_file_path_of_layer(self.dockwidget.QCBox_MaskInShapeArea.currentLayer())):
+                if os.path.isfile(tmp_memory_file):
+                    os.remove(tmp_memory_file)
+            self.remove_fmask_files()
+            # the preview is not blended, the full resolution mask is made with "Generate mask",
+            # only the last preview is kept in the map
+            if self.preview_rlayer_id and QgsProject.instance().mapLayer(self.preview_rlayer_id):
+                QgsProject.instance().removeMapLayer(self.preview_rlayer_id)
+            preview_rlayer = self.load_cloud_mask(
+                self.masking_result.cloud_fmask_file, self.tr("Fmask preview 1/{} ({})".format(
+                    self.preview_factor(), datetime.now().strftime('%H:%M:%S'))), enable_symbology)
+            self.preview_rlayer_id = preview_rlayer.id()
+            return
+
         ########################################
         # Blue Band filter
 
@@ -808,95 +885,9 @@ class CloudMasking:
             enable_symbology[8] = True
 
         ########################################
-        # Blended cloud masking files
-
-        # only one filter is activated
-        if len(self.masking_result.cloud_masking_files) == 1:
-            self.final_cloud_mask_file = self.masking_result.cloud_masking_files[0]
-
-        # two filters are activated
-        if len(self.masking_result.cloud_masking_files) == 2:
-            self.final_cloud_mask_file = os.path.join(self.dockwidget.tmp_dir,
-                                                      "cloud_blended_{}.tif".format(datetime.now().strftime('%H%M%S')))
-            gdal_calc.Calc(calc="A*(A>1)+B*(A==1)", outfile=self.final_cloud_mask_file,
-                           A=self.masking_result.cloud_masking_files[0], B=self.masking_result.cloud_masking_files[1])
-
-        # three filters are activated
-        if len(self.masking_result.cloud_masking_files) == 3:
-            self.final_cloud_mask_file = os.path.join(self.dockwidget.tmp_dir,
-                                                      "cloud_blended_{}.tif".format(datetime.now().strftime('%H%M%S')))
-            gdal_calc.Calc(calc="A*(A>1)+B*logical_and(A==1,B>1)+C*logical_and(A==1,B==1)",
-                           outfile=self.final_cloud_mask_file,
-                           A=self.masking_result.cloud_masking_files[0], B=self.masking_result.cloud_masking_files[1],
-                           C=self.masking_result.cloud_masking_files[2])
-
-        # four filters are activated
-        if len(self.masking_result.cloud_masking_files) == 4:
-            self.final_cloud_mask_file = os.path.join(self.dockwidget.tmp_dir,
-                                                      "cloud_blended_{}.tif".format(datetime.now().strftime('%H%M%S')))
-            gdal_calc.Calc(calc="A*(A>1)+B*logical_and(A==1,B>1)+C*logical_and(logical_and(A==1,B==1),C>1)"
-                                "+D*logical_and(logical_and(A==1,B==1),C==1)",
-                           outfile=self.final_cloud_mask_file,
-                           A=self.masking_result.cloud_masking_files[0], B=self.masking_result.cloud_masking_files[1],
-                           C=self.masking_result.cloud_masking_files[2], D=self.masking_result.cloud_masking_files[3])
-
-        # five filters are activated
-        if len(self.masking_result.cloud_masking_files) == 5:
-            self.final_cloud_mask_file = os.path.join(self.dockwidget.tmp_dir,
-                                                      "cloud_blended_{}.tif".format(datetime.now().strftime('%H%M%S')))
-            gdal_calc.Calc(calc="A*(A>1)+B*logical_and(A==1,B>1)+C*logical_and(logical_and(A==1,B==1),C>1)"
-                                "+D*logical_and(logical_and(A==1,B==1,C==1),D>1)+E*logical_and(logical_and(A==1,B==1,C==1),D==1)",
-                           outfile=self.final_cloud_mask_file,
-                           A=self.masking_result.cloud_masking_files[0], B=self.masking_result.cloud_masking_files[1],
-                           C=self.masking_result.cloud_masking_files[2], D=self.masking_result.cloud_masking_files[3],
-                           E=self.masking_result.cloud_masking_files[4])
-
-        ########################################
-        # keep the data outside the shape area as valid data (=1), important for apply several mask
-        if (self.dockwidget.checkBox_ShapeSelector.isChecked() and not self.dockwidget.shapeSelector_CutWithShape.isChecked()) or \
-                self.dockwidget.checkBox_AOISelector.isChecked():
-            self.masking_result.clip(self.final_cloud_mask_file, self.final_cloud_mask_file.replace(".tif", "1.tif"),
-                                     nodata=1, process_bar=False)
-            os.remove(self.final_cloud_mask_file)
-            # expand to original extent
-            img_path = get_prefer_name(os.path.join(os.path.dirname(self.dockwidget.mtl_path),
-                                                    self.dockwidget.mtl_file['FILE_NAME_BAND_1']))
-            if not os.path.exists(img_path):
-                img_path = get_prefer_name(os.path.join(os.path.dirname(self.dockwidget.mtl_path),
-                                                        self.dockwidget.mtl_file['FILE_NAME_BAND_SR_1']))
-            extent = get_extent(img_path)
-            gdal.Translate(self.final_cloud_mask_file,
-                           self.final_cloud_mask_file.replace(".tif", "1.tif"),
-                           projWin=extent, noData=1)
-            os.remove(self.final_cloud_mask_file.replace(".tif", "1.tif"))
-
-            # unset nodata
-            cmd = ['gdal_edit' if platform.system() == 'Windows' else 'gdal_edit.py',
-                   '"{}"'.format(self.final_cloud_mask_file), '-unsetnodata']
-            call(" ".join(cmd), shell=True)
-        else:
-            # mask the nodata value as 255 value
-            self.masking_result.do_nodata_mask(self.final_cloud_mask_file)
-
-        ########################################
-        # Delete data outside the shapefile or selected area, as 255 value
-        if self.dockwidget.checkBox_ShapeSelector.isChecked() and self.dockwidget.shapeSelector_CutWithShape.isChecked():
-            # expand to original extent
-            img_path = get_prefer_name(os.path.join(os.path.dirname(self.dockwidget.mtl_path),
-                                                    self.dockwidget.mtl_file['FILE_NAME_BAND_1']))
-            if not os.path.exists(img_path):
-                img_path = get_prefer_name(os.path.join(os.path.dirname(self.dockwidget.mtl_path),
-                                                        self.dockwidget.mtl_file['FILE_NAME_BAND_SR_1']))
-            extent = get_extent(img_path)
-            gdal.Translate(self.final_cloud_mask_file.replace(".tif", "1.tif"), self.final_cloud_mask_file,
-                           projWin=extent, noData=255)
-            os.remove(self.final_cloud_mask_file)
-            os.rename(self.final_cloud_mask_file.replace(".tif", "1.tif"), self.final_cloud_mask_file)
-
-            # unset nodata
-            cmd = ['gdal_edit' if platform.system() == 'Windows' else 'gdal_edit.py',
-                   '"{}"'.format(self.final_cloud_mask_file), '-unsetnodata']
-            call(" ".join(cmd), shell=True)
+        # Blended cloud masking files, masking the nodata and the data
+        # outside the shapefile or selected area in the same pass
+        self.final_cloud_mask_file = self.masking_result.do_composite_masks()
 
         ########################################
         # Post process mask
@@ -909,13 +900,7 @@ class CloudMasking:
                 os.remove(tmp_memory_file)
         # from fmask
         if self.dockwidget.checkBox_FMask.isChecked():
-            os.remove(self.masking_result.angles_file)
-            os.remove(self.masking_result.saturationmask_file)
-            os.remove(self.masking_result.toa_file)
-            if os.path.isfile(self.masking_result.reflective_stack_clip_file):
-                os.remove(self.masking_result.reflective_stack_clip_file)
-            if os.path.isfile(self.masking_result.thermal_stack_clip_file):
-                os.remove(self.masking_result.thermal_stack_clip_file)
+            self.remove_fmask_files()
         # from blue band
         if self.dockwidget.checkBox_BlueBand.isChecked():
             if os.path.isfile(self.masking_result.blue_band_clip_file):
@@ -942,6 +927,9 @@ class CloudMasking:
         for cloud_masking_file in self.masking_result.cloud_masking_files:
             if cloud_masking_file != self.final_cloud_mask_file:
                 os.remove(cloud_masking_file)
+        # the cached products of this process can be evicted now
+        if self.masking_result.products_cache is not None:
+            self.masking_result.products_cache.release()
 
         # Add to QGIS the reflectance stack file and cloud file
         if self.masking_result.clipping_with_aoi:
@@ -950,8 +938,24 @@ class CloudMasking:
             masking_result_name = self.tr("Cloud Mask in shape ({})".format(datetime.now().strftime('%H:%M:%S')))
         else:
             masking_result_name = self.tr("Cloud Mask ({})".format(datetime.now().strftime('%H:%M:%S')))
-        self.cloud_mask_rlayer = QgsRasterLayer(self.final_cloud_mask_file, masking_result_name)
-        QgsProject.instance().addMapLayer(self.cloud_mask_rlayer)
+        self.cloud_mask_rlayer = self.load_cloud_mask(self.final_cloud_mask_file, masking_result_name,
+                                                      enable_symbology)
+
+        # unselect AOI
+        self.dockwidget.checkBox_AOISelector.setChecked(False)
+
+    def remove_fmask_files(self):
+        """Delete the intermediate files of Fmask, the products saved in the cache are reused in the next process"""
+        for fmask_file in [self.masking_result.saturationmask_file,
+                           self.masking_result.toa_file, self.masking_result.reflective_stack_clip_file,
+                           self.masking_result.thermal_stack_clip_file]:
+            if os.path.isfile(fmask_file) and not self.masking_result.is_cached(fmask_file):
+                os.remove(fmask_file)
+
+    def load_cloud_mask(self, mask_file, name, enable_symbology):
+        """Load the cloud mask file in QGIS with the symbology of the filters enabled"""
+        cloud_mask_rlayer = QgsRasterLayer(mask_file, name)
+        QgsProject.instance().addMapLayer(cloud_mask_rlayer)
 
         # Set symbology (thematic color and name) for new raster layer
         symbology = {
@@ -966,16 +970,15 @@ class CloudMasking:
             'QA Band': (170, 85, 255, 255),
         }
         # apply
-        apply_symbology(self.cloud_mask_rlayer,
+        apply_symbology(cloud_mask_rlayer,
                         symbology,
                         enable_symbology,
                         transparent=[])
         # Refresh layer symbology
-        layer_node = QgsProject.instance().layerTreeRoot().findLayer(self.cloud_mask_rlayer)
+        layer_node = QgsProject.instance().layerTreeRoot().findLayer(cloud_mask_rlayer)
         self.iface.layerTreeView().layerTreeModel().refreshLayerLegend(layer_node)
 
-        # unselect AOI
-        self.dockwidget.checkBox_AOISelector.setChecked(False)
+        return cloud_mask_rlayer
 
     @wait_process
     def fileDialog_exportSimpleMask(self):
@@ -990,15 +993,12 @@ class CloudMasking:
 
         if mask_outpath != '' and mask_inpath != '':
             # unset nodata
-            cmd = ['gdal_edit' if platform.system() == 'Windows' else 'gdal_edit.py',
-                   '"{}"'.format(mask_inpath), '-unsetnodata']
-            call(" ".join(cmd), shell=True)
-
-            cmd = ['gdal_calc' if platform.system() == 'Windows' else 'gdal_calc.py', '--quiet', '--overwrite',
-                   '--calc "1*(A==1)+0*(A!=1)"', '-A "{}"'.format(mask_inpath), '--outfile "{}"'.format(mask_outpath),
-                   '--type="Byte"', '--co COMPRESS=PACKBITS']
-            return_code = call(" ".join(cmd), shell=True)
-            if return_code != 0:
+            unset_nodata(mask_inpath)
+
+            try:
+                calc("1*(A==1)+0*(A!=1)", mask_outpath, out_type="Byte", creation_options=["COMPRESS=PACKBITS"],
+                     A=mask_inpath)
+            except Exception:
                 iface.messageBar().pushMessage("Error during saving the combined mask file", level=Qgis.Critical)
             else:
                 iface.messageBar().pushMessage("Combined mask file saved successfully", level=Qgis.Success)
@@ -1043,19 +1043,14 @@ class CloudMasking:
                     tmp_adj_list.append(tmp_adj)
 
                 # unset nodata for all mask layers, else the calc doesn't work
-                cmd = ['gdal_edit' if platform.system() == 'Windows' else 'gdal_edit.py',
-                       '"{}"'.format(input_files[alpha_list[x]]), '-unsetnodata']
-                call(" ".join(cmd), shell=True)
+                unset_nodata(input_files[alpha_list[x]])
 
             filter_ones = ",".join([alpha_list[x] + "==1" for x in range(len(layers_selected))])
-            cmd = ['gdal_calc' if platform.system() == 'Windows' else 'gdal_calc.py', '--quiet', '--overwrite',
-                   '--calc "1*(numpy.all([{filter_ones}], axis=0)) + 0*(~numpy.all([{filter_ones}], axis=0))"'
-                       .format(filter_ones=filter_ones),
-                   '--outfile "{}"'.format(mask_outpath), '--type="Byte"', '--co COMPRESS=PACKBITS'] + \
-                  ['-{} "{}"'.format(letter, filepath) for letter, filepath in input_files.items()]
-            return_code = call(" ".join(cmd), shell=True)
-
-            if return_code != 0:
+            try:
+                calc("1*(numpy.all([{filter_ones}], axis=0)) + 0*(~numpy.all([{filter_ones}], axis=0))"
+                     .format(filter_ones=filter_ones), mask_outpath, out_type="Byte",
+                     creation_options=["COMPRESS=PACKBITS"], **input_files)
+            except Exception:
                 iface.messageBar().pushMessage("Error during saving the combined mask file", level=Qgis.Critical)
             else:
                 iface.messageBar().pushMessage("Combined mask file saved successfully", level=Qgis.Success)
@@ -1118,9 +1113,7 @@ class CloudMasking:
                 return None, None
 
             # fix nodata to null, unset the nodata else the result lost the data in the valid value to mask (1)
-            cmd = ['gdal_edit' if platform.system() == 'Windows' else 'gdal_edit.py',
-                   '"{}"'.format(mask_path), '-unsetnodata']
-            call(" ".join(cmd), shell=True)
+            unset_nodata(mask_path)
 
             return mask_path
 
@@ -1145,9 +1138,7 @@ class CloudMasking:
             gdal_merge.main(["", "-of", "GTiff", "-o", final_mask_path, "-n", "1", "-a_nodata", "1"] + [prepare_mask(layer) for layer in layers_selected])
 
             # unset nodata
-            cmd = ['gdal_edit' if platform.system() == 'Windows' else 'gdal_edit.py',
-                   '"{}"'.format(final_mask_path), '-unsetnodata']
-            call(" ".join(cmd), shell=True)
+            unset_nodata(final_mask_path)
 
         # get and set stack bands for make layer stack for apply mask
         if self.dockwidget.radioButton_ToRaw_Bands.isChecked() or self.dockwidget.radioButton_ToSR_Bands.isChecked():
@@ -1201,8 +1192,8 @@ class CloudMasking:
             self.reflective_stack_file = os.path.join(self.dockwidget.tmp_dir, "Reflective_stack_" +
                                                       self.dockwidget.mtl_file['LANDSAT_SCENE_ID'] + ".tif")
 
-            gdal_merge.main(["", "-separate", "-of", "GTiff", "-ot", "UInt16", "-o",
-                             self.reflective_stack_file] + stack_bands)
+            self.reflective_stack_file = build_stack(stack_bands, self.reflective_stack_file,
+                                                     materialize=self.materialize_stacks(), out_type="UInt16")
 
         update_process_bar(self.dockwidget.bar_processApplyMask, 50, self.dockwidget.status_processApplyMask,
                            self.tr("Applying mask..."))
@@ -1211,16 +1202,19 @@ class CloudMasking:
         # and "keep the original image size" is not selected. Then resize the reflective
         # stack to mask size
         if get_extent(self.reflective_stack_file) != get_extent(final_mask_path):
-            inprogress_file = self.reflective_stack_file \
-                .replace(".tif", "_inprogress.tif").replace(".TIF", "_inprogress.tif")
+            inprogress_file = os.path.splitext(self.reflective_stack_file)[0] + "_inprogress.tif"
             extent_mask = get_extent(final_mask_path)
             gdal.Translate(inprogress_file, self.reflective_stack_file, projWin=extent_mask, noData=NoDataValue)
             os.remove(self.reflective_stack_file)
-            os.rename(inprogress_file, self.reflective_stack_file)
+            if self.reflective_stack_file.endswith(".vrt"):
+                # the stack is now a file
+                self.reflective_stack_file = inprogress_file
+            else:
+                os.rename(inprogress_file, self.reflective_stack_file)
 
         # apply mask to stack
-        gdal_calc.Calc(calc="A*(B==1)", A=self.reflective_stack_file, B=final_mask_path,
-                       outfile=result_path, allBands='A', overwrite=True, NoDataValue=NoDataValue)
+        calc("A*(B==1)", result_path, nodata=NoDataValue, all_bands='A', A=self.reflective_stack_file,
+             B=final_mask_path)
 
         # clean
         if not self.dockwidget.radioButton_ToParticularFile.isChecked():
@@ -1228,9 +1222,7 @@ class CloudMasking:
 
         # unset nodata
         if NoDataValue is None:
-            cmd = ['gdal_edit' if platform.system() == 'Windows' else 'gdal_edit.py',
-                   '"{}"'.format(result_path), '-unsetnodata']
-            call(" ".join(cmd), shell=True)
+            unset_nodata(result_path)
 
         # delete tmp mask file
         if self.dockwidget.select_layer_mask.currentIndex() == 1:
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ CloudMasking Batch
+                                 A QGIS plugin
+ Cloud masking for landsat products using different process suck as fmask
+                             -------------------
+        copyright            : (C) 2016-2022 by Xavier Corredor Llano, SMByC
+        email                : xcorredorl@ideam.gov.co
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 3 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import traceback
+from collections import defaultdict
+from multiprocessing import Pool
+
+from osgeo import gdal
+
+# from plugins
+from CloudMasking import fmask_libs
+from CloudMasking.core.cloud_masking_utils import mtl2dict, normalize_mtl
+
+# filters available in the recipe, in the order that they are blended
+# (the same order used by the plugin)
+FILTERS = ["fmask", "blue_band", "cloud_qa", "aerosol", "pixel_qa", "qaband_c1", "qaband_c2"]
+
+
+def load_recipe(recipe_file):
+    """
+    Load and check the filters recipe (json file), only the filters
+    defined in the recipe are enabled, example:
+
+        {
+          "fmask": {"filters_enabled": {"Fmask Cloud": true, "Fmask Shadow": true},
+                    "cloud_prob_thresh": 0.225, "cloud_buffer_size": 4},
+          "blue_band": {"threshold": 14000},
+          "qaband_c2": {"checked_items": {"Cloud (bit 3)": true, "Cloud Shadow (bit 4)": true,
+                                          "Cloud Confidence (bits 8-9)": ["High"]},
+                        "specific_values": []}
+        }
+
+    The fmask parameters are the same of CloudMaskingResult.do_fmask and the
+    checked items of the QA filters are the same items of the plugin.
+    """
+    with open(recipe_file, 'r') as f:
+        recipe = json.load(f)
+
+    if not recipe:
+        raise ValueError("No filters enabled in the recipe: {}".format(recipe_file))
+    unknown_filters = [name for name in recipe if name not in FILTERS]
+    if unknown_filters:
+        raise ValueError("Unknown filters in the recipe: {}".format(", ".join(unknown_filters)))
+
+    return recipe
+
+
+def get_qa_file(mtl_path, mtl_file, qa_filter):
+    """Search the QA file of the scene for the QA filter"""
+    input_dir = os.path.dirname(mtl_path)
+    band_1 = mtl_file['FILE_NAME_BAND_1']
+
+    if qa_filter == "cloud_qa":
+        return os.path.join(input_dir, band_1.replace(band_1.split("_")[-1], "sr_cloud_qa.tif"))
+    if qa_filter == "aerosol":
+        return os.path.join(input_dir, band_1.replace(band_1.split("_")[-1], "sr_aerosol.tif"))
+    if qa_filter == "pixel_qa":
+        return os.path.join(input_dir, band_1.replace(band_1.split("_")[-1], "pixel_qa.tif"))
+    if qa_filter == "qaband_c1":
+        qaband_file = os.path.join(input_dir, mtl_file['FILE_NAME_BAND_QUALITY'])
+        if not os.path.isfile(qaband_file):
+            qaband_file = qaband_file.replace("BQA.TIF", "bqa.tif")
+        return qaband_file
+    if qa_filter == "qaband_c2":
+        return os.path.join(input_dir, mtl_file['FILE_NAME_QUALITY_L1_PIXEL'])
+
+
+def apply_recipe(masking_result, recipe):
+    """
+    Apply the filters of the recipe over the masking result instance in the
+    blending order, return the filters that not apply for this scene
+    """
+    landsat_version = masking_result.landsat_version
+    collection = masking_result.collection
+    processing_level = masking_result.mtl_file['PROCESSING_LEVEL'][0:2]
+    skipped = []
+
+    for name in FILTERS:
+        if name not in recipe:
+            continue
+        params = recipe[name]
+
+        ########################################
+        # FMask filter
+        if name == "fmask":
+            params = dict(params)
+            params.setdefault("filters_enabled", {"Fmask Cloud": True, "Fmask Shadow": True, "Fmask Snow": True,
+                                                  "Fmask Water": False})
+            params["filters_enabled"] = defaultdict(bool, params["filters_enabled"])
+            masking_result.do_fmask(**params)
+            continue
+
+        ########################################
+        # Blue Band filter
+        if name == "blue_band":
+            default_threshold = 110 if landsat_version in [4, 5, 7] else 14000
+            masking_result.do_blue_band(int(params.get("threshold", default_threshold)))
+            continue
+
+        ########################################
+        # QA filters
+        if name == "cloud_qa" and not (landsat_version in [4, 5, 7] and collection == 1):
+            skipped.append(name)
+            continue
+        if name == "aerosol" and not (landsat_version in [8, 9] and collection == 1):
+            skipped.append(name)
+            continue
+        if name == "pixel_qa" and collection != 1:
+            skipped.append(name)
+            continue
+        if name == "qaband_c1" and not (collection == 1 and processing_level == "L1"):
+            skipped.append(name)
+            continue
+        if name == "qaband_c2" and collection != 2:
+            skipped.append(name)
+            continue
+
+        qa_file = get_qa_file(masking_result.mtl_path, masking_result.mtl_file, name)
+        if not os.path.isfile(qa_file):
+            raise FileNotFoundError("The QA file for the {} filter not exists: {}".format(name, qa_file))
+
+        checked_items = params.get("checked_items", {})
+        specific_values = [int(sv) for sv in params.get("specific_values", [])]
+
+        if name == "cloud_qa":
+            masking_result.do_cloud_qa_l457(qa_file, checked_items, specific_values)
+        if name == "aerosol":
+            masking_result.do_aerosol_l89(qa_file, checked_items, specific_values)
+        if name == "pixel_qa":
+            masking_result.do_pixel_qa(qa_file, checked_items, specific_values)
+        if name == "qaband_c1" and landsat_version in [4, 5, 7]:
+            masking_result.do_qaband_c1_l457(qa_file, checked_items, specific_values)
+        if name == "qaband_c1" and landsat_version in [8, 9]:
+            masking_result.do_qaband_c1_l89(qa_file, checked_items, specific_values)
+        if name == "qaband_c2":
+            masking_result.do_qaband_c2(qa_file, checked_items, specific_values)
+
+    return skipped
+
+
+def process_scene(mtl_path, recipe, output_dir, tmp_dir=None):
+    """
+    Make the cloud mask for one scene with the filters recipe, this is the
+    same blended mask with nodata (255) made by the plugin for the whole
+    scene. Return the output mask file and the skipped filters
+    """
+    # imported here, after the fmask libs were prepared by the worker
+    from CloudMasking.core.cloud_filters import CloudMaskingResult
+
+    mtl_file = normalize_mtl(mtl2dict(mtl_path))
+    scene_tmp_dir = tempfile.mkdtemp(prefix="CloudMasking_", dir=tmp_dir)
+    try:
+        masking_result = CloudMaskingResult(mtl_path, mtl_file, scene_tmp_dir)
+        # evaluate the filters by blocks in the blending, without intermediate files
+        masking_result.fused = True
+        # the scenes are already processed in parallel
+        masking_result.fmask_workers = 1
+        skipped = apply_recipe(masking_result, recipe)
+        if len(skipped) == len(recipe):
+            raise ValueError("None of the filters in the recipe apply for this scene")
+
+        # blend the masks and mask the nodata value as 255 value
+        final_cloud_mask_file = masking_result.do_composite_masks()
+
+        output_file = os.path.join(output_dir, mtl_file['LANDSAT_SCENE_ID'] + "_Mask.tif")
+        if os.path.isfile(output_file):
+            os.remove(output_file)
+        shutil.move(final_cloud_mask_file, output_file)
+    finally:
+        shutil.rmtree(scene_tmp_dir, ignore_errors=True)
+
+    return output_file, skipped
+
+
+def init_worker(gdal_cache=None, memory_limit=None):
+    """
+    Initialize each worker process of the pool, prepare the fmask libs and
+    bound the memory used by the worker: the GDAL block cache and (only
+    POSIX systems) the maximum address space of the process, both in MB
+    """
+    fmask_libs()
+
+    if gdal_cache:
+        gdal.SetCacheMax(int(gdal_cache) * 1024 * 1024)
+
+    if memory_limit:
+        try:
+            import resource
+        except ImportError:
+            # not available in Windows
+            return
+        limit = int(memory_limit) * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def process_scene_task(task):
+    """Worker task, process the scene and catch the errors for report them"""
+    mtl_path, recipe, output_dir, tmp_dir = task
+    try:
+        output_file, skipped = process_scene(mtl_path, recipe, output_dir, tmp_dir)
+        return {"mtl_path": mtl_path, "output_file": output_file, "skipped": skipped, "error": None}
+    except Exception:
+        return {"mtl_path": mtl_path, "output_file": None, "skipped": [], "error": traceback.format_exc()}
+
+
+def run_batch(mtl_paths, recipe, output_dir, processes=None, tasks_per_worker=1, gdal_cache=256,
+              memory_limit=None, tmp_dir=None):
+    """
+    Process all the scenes (MTL files) with the filters recipe in a pool of
+    processes, yield the result of each scene when it's done. Each worker is
+    restarted after process tasks_per_worker scenes to free the memory
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    tasks = [(os.path.abspath(mtl_path), recipe, os.path.abspath(output_dir), tmp_dir) for mtl_path in mtl_paths]
+
+    with Pool(processes=processes, initializer=init_worker, initargs=(gdal_cache, memory_limit),
+              maxtasksperchild=tasks_per_worker) as pool:
+        for result in pool.imap_unordered(process_scene_task, tasks):
+            yield result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m CloudMasking.core.batch",
+        description="Make the cloud masks of several Landsat scenes without QGIS, using the same "
+                    "filters and blending of the CloudMasking plugin")
+    parser.add_argument("mtl_files", nargs="+", help="MTL files of the scenes to process")
+    parser.add_argument("-r", "--recipe", required=True, help="filters recipe to apply (json file)")
+    parser.add_argument("-o", "--output-dir", required=True, help="directory to save the masks")
+    parser.add_argument("-p", "--processes", type=int, default=None,
+                        help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("--tasks-per-worker", type=int, default=1,
+                        help="scenes processed by each worker before restart it (default: 1)")
+    parser.add_argument("--gdal-cache", type=int, default=256,
+                        help="GDAL block cache for each worker in MB (default: 256)")
+    parser.add_argument("--memory-limit", type=int, default=None,
+                        help="maximum memory for each worker in MB, only POSIX systems (default: no limit)")
+    parser.add_argument("--tmp-dir", default=None, help="directory for temporary files")
+    args = parser.parse_args(argv)
+
+    recipe = load_recipe(args.recipe)
+
+    failed = 0
+    for result in run_batch(args.mtl_files, recipe, args.output_dir, args.processes, args.tasks_per_worker,
+                            args.gdal_cache, args.memory_limit, args.tmp_dir):
+        if result["error"]:
+            failed += 1
+            print("FAILED: {}\n{}".format(result["mtl_path"], result["error"]), file=sys.stderr)
+            continue
+        print("DONE: {} -> {}".format(result["mtl_path"], result["output_file"]))
+        if result["skipped"]:
+            print("  filters not applicable for this scene: {}".format(", ".join(result["skipped"])))
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
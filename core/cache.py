@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ Cache
+                                 A QGIS plugin
+ Cloud masking for landsat products using different process suck as fmask
+                             -------------------
+        copyright            : (C) 2016-2022 by Xavier Corredor Llano, SMByC
+        email                : xcorredorl@ideam.gov.co
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 3 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+# default size limit of the cache in MB
+CACHE_MAX_SIZE = 4096
+
+
+def default_cache_dir():
+    """Cache dir of the plugin in the user cache directory"""
+    if os.name == "nt":
+        base_dir = os.environ.get("LOCALAPPDATA", os.path.expanduser("~"))
+    else:
+        base_dir = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base_dir, "CloudMasking", "products")
+
+
+def file_fingerprint(file_path):
+    """Fingerprint of the file: path, size and modification time"""
+    stat = os.stat(file_path)
+    return "{}|{}|{}".format(os.path.realpath(file_path), stat.st_size, stat.st_mtime_ns)
+
+
+class ProductsCache(object):
+    """
+    Persistent content-addressed cache of the intermediate products (raster
+    files) of the process, reused across runs and QGIS sessions. The key of
+    each product is made from the scene, the fingerprints of the input files,
+    the clip geometry and the parameters of the stage that made it. The
+    cache is limited by size, the least recently used products are evicted
+    """
+
+    def __init__(self, cache_dir=None, max_size=CACHE_MAX_SIZE):
+        self.cache_dir = cache_dir or default_cache_dir()
+        # size limit in MB
+        self.max_size = max_size
+        # products used in the current process, they are not evicted
+        self.in_use = set()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(stage, scene_id, input_files, clip=None, params=None):
+        """Key of the product made by the stage"""
+        content = {
+            "stage": stage,
+            "scene_id": scene_id,
+            "inputs": [file_fingerprint(input_file) for input_file in input_files],
+            "clip": clip,
+            "params": params,
+        }
+        return hashlib.sha1(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+    def path(self, key, suffix=".tif"):
+        return os.path.join(self.cache_dir, key + suffix)
+
+    def contains(self, file_path):
+        """Check if the file is a product in the cache"""
+        return os.path.dirname(os.path.realpath(file_path)) == os.path.realpath(self.cache_dir)
+
+    def get(self, key, suffix=".tif"):
+        """Return the cached product or None, the product is marked as recently used"""
+        cached_file = self.path(key, suffix)
+        if not os.path.isfile(cached_file):
+            return None
+        try:
+            os.utime(cached_file)
+        except OSError:
+            return None
+        self.in_use.add(cached_file)
+        return cached_file
+
+    def put(self, key, product_file, suffix=".tif"):
+        """Move the product file into the cache, return the cached product"""
+        cached_file = self.path(key, suffix)
+        # move and replace, other process could be reading the same product
+        tmp_fd, tmp_file = tempfile.mkstemp(suffix=suffix + ".tmp", dir=self.cache_dir)
+        os.close(tmp_fd)
+        shutil.move(product_file, tmp_file)
+        os.replace(tmp_file, cached_file)
+        self.in_use.add(cached_file)
+        self.evict()
+        return cached_file
+
+    def release(self):
+        """The products of the current process are not used anymore"""
+        self.in_use.clear()
+
+    def size(self):
+        """Total size of the products in the cache in bytes"""
+        return sum(entry.stat().st_size for entry in os.scandir(self.cache_dir) if entry.is_file())
+
+    def evict(self):
+        """Delete the least recently used products until the cache size is within the limit"""
+        products = [(entry.path, entry.stat()) for entry in os.scandir(self.cache_dir)
+                    if entry.is_file() and not entry.name.endswith(".tmp")]
+        total_size = sum(stat.st_size for _, stat in products)
+        max_size = self.max_size * 1024 * 1024
+
+        for product_file, stat in sorted(products, key=lambda product: product[1].st_mtime):
+            if total_size <= max_size:
+                break
+            if product_file in self.in_use:
+                continue
+            try:
+                os.remove(product_file)
+            except OSError:
+                continue
+            total_size -= stat.st_size
+
+    def clear(self):
+        """Delete all products in the cache"""
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        os.makedirs(self.cache_dir, exist_ok=True)
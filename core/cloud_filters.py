@@ -20,20 +20,33 @@
 """
 
 import os, sys
-import platform
 import tempfile
 from datetime import datetime
-from subprocess import call
 
+import numpy
 from osgeo import gdal
-from qgis.core import QgsCoordinateReferenceSystem, QgsCoordinateTransform, QgsProject, QgsRasterLayer, \
-    QgsVectorFileWriter
-from qgis.PyQt.QtCore import QCoreApplication, QFileInfo
 
 # from plugins
-from CloudMasking.core.utils import get_prefer_name, update_process_bar, binary_combination, check_values_in_image, \
-    get_extent, get_layer_by_name, load_layer, unload_layer
-from CloudMasking.libs import gdal_merge, gdal_calc
+from CloudMasking.core import qa_bits
+from CloudMasking.core.cache import ProductsCache
+from CloudMasking.core.cloud_masking_utils import get_prefer_name
+from CloudMasking.core.compositor import composite_masks
+from CloudMasking.core.raster_ops import build_stack, calc, clip_with_cutline, decimate
+from CloudMasking.core.raster_utils import apply_lut, get_cached_histogram, get_extent, get_nodata_value_from_file, \
+    make_constant_raster
+
+try:
+    from qgis.core import QgsCoordinateReferenceSystem, QgsCoordinateTransform, QgsProject, QgsRasterLayer, \
+        QgsVectorFileWriter, QgsVectorLayer
+    from qgis.PyQt.QtCore import QCoreApplication, QFileInfo
+    from CloudMasking.core.utils import update_process_bar, get_layer_by_name, load_layer, unload_layer
+except ImportError:
+    # running outside QGIS (headless batch processing), without progress
+    # bar, translations and clipping with AOI or shapes
+    QCoreApplication = None
+
+    def update_process_bar(bar_inst=None, bar=None, status_inst=None, status=None):
+        pass
 
 # adding the libs plugin path
 libs_folder = os.path.join(os.path.dirname(os.path.dirname(__file__)), "libs")
@@ -67,6 +80,32 @@ class CloudMaskingResult(object):
         self.clipping_with_shape = False
         # save all result files of cloud masking
         self.cloud_masking_files = []
+        # the masks to blend in order: result files or fused filters, (source file, block function)
+        self.mask_sources = []
+        # source files of the fused filters to compute their values histogram
+        # when the masks are blended
+        self.histogram_files = []
+        # fused mode: the filters that can be evaluated by blocks are not written
+        # to files, they are evaluated in memory when the masks are blended
+        self.fused = False
+        # make the bands stacks as virtual rasters (VRT) or write them (GeoTIFF)
+        self.materialize_stacks = False
+        # persistent cache of the intermediate products (ProductsCache), or None
+        self.products_cache = None
+        # products made without the cache in this session, by file: key of the product
+        self.session_products = {}
+        # results of the Fmask stages kept between runs, only the stages affected
+        # by the Fmask parameters changed are computed again
+        self.fmask_stages = fmask.FmaskStageCache()
+        self.fmask_preview_stages = fmask.FmaskStageCache()
+        # workers for the Fmask shadow matching (threads), None for the number of CPUs
+        self.fmask_workers = None
+        # RIOS read and compute workers (threads) for the Fmask passes through the
+        # images, 0 and 0 for serial
+        self.rios_read_workers = 0
+        self.rios_compute_workers = 0
+        # decimated stacks for the Fmask preview, by file: (source file, size, modification time, factor)
+        self.preview_stacks = {}
 
         # get_metadata
         self.landsat_version = int(self.mtl_file['SPACECRAFT_ID'][-1])
@@ -111,6 +150,8 @@ class CloudMaskingResult(object):
         self.thermal_bands = [get_prefer_name(file_path) for file_path in self.thermal_bands]
 
     def tr(self, string, context=''):
+        if QCoreApplication is None:
+            return string
         if context == '':
             context = self.__class__.__name__
         return QCoreApplication.translate(context, string)
@@ -151,6 +192,96 @@ class CloudMaskingResult(object):
                                             out_clipped_file, self.crop_to_cutline, nodata)
         return out_clipped_file
 
+    def clip_params(self):
+        """
+        Description of the selected area or shape area for the key of the
+        cached products: the geometries and CRS of the features, or None
+        """
+        if self.clipping_with_aoi:
+            features_layer = self.aoi_features
+        elif self.clipping_with_shape:
+            features_layer = QgsVectorLayer(self.shape_path, "shape", "ogr")
+        else:
+            return None
+
+        return {"aoi": self.clipping_with_aoi,
+                "crop_to_cutline": self.clipping_with_shape and self.crop_to_cutline,
+                "crs": features_layer.crs().toWkt(),
+                "geometries": [f.geometry().asWkt() for f in features_layer.getFeatures()]}
+
+    def cached_product(self, stage, input_files, out_file, make_product, clip=None, params=None):
+        """
+        Return the product of the stage from the cache if it was made with
+        the same input files, clip and parameters, else make it with
+        make_product(out_file) and save it in the cache. Without cache the
+        product made in a previous run is kept while it has the same key, so
+        the Fmask stages that depend on it are not made again
+        """
+        key = ProductsCache.key(stage, self.landsat_scene, input_files, clip, params)
+        if self.products_cache is None:
+            if self.session_products.get(out_file) == key and os.path.isfile(out_file):
+                return out_file
+            self.session_products.pop(out_file, None)
+            product_file = make_product(out_file)
+            if product_file == out_file:
+                self.session_products[out_file] = key
+            return product_file
+
+        cached_file = self.products_cache.get(key)
+        if cached_file is not None:
+            return cached_file
+
+        product_file = make_product(out_file)
+        if product_file != out_file:
+            # nothing made, e.g. the clip is not activated
+            return product_file
+        return self.products_cache.put(key, product_file)
+
+    def has_product(self, stage, input_files, out_file, clip=None, params=None):
+        """Check if cached_product would return the product of the stage without making it"""
+        key = ProductsCache.key(stage, self.landsat_scene, input_files, clip, params)
+        if self.products_cache is None:
+            return self.session_products.get(out_file) == key and os.path.isfile(out_file)
+        return os.path.isfile(self.products_cache.path(key))
+
+    def decimate_for_preview(self, in_file, out_file, factor):
+        """
+        Decimate the file for the Fmask preview, the decimated file is made
+        again only if the file or the factor changed, so the results of the
+        Fmask stages of the previous preview are reused
+        """
+        stat = os.stat(in_file)
+        source = (in_file, stat.st_size, stat.st_mtime_ns, factor)
+        if self.preview_stacks.get(out_file) != source or not os.path.isfile(out_file):
+            out_file = decimate(in_file, out_file, factor)
+            self.preview_stacks[out_file] = source
+        return out_file
+
+    def fmask_config(self, sensor):
+        """FmaskConfig of the sensor with the RIOS read and compute workers of the plugin"""
+        fmaskConfig = config.FmaskConfig(sensor)
+        fmaskConfig.setRiosWorkers(self.rios_read_workers, self.rios_compute_workers)
+        return fmaskConfig
+
+    def is_cached(self, file_path):
+        """Check if the file is a product in the cache, it must be not deleted"""
+        return self.products_cache is not None and self.products_cache.contains(file_path)
+
+    def clip_filter_input(self, in_file, out_clipped_file):
+        """
+        Clipping the input file of the filter, in fused mode the filter is
+        evaluated over the whole scene and the area outside of the selected area
+        or shape area is masked when the masks are blended
+        """
+        if self.fused:
+            return in_file
+        return self.clip(in_file, out_clipped_file)
+
+    def add_mask_file(self, mask_file):
+        """Save the result file of the filter to blend it"""
+        self.cloud_masking_files.append(mask_file)
+        self.mask_sources.append(mask_file)
+
     def do_clipping_extent(self, in_file, out_file):
         # check and adjust the maximum/minimum values for extent selected
         # based on the original image
@@ -186,103 +317,158 @@ class CloudMaskingResult(object):
         # trim
         gdal.Translate(stack_file_trimmed, stack_file, projWin=[box.xMinimum(), box.yMaximum(), box.xMaximum(), box.yMinimum()])
 
-        if crop_to_cutline:
-            #  -crop_to_cutline
-            call('gdalwarp -multi -wo NUM_THREADS=ALL_CPUS --config GDALWARP_IGNORE_BAD_CUTLINE YES -cutline "{}" '
-                 '-dstnodata 0 "{}" "{}"'.format(shape_path, stack_file_trimmed, clip_file), shell=True)
-        else:
-            call('gdalwarp -multi -wo NUM_THREADS=ALL_CPUS --config GDALWARP_IGNORE_BAD_CUTLINE YES -cutline "{}" '
-                 '-dstnodata {} "{}" "{}"'.format(shape_path, nodata, stack_file_trimmed, clip_file), shell=True)
+        clip_with_cutline(stack_file_trimmed, clip_file, shape_path, 0 if crop_to_cutline else nodata, crop_to_cutline)
         os.remove(stack_file_trimmed)
 
-    def do_nodata_mask(self, img_to_mask):
+    def do_composite_masks(self):
+        """
+        Blend all cloud masking files in the order that they were made, the
+        first filter with a masked value (different to 1) has the priority
+        over the next filters. In the same pass mask the nodata as 255 and
+        set the area outside the AOI or shape: as valid data (1) or, cropping
+        to the shape, as nodata (255), the final mask has the extent of the
+        whole scene. Return the final cloud mask file
+        """
         band_1 = get_prefer_name(os.path.join(self.input_dir, self.mtl_file['FILE_NAME_BAND_1']))
+        if not os.path.isfile(band_1):
+            band_1 = get_prefer_name(os.path.join(self.input_dir, self.mtl_file['FILE_NAME_BAND_SR_1']))
 
-        band_from_mask = self.clip(band_1, os.path.join(self.tmp_dir, "band_from_mask.tif"), process_bar=False)
+        final_cloud_mask_file = os.path.join(self.tmp_dir, "cloud_blended_{}.tif".format(
+            datetime.now().strftime('%H%M%S')))
 
-        cmd = ['gdal_calc' if platform.system() == 'Windows' else 'gdal_calc.py', '--quiet', '--overwrite',
-               '--calc "A*(B>0)+255*logical_or(B==0,A==0)"', '-A "{}"'.format(img_to_mask), '-B "{}"'.format(band_from_mask),
-               '--outfile "{}"'.format(img_to_mask)]
-        call(" ".join(cmd), shell=True)
+        if self.clipping_with_shape:
+            composite_masks(self.mask_sources, final_cloud_mask_file, band_1,
+                            cutline_file=os.path.abspath(self.shape_path),
+                            keep_outside_cutline=self.clipping_with_aoi or not self.crop_to_cutline,
+                            histogram_files=self.histogram_files)
+        elif self.clipping_with_aoi:
+            tmp_aoi = os.path.join(self.tmp_dir, "aoi_tmp_{}.gpkg".format(datetime.now().strftime("%y%m%d_%H%M%S")))
+            QgsVectorFileWriter.writeAsVectorFormat(self.aoi_features, tmp_aoi, "System", self.aoi_features.crs(), "GPKG")
+            composite_masks(self.mask_sources, final_cloud_mask_file, band_1,
+                            cutline_file=tmp_aoi, keep_outside_cutline=True,
+                            histogram_files=self.histogram_files)
+            try: os.remove(tmp_aoi)
+            except: pass
+        else:
+            composite_masks(self.mask_sources, final_cloud_mask_file, band_1,
+                            histogram_files=self.histogram_files)
 
-        # unset nodata
-        cmd = ['gdal_edit' if platform.system() == 'Windows' else 'gdal_edit.py', '"{}"'.format(img_to_mask), '-unsetnodata']
-        call(" ".join(cmd), shell=True)
+        return final_cloud_mask_file
 
     def do_fmask(self, filters_enabled, min_cloud_size=0, cloud_prob_thresh=0.225, cloud_buffer_size=4,
                  shadow_buffer_size=6, cirrus_prob_ratio=0.04, nir_fill_thresh=0.02, swir2_thresh=0.03,
-                 whiteness_thresh=0.7, swir2_water_test=0.03, nir_snow_thresh=0.11, green_snow_thresh=0.1):
+                 whiteness_thresh=0.7, swir2_water_test=0.03, nir_snow_thresh=0.11, green_snow_thresh=0.1,
+                 preview_factor=None):
+        """
+        Make the Fmask cloud mask. With preview_factor (e.g. 4 for 1/4 of the
+        resolution) the whole Fmask process is done over the decimated stacks
+        for a fast preview of the parameters, the pixel based parameters are
+        scaled to the decimated resolution, the result mask is decimated too
+        """
+
+        # the bands stacks are virtual rasters (VRT) unless they are materialized
+        stack_ext = ".tif" if self.materialize_stacks else ".vrt"
+        # the saturation, TOA and clipped products depend on the bands, the
+        # MTL file and the selected area or shape area, they are reused from the
+        # cache (or from the previous run without cache) when only the Fmask
+        # parameters changed
+        reflective_inputs = self.reflective_bands + [self.mtl_path]
+        clip_params = self.clip_params()
 
         ########################################
         # reflective bands stack
 
         # tmp file for reflective bands stack
-        self.reflective_stack_file = os.path.join(self.tmp_dir, "reflective_stack.tif")
+        self.reflective_stack_file = os.path.join(self.tmp_dir, "reflective_stack" + stack_ext)
 
         if not os.path.isfile(self.reflective_stack_file):
             update_process_bar(self.process_bar, 10, self.process_status,
                                self.tr("Making reflective bands stack..."))
 
-            gdal_merge.main(["", "-separate", "-of", "GTiff", "-o",
-                             self.reflective_stack_file] + self.reflective_bands)
+            if self.materialize_stacks:
+                self.reflective_stack_file = self.cached_product(
+                    "reflective_stack", self.reflective_bands, self.reflective_stack_file,
+                    lambda out_file: build_stack(self.reflective_bands, out_file, materialize=True))
+            else:
+                build_stack(self.reflective_bands, self.reflective_stack_file)
 
         ########################################
         # thermal bands stack
 
-        # tmp file for reflective bands stack
-        self.thermal_stack_file = os.path.join(self.tmp_dir, "thermal_stack.tif")
+        # tmp file for thermal bands stack
+        self.thermal_stack_file = os.path.join(self.tmp_dir, "thermal_stack" + stack_ext)
 
         if not os.path.isfile(self.thermal_stack_file):
             update_process_bar(self.process_bar, 20, self.process_status,
                                self.tr("Making thermal bands stack..."))
 
-            gdal_merge.main(["", "-separate", "-of", "GTiff", "-o",
-                             self.thermal_stack_file] + self.thermal_bands)
+            if self.materialize_stacks:
+                self.thermal_stack_file = self.cached_product(
+                    "thermal_stack", self.thermal_bands, self.thermal_stack_file,
+                    lambda out_file: build_stack(self.thermal_bands, out_file, materialize=True))
+            else:
+                build_stack(self.thermal_bands, self.thermal_stack_file)
 
         ########################################
         # clipping the reflective bands stack (only if is activated selected area or shape area)
         self.reflective_stack_clip_file = os.path.join(self.tmp_dir, "reflective_stack_clip.tif")
-        self.reflective_stack_for_process = self.clip(self.reflective_stack_file, self.reflective_stack_clip_file)
+        self.reflective_stack_for_process = self.cached_product(
+            "reflective_stack_clip", self.reflective_bands, self.reflective_stack_clip_file,
+            lambda out_file: self.clip(self.reflective_stack_file, out_file), clip=clip_params)
 
         ########################################
         # clipping the thermal bands stack (only if is activated selected area or shape area)
         self.thermal_stack_clip_file = os.path.join(self.tmp_dir, "thermal_stack_clip.tif")
-        self.thermal_stack_for_process = self.clip(self.thermal_stack_file, self.thermal_stack_clip_file)
+        self.thermal_stack_for_process = self.cached_product(
+            "thermal_stack_clip", self.thermal_bands, self.thermal_stack_clip_file,
+            lambda out_file: self.clip(self.thermal_stack_file, out_file), clip=clip_params)
+
+        ########################################
+        # decimate the stacks for the preview
+        if preview_factor:
+            self.reflective_stack_for_process = self.decimate_for_preview(
+                self.reflective_stack_for_process, os.path.join(self.tmp_dir, "reflective_stack_preview.vrt"),
+                preview_factor)
+            self.thermal_stack_for_process = self.decimate_for_preview(
+                self.thermal_stack_for_process, os.path.join(self.tmp_dir, "thermal_stack_preview.vrt"),
+                preview_factor)
+
+            # the pixel based parameters in the decimated resolution
+            min_cloud_size = int(round(min_cloud_size / preview_factor ** 2))
+            cloud_buffer_size = round(cloud_buffer_size / preview_factor)
+            shadow_buffer_size = round(shadow_buffer_size / preview_factor)
+        stage_params = {"preview_factor": preview_factor}
 
         ########################################
         # estimates of per-pixel angles for sun
         # and satellite azimuth and zenith
         #
-        # fmask_usgsLandsatMakeAnglesImage.py
-
-        # tmp file for angles
-        self.angles_file = os.path.join(self.tmp_dir, "angles.tif")
+        # fmask_usgsLandsatMakeAnglesImage.py, the angles are evaluated from the
+        # model for the pixels queried instead of making an angles file
 
         update_process_bar(self.process_bar, 30, self.process_status,
-                           self.tr("Making fmask angles file..."))
+                           self.tr("Making fmask angles model..."))
 
         mtlInfo = config.readMTLFile(self.mtl_path)
 
         imgInfo = fileinfo.ImageInfo(self.reflective_stack_for_process)
-        corners = landsatangles.findImgCorners(self.reflective_stack_for_process, imgInfo)
+        corners = landsatangles.findImgCornersFast(self.reflective_stack_for_process, imgInfo)
         nadirLine = landsatangles.findNadirLine(corners)
 
         extentSunAngles = landsatangles.sunAnglesForExtent(imgInfo, mtlInfo)
         satAzimuth = landsatangles.satAzLeftRight(nadirLine)
 
-        landsatangles.makeAnglesImage(self.reflective_stack_for_process, self.angles_file,
-                                      nadirLine, extentSunAngles, satAzimuth, imgInfo)
+        self.angles_model = landsatangles.LandsatAnglesModelInfo(imgInfo, nadirLine, extentSunAngles, satAzimuth)
 
         ########################################
-        # saturation mask
+        # saturation mask and top of Atmosphere reflectance
         #
-        # fmask_usgsLandsatSaturationMask.py
-
-        # tmp file for angles
-        self.saturationmask_file = os.path.join(self.tmp_dir, "saturationmask.tif")
+        # fmask_usgsLandsatSaturationMask.py and fmask_usgsLandsatTOA.py, both
+        # made in the same pass through the reflective bands stack, unless
+        # one of them is in the cache, then only the other is made
 
         update_process_bar(self.process_bar, 40, self.process_status,
-                           self.tr("Making saturation mask file..."))
+                           self.tr("Making saturation mask and top of Atmosphere ref..."))
 
         if self.landsat_version == 4:
             sensor = config.FMASK_LANDSAT47
@@ -293,26 +479,7 @@ class CloudMaskingResult(object):
         elif self.landsat_version in [8, 9]:
             sensor = config.FMASK_LANDSATOLI
 
-        # needed so the saturation function knows which
-        # bands are visible etc.
-        fmaskConfig = config.FmaskConfig(sensor)
-
-        saturationcheck.makeSaturationMask(fmaskConfig, self.reflective_stack_for_process,
-                                           self.saturationmask_file)
-
-        ########################################
-        # top of Atmosphere reflectance
-        #
-        # fmask_usgsLandsatTOA.py
-
-        # tmp file for toa
-        self.toa_file = os.path.join(self.tmp_dir, "toa.tif")
-
-        update_process_bar(self.process_bar, 50, self.process_status,
-                           self.tr("Making top of Atmosphere ref..."))
-
-        landsatTOA.makeTOAReflectance(self.reflective_stack_for_process, self.mtl_path,
-                                      self.angles_file, self.toa_file)
+        self.make_saturation_and_toa(sensor, reflective_inputs, clip_params, stage_params)
 
         ########################################
         # cloud mask
@@ -320,7 +487,8 @@ class CloudMaskingResult(object):
         # fmask_usgsLandsatStacked.py
 
         # tmp file for cloud
-        self.cloud_fmask_file = os.path.join(self.tmp_dir, "cloud_fmask_{}.tif".format(datetime.now().strftime('%H%M%S')))
+        self.cloud_fmask_file = os.path.join(self.tmp_dir, "cloud_fmask{}_{}.tif".format(
+            "_preview" if preview_factor else "", datetime.now().strftime('%H%M%S')))
 
         update_process_bar(self.process_bar, 70, self.process_status,
                            self.tr("Making cloud mask with fmask..."))
@@ -329,9 +497,6 @@ class CloudMaskingResult(object):
         # stack of Landsat thermal bands
         thermalInfo = config.readThermalInfoFromLandsatMTL(self.mtl_path)
 
-        anglesInfo = config.AnglesFileInfo(self.angles_file, 3, self.angles_file,
-                                           2, self.angles_file, 1, self.angles_file, 0)
-
         if self.landsat_version == 4:
             sensor = config.FMASK_LANDSAT47
         elif self.landsat_version == 5:
@@ -347,12 +512,14 @@ class CloudMaskingResult(object):
         fmaskFilenames.setOutputCloudMaskFile(self.cloud_fmask_file)
         fmaskFilenames.setSaturationMask(self.saturationmask_file)  # TODO: optional
 
-        fmaskConfig = config.FmaskConfig(sensor)
+        fmaskConfig = self.fmask_config(sensor)
         fmaskConfig.setThermalInfo(thermalInfo)
-        fmaskConfig.setAnglesInfo(anglesInfo)
+        fmaskConfig.setAnglesInfo(self.angles_model)
         fmaskConfig.setKeepIntermediates(False)
         fmaskConfig.setVerbose(True)
         fmaskConfig.setTempDir(self.tmp_dir)
+        fmaskConfig.setShadowMatchWorkers(self.fmask_workers or os.cpu_count() or 1)
+        fmaskConfig.setStageCache(self.fmask_preview_stages if preview_factor else self.fmask_stages)
 
         # Set the settings fmask filters from widget to FmaskConfig
         fmaskConfig.setMinCloudSize(min_cloud_size)
@@ -392,12 +559,58 @@ class CloudMaskingResult(object):
         fmask.doFmask(fmaskFilenames, fmaskConfig)
 
         # save final result of masking
-        self.cloud_masking_files.append(self.cloud_fmask_file)
+        self.add_mask_file(self.cloud_fmask_file)
 
         ### ending fmask process
         update_process_bar(self.process_bar, 100, self.process_status,
                            self.tr("DONE"))
 
+    def make_saturation_and_toa(self, sensor, reflective_inputs, clip_params, stage_params):
+        """
+        Make the saturation mask and the top of Atmosphere reflectance of the
+        reflective stack, in the same pass through it, unless one of them is
+        in the cache, then only the other is made
+        """
+        # tmp file for toa, made along with the saturation mask
+        toa_file = os.path.join(self.tmp_dir, "toa.tif")
+        toa_params = dict(stage_params, angles="model")
+        toa_cached = self.has_product("toa", reflective_inputs, toa_file, clip=clip_params, params=toa_params)
+        toa_made = []
+
+        def make_saturation_mask(saturationmask_file):
+            # needed so the saturation function knows which
+            # bands are visible etc.
+            fmaskConfig = self.fmask_config(sensor)
+
+            if toa_cached:
+                saturationcheck.makeSaturationMask(fmaskConfig, self.reflective_stack_for_process,
+                                                   saturationmask_file)
+                return saturationmask_file
+
+            landsatTOA.makeTOAReflectance(self.reflective_stack_for_process, self.mtl_path,
+                                          None, toa_file, anglesModel=self.angles_model,
+                                          saturationMaskFile=saturationmask_file, fmaskConfig=fmaskConfig)
+            toa_made.append(toa_file)
+            return saturationmask_file
+
+        # tmp file for saturation mask
+        self.saturationmask_file = self.cached_product(
+            "saturation_mask", reflective_inputs, os.path.join(self.tmp_dir, "saturationmask.tif"),
+            make_saturation_mask, clip=clip_params, params=dict(stage_params, sensor=sensor))
+
+        update_process_bar(self.process_bar, 50, self.process_status,
+                           self.tr("Making top of Atmosphere ref..."))
+
+        def make_toa(toa_file):
+            if toa_file not in toa_made:
+                landsatTOA.makeTOAReflectance(self.reflective_stack_for_process, self.mtl_path,
+                                              None, toa_file, anglesModel=self.angles_model,
+                                              fmaskConfig=self.fmask_config(sensor))
+            return toa_file
+
+        self.toa_file = self.cached_product("toa", reflective_inputs, toa_file,
+                                            make_toa, clip=clip_params, params=toa_params)
+
     def do_blue_band(self, bb_threshold):
         # tmp file for cloud
         self.cloud_bb_file = os.path.join(self.tmp_dir, "cloud_bb_{}.tif".format(datetime.now().strftime('%H%M%S')))
@@ -424,23 +637,53 @@ class CloudMaskingResult(object):
         ########################################
         # clipping the Blue Band (only if is activated selected area or shape area)
         self.blue_band_clip_file = os.path.join(self.tmp_dir, "blue_band_clip.tif")
-        self.blue_band_for_process = self.clip(self.blue_band_file, self.blue_band_clip_file)
+        self.blue_band_for_process = self.clip_filter_input(self.blue_band_file, self.blue_band_clip_file)
 
         ########################################
         # do blue band filter
-        cmd = ['gdal_calc' if platform.system() == 'Windows' else 'gdal_calc.py', '--quiet', '--overwrite',
-               '--calc "1*(A<{threshold})+6*(A>={threshold})"'.format(threshold=bb_threshold),
-               '-A "{}"'.format(self.blue_band_for_process), '--outfile "{}"'.format(self.cloud_bb_file),
-               '--type="Byte"', '--co COMPRESS=PACKBITS']
-        call(" ".join(cmd), shell=True)
+        if self.fused:
+            self.mask_sources.append(
+                (self.blue_band_for_process, lambda values: numpy.where(values < bb_threshold, 1, 6)))
+            update_process_bar(self.process_bar, 100, self.process_status,
+                               self.tr("DONE"))
+            return
+
+        calc("1*(A<{threshold})+6*(A>={threshold})".format(threshold=bb_threshold), self.cloud_bb_file,
+             out_type="Byte", creation_options=["COMPRESS=PACKBITS"], A=self.blue_band_for_process)
 
         # save final result of masking
-        self.cloud_masking_files.append(self.cloud_bb_file)
+        self.add_mask_file(self.cloud_bb_file)
 
         ### ending process
         update_process_bar(self.process_bar, 100, self.process_status,
                            self.tr("DONE"))
 
+    def do_qa_mask(self, qa_file, qa_mask_file, codes_lut):
+        """
+        Apply the lookup table of the filter codes to the QA file. If the QA file
+        was already read, its cached values histogram tells when none of the
+        values to mask are in the file, then all the output is valid (1)
+        without read the QA file again. In fused mode the lookup table is
+        applied by blocks when the masks are blended, and the values histogram
+        is computed in the same pass
+        """
+        histogram = get_cached_histogram(qa_file)
+        if histogram is not None and not histogram[codes_lut != 1].any():
+            if not self.fused:
+                make_constant_raster(qa_file, qa_mask_file, 1)
+                self.add_mask_file(qa_mask_file)
+            # else, nothing to blend
+            return
+
+        if self.fused:
+            self.mask_sources.append((qa_file, lambda values: numpy.take(codes_lut, values)))
+            if histogram is None:
+                self.histogram_files.append(qa_file)
+            return
+
+        apply_lut(qa_file, qa_mask_file, codes_lut, cache_histogram=True)
+        self.add_mask_file(qa_mask_file)
+
     def do_cloud_qa_l457(self, cloud_qa_file, checked_items, specific_values=[]):
         # tmp file for cloud
         self.cloud_qa = os.path.join(self.tmp_dir, "cloud_qa_{}.tif".format(datetime.now().strftime('%H%M%S')))
@@ -450,48 +693,17 @@ class CloudMaskingResult(object):
         ########################################
         # clipping the QA Mask (only if is activated selected area or shape area)
         self.cloud_qa_clip_file = os.path.join(self.tmp_dir, "cloud_qa_clip.tif")
-        self.cloud_qa_for_process = self.clip(cloud_qa_file, self.cloud_qa_clip_file)
+        self.cloud_qa_for_process = self.clip_filter_input(cloud_qa_file, self.cloud_qa_clip_file)
 
         ########################################
-        # convert selected items to binary and decimal values
-        values_combinations = []
-        # bits not used or not fill
-        static_bits = [6, 7]
-
-        # generate the values combinations for one bit items selected
-        cloud_qa_items_1b = {"Dark Dense Vegetation (bit 0)": [0], "Cloud (bit 1)": [1], "Cloud Shadow (bit 2)": [2],
-                             "Adjacent to cloud (bit 3)": [3], "Snow (bit 4)": [4], "Water (bit 5)": [5]}
-
-        for item, bits in cloud_qa_items_1b.items():
-            binary = [0] * 8
-            if checked_items[item]:
-                binary[(len(binary) - 1) - bits[0]] = 1
-                values_combinations += list(binary_combination(binary, static_bits + bits))
-
-        # add the specific values
-        if specific_values:
-            values_combinations += specific_values
-
-        # delete duplicates
-        values_combinations = list(set(values_combinations))
-
-        # only left the values inside the image
-        values_combinations = check_values_in_image(self.cloud_qa_for_process, values_combinations)
-
-        filter_values = ",".join(["A==" + str(x) for x in values_combinations])
-        not_filter_values = ",".join(["A!=" + str(x) for x in values_combinations])
+        # convert selected items to the lookup table of the QA values to mask
+        qa_lut = qa_bits.compile_checked_items(qa_bits.CLOUD_QA_L457, checked_items, specific_values)
+        # the selected values get the filter code, the other values and the nodata are valid (1)
+        codes_lut = qa_bits.lut_to_codes(qa_lut, 7, get_nodata_value_from_file(self.cloud_qa_for_process))
 
         ########################################
         # do QA Mask filter
-        gdal_calc.Calc(calc="1*(numpy.all([{nfv}], axis=0)) + 7*(numpy.any([{fv}], axis=0))".format(fv=filter_values,
-                                                                                                    nfv=not_filter_values),
-                       A=self.cloud_qa_for_process, outfile=self.cloud_qa, type="Byte", NoDataValue=1)
-        # unset the nodata, leave the 1 (valid fields)
-        cmd = ['gdal_edit' if platform.system() == 'Windows' else 'gdal_edit.py', '"{}"'.format(self.cloud_qa), '-unsetnodata']
-        call(" ".join(cmd), shell=True)
-
-        # save final result of masking
-        self.cloud_masking_files.append(self.cloud_qa)
+        self.do_qa_mask(self.cloud_qa_for_process, self.cloud_qa, codes_lut)
 
         ### ending process
         update_process_bar(self.process_bar, 100, self.process_status,
@@ -506,63 +718,17 @@ class CloudMaskingResult(object):
         ########################################
         # clipping the QA Mask (only if is activated selected area or shape area)
         self.aerosol_clip_file = os.path.join(self.tmp_dir, "aerosol_clip.tif")
-        self.aerosol_for_process = self.clip(aerosol_file, self.aerosol_clip_file)
+        self.aerosol_for_process = self.clip_filter_input(aerosol_file, self.aerosol_clip_file)
 
         ########################################
-        # convert selected items to binary and decimal values
-        values_combinations = []
-        # bits not used or not fill
-        static_bits = [0, 4, 5]
-
-        # generate the values combinations for one bit items selected
-        aerosol_items_1b = {"Aerosol Retrieval - Valid (bit 1)": [1],
-                            "Aerosol Retrieval - Interpolated (bit 2)": [2],
-                            "Water Pixel (bit 3)": [3]}
-
-        for item, bits in aerosol_items_1b.items():
-            binary = [0]*8
-            if checked_items[item]:
-                binary[(len(binary) - 1) - bits[0]] = 1
-                values_combinations += list(binary_combination(binary, static_bits + bits))
-
-        # generate the values combinations for two bits items selected
-        aerosol_items_2b = {"Aerosol Content (bits 6-7)": [6, 7]}
-        levels = {"Climatology content": [0, 0], "Low content": [0, 1],
-                  "Average content": [1, 0], "High content": [1, 1]}
-
-        for item, bits in aerosol_items_2b.items():
-            if item in checked_items.keys():
-                for level in checked_items[item]:
-                    binary = [0]*8
-                    binary[bits[0]:bits[1]+1] = (levels[level])[::-1]
-                    binary.reverse()
-                    values_combinations += list(binary_combination(binary, static_bits + bits))
-
-        # add the specific values
-        if specific_values:
-            values_combinations += specific_values
-
-        # delete duplicates
-        values_combinations = list(set(values_combinations))
-
-        # only left the values inside the image
-        values_combinations = check_values_in_image(self.aerosol_for_process, values_combinations)
-
-        filter_values = ",".join(["A=="+str(x) for x in values_combinations])
-        not_filter_values = ",".join(["A!="+str(x) for x in values_combinations])
+        # convert selected items to the lookup table of the QA values to mask
+        qa_lut = qa_bits.compile_checked_items(qa_bits.AEROSOL_L89, checked_items, specific_values)
+        # the selected values get the filter code, the other values and the nodata are valid (1)
+        codes_lut = qa_bits.lut_to_codes(qa_lut, 8, get_nodata_value_from_file(self.aerosol_for_process))
 
         ########################################
         # do QA Mask filter
-        gdal_calc.Calc(calc="1*(numpy.all([{nfv}], axis=0)) + 8*(numpy.any([{fv}], axis=0))".format(fv=filter_values, nfv=not_filter_values),
-                       A=self.aerosol_for_process, outfile=self.aerosol, type="Byte", NoDataValue=1)
-
-        # unset nodata
-        cmd = ['gdal_edit' if platform.system() == 'Windows' else 'gdal_edit.py',
-               '"{}"'.format(self.aerosol), '-unsetnodata']
-        call(" ".join(cmd), shell=True)
-
-        # save final result of masking
-        self.cloud_masking_files.append(self.aerosol)
+        self.do_qa_mask(self.aerosol_for_process, self.aerosol, codes_lut)
 
         ### ending process
         update_process_bar(self.process_bar, 100, self.process_status,
@@ -580,70 +746,20 @@ class CloudMaskingResult(object):
         ########################################
         # clipping the QA Mask (only if is activated selected area or shape area)
         self.pixel_qa_clip_file = os.path.join(self.tmp_dir, "pixel_qa_clip.tif")
-        self.pixel_qa_for_process = self.clip(pixel_qa_file, self.pixel_qa_clip_file)
+        self.pixel_qa_for_process = self.clip_filter_input(pixel_qa_file, self.pixel_qa_clip_file)
 
         ########################################
-        # convert selected items to binary and decimal values
-        values_combinations = []
-        # bits not used or not fill
+        # convert selected items to the lookup table of the QA values to mask
         if self.landsat_version in [4, 5, 7]:
-            static_bits = [0, 1, 8, 9, 10, 11, 12, 13, 14, 15]
+            qa_lut = qa_bits.compile_checked_items(qa_bits.PIXEL_QA_L457, checked_items, specific_values)
         if self.landsat_version in [8, 9]:
-            static_bits = [0, 1, 11, 12, 13, 14, 15]
-
-        # generate the values combinations for one bit items selected
-        pixel_qa_items_1b = {"Water (bit 2)": [2], "Cloud Shadow (bit 3)": [3],
-                             "Snow (bit 4)": [4], "Cloud (bit 5)": [5]}
-        if self.landsat_version in [8, 9]:  # add to L89
-            pixel_qa_items_1b["Terrain Occlusion (bit 10)"] = [10]
-
-        for item, bits in pixel_qa_items_1b.items():
-            binary = [0]*16
-            if checked_items[item]:
-                binary[(len(binary) - 1) - bits[0]] = 1
-                values_combinations += list(binary_combination(binary, static_bits + bits))
-
-        # generate the values combinations for two bits items selected
-        if self.landsat_version in [4, 5, 7]:
-            pixel_qa_items_2b = {"Cloud Confidence (bits 6-7)": [6, 7]}
-        if self.landsat_version in [8, 9]:
-            pixel_qa_items_2b = {"Cloud Confidence (bits 6-7)": [6, 7], "Cirrus Confidence (bits 8-9)": [8, 9]}
-        levels = {"0% None": [0, 0], "0-33% Low": [0, 1],
-                  "34-66% Medium": [1, 0], "67-100% High": [1, 1]}
-
-        for item, bits in pixel_qa_items_2b.items():
-            if item in checked_items.keys():
-                for level in checked_items[item]:
-                    binary = [0] * 16
-                    binary[bits[0]:bits[1]+1] = (levels[level])[::-1]
-                    binary.reverse()
-                    values_combinations += list(binary_combination(binary, static_bits + bits))
-
-        # add the specific values
-        if specific_values:
-            values_combinations += specific_values
-
-        # delete duplicates
-        values_combinations = list(set(values_combinations))
-
-        # only left the values inside the image
-        values_combinations = check_values_in_image(self.pixel_qa_for_process, values_combinations)
-
-        filter_values = ",".join(["A==" + str(x) for x in values_combinations])
-        not_filter_values = ",".join(["A!=" + str(x) for x in values_combinations])
+            qa_lut = qa_bits.compile_checked_items(qa_bits.PIXEL_QA_L89, checked_items, specific_values)
+        # the selected values get the filter code, the other values and the nodata are valid (1)
+        codes_lut = qa_bits.lut_to_codes(qa_lut, 9, get_nodata_value_from_file(self.pixel_qa_for_process))
 
         ########################################
         # do QA Mask filter
-        gdal_calc.Calc(calc="1*(numpy.all([{nfv}], axis=0)) + 9*(numpy.any([{fv}], axis=0))".format(fv=filter_values, nfv=not_filter_values),
-                       A=self.pixel_qa_for_process, outfile=self.pixel_qa, type="Byte", NoDataValue=1)
-
-        # unset nodata
-        cmd = ['gdal_edit' if platform.system() == 'Windows' else 'gdal_edit.py',
-               '"{}"'.format(self.pixel_qa), '-unsetnodata']
-        call(" ".join(cmd), shell=True)
-
-        # save final result of masking
-        self.cloud_masking_files.append(self.pixel_qa)
+        self.do_qa_mask(self.pixel_qa_for_process, self.pixel_qa, codes_lut)
 
         ### ending process
         update_process_bar(self.process_bar, 100, self.process_status,
@@ -661,74 +777,17 @@ class CloudMaskingResult(object):
         ########################################
         # clipping the QA Mask (only if is activated selected area or shape area)
         self.qaband_clip_file = os.path.join(self.tmp_dir, "qaband_clip.tif")
-        self.qaband_for_process = self.clip(qabandc1_file, self.qaband_clip_file)
+        self.qaband_for_process = self.clip_filter_input(qabandc1_file, self.qaband_clip_file)
 
         ########################################
-        # convert selected items to binary and decimal values
-        values_combinations = []
-        # bits not used or not fill
-        static_bits = [0, 11, 12, 13, 14, 15]
-
-        # generate the values combinations for one bit items selected
-        qaband_items_1b = {"Dropped Pixel (bit 1)": [1], "Cloud (bit 4)": [4]}
-
-        for item, bits in qaband_items_1b.items():
-            binary = [0] * 16
-            if checked_items[item]:
-                binary[(len(binary) - 1) - bits[0]] = 1
-                values_combinations += list(binary_combination(binary, static_bits + bits))
-
-        # generate the values combinations for two bits items selected
-        qaband_items_2b = {"Radiometric Saturation (bits 2-3)": [2, 3]}
-        levels = {"No bands saturated": [0, 0], "1 to 2 bands saturated": [0, 1],
-                  "3 to 4 bands saturated": [1, 0], "> 4 bands saturated": [1, 1]}
-        for item, bits in qaband_items_2b.items():
-            if item in checked_items.keys():
-                for level in checked_items[item]:
-                    binary = [0] * 16
-                    binary[bits[0]:bits[1] + 1] = (levels[level])[::-1]
-                    binary.reverse()
-                    values_combinations += list(binary_combination(binary, static_bits + bits))
-
-        # generate the values combinations for two bits items selected
-        qaband_items_2b = {"Cloud Confidence (bits 5-6)": [5, 6],
-                           "Cloud Shadow (bits 7-8)": [7, 8], "Snow/Ice (bits 9-10)": [9, 10]}
-        levels = {"0% None": [0, 0], "0-33% Low": [0, 1],
-                  "34-66% Medium": [1, 0], "67-100% High": [1, 1]}
-        for item, bits in qaband_items_2b.items():
-            if item in checked_items.keys():
-                for level in checked_items[item]:
-                    binary = [0] * 16
-                    binary[bits[0]:bits[1] + 1] = (levels[level])[::-1]
-                    binary.reverse()
-                    values_combinations += list(binary_combination(binary, static_bits + bits))
-
-        # add the specific values
-        if specific_values:
-            values_combinations += specific_values
-
-        # delete duplicates
-        values_combinations = list(set(values_combinations))
-
-        # only left the values inside the image
-        values_combinations = check_values_in_image(self.qaband_for_process, values_combinations)
-
-        filter_values = ",".join(["A==" + str(x) for x in values_combinations])
-        not_filter_values = ",".join(["A!=" + str(x) for x in values_combinations])
+        # convert selected items to the lookup table of the QA values to mask
+        qa_lut = qa_bits.compile_checked_items(qa_bits.QABAND_C1_L457, checked_items, specific_values)
+        # the selected values get the filter code, the other values and the nodata are valid (1)
+        codes_lut = qa_bits.lut_to_codes(qa_lut, 10, get_nodata_value_from_file(self.qaband_for_process))
 
         ########################################
         # do QA Mask filter
-        tmp_pqa_file = os.path.join(self.tmp_dir, "qaband.tif")
-        gdal_calc.Calc(calc="1*(numpy.all([{nfv}], axis=0)) + 10*(numpy.any([{fv}], axis=0))".format(fv=filter_values,
-                                                                                                    nfv=not_filter_values),
-                       A=self.qaband_for_process, outfile=tmp_pqa_file, type="Byte", NoDataValue=1)
-        # unset the nodata, leave the 1 (valid fields)
-        gdal.Translate(self.qaband, tmp_pqa_file, noData="none")
-        # delete tmp files
-        os.remove(tmp_pqa_file)
-
-        # save final result of masking
-        self.cloud_masking_files.append(self.qaband)
+        self.do_qa_mask(self.qaband_for_process, self.qaband, codes_lut)
 
         ### ending process
         update_process_bar(self.process_bar, 100, self.process_status,
@@ -746,74 +805,17 @@ class CloudMaskingResult(object):
         ########################################
         # clipping the QA Mask (only if is activated selected area or shape area)
         self.qaband_clip_file = os.path.join(self.tmp_dir, "qaband_clip.tif")
-        self.qaband_for_process = self.clip(qabandc1_file, self.qaband_clip_file)
+        self.qaband_for_process = self.clip_filter_input(qabandc1_file, self.qaband_clip_file)
 
         ########################################
-        # convert selected items to binary and decimal values
-        values_combinations = []
-        # bits not used or not fill
-        static_bits = [0, 13, 14, 15]
-
-        # generate the values combinations for one bit items selected
-        qaband_items_1b = {"Terrain Occlusion (bit 1)": [1], "Cloud (bit 4)": [4]}
-
-        for item, bits in qaband_items_1b.items():
-            binary = [0] * 16
-            if checked_items[item]:
-                binary[(len(binary) - 1) - bits[0]] = 1
-                values_combinations += list(binary_combination(binary, static_bits + bits))
-
-        # generate the values combinations for two bits items selected
-        qaband_items_2b = {"Radiometric Saturation (bits 2-3)": [2, 3]}
-        levels = {"No bands saturated": [0, 0], "1 to 2 bands saturated": [0, 1],
-                  "3 to 4 bands saturated": [1, 0], "> 4 bands saturated": [1, 1]}
-        for item, bits in qaband_items_2b.items():
-            if item in checked_items.keys():
-                for level in checked_items[item]:
-                    binary = [0] * 16
-                    binary[bits[0]:bits[1] + 1] = (levels[level])[::-1]
-                    binary.reverse()
-                    values_combinations += list(binary_combination(binary, static_bits + bits))
-
-        # generate the values combinations for two bits items selected
-        qaband_items_2b = {"Cloud Confidence (bits 5-6)": [5, 6], "Cloud Shadow (bits 7-8)": [7, 8],
-                           "Snow/Ice (bits 9-10)": [9, 10], "Cirrus Confidence (bits 11-12)": [11, 12]}
-        levels = {"0% None": [0, 0], "0-33% Low": [0, 1],
-                  "34-66% Medium": [1, 0], "67-100% High": [1, 1]}
-        for item, bits in qaband_items_2b.items():
-            if item in checked_items.keys():
-                for level in checked_items[item]:
-                    binary = [0] * 16
-                    binary[bits[0]:bits[1] + 1] = (levels[level])[::-1]
-                    binary.reverse()
-                    values_combinations += list(binary_combination(binary, static_bits + bits))
-
-        # add the specific values
-        if specific_values:
-            values_combinations += specific_values
-
-        # delete duplicates
-        values_combinations = list(set(values_combinations))
-
-        # only left the values inside the image
-        values_combinations = check_values_in_image(self.qaband_for_process, values_combinations)
-
-        filter_values = ",".join(["A==" + str(x) for x in values_combinations])
-        not_filter_values = ",".join(["A!=" + str(x) for x in values_combinations])
+        # convert selected items to the lookup table of the QA values to mask
+        qa_lut = qa_bits.compile_checked_items(qa_bits.QABAND_C1_L89, checked_items, specific_values)
+        # the selected values get the filter code, the other values and the nodata are valid (1)
+        codes_lut = qa_bits.lut_to_codes(qa_lut, 10, get_nodata_value_from_file(self.qaband_for_process))
 
         ########################################
         # do QA Mask filter
-        tmp_pqa_file = os.path.join(self.tmp_dir, "qaband.tif")
-        gdal_calc.Calc(calc="1*(numpy.all([{nfv}], axis=0)) + 10*(numpy.any([{fv}], axis=0))".format(fv=filter_values,
-                                                                                                    nfv=not_filter_values),
-                       A=self.qaband_for_process, outfile=tmp_pqa_file, type="Byte", NoDataValue=1)
-        # unset the nodata, leave the 1 (valid fields)
-        gdal.Translate(self.qaband, tmp_pqa_file, noData="none")
-        # delete tmp files
-        os.remove(tmp_pqa_file)
-
-        # save final result of masking
-        self.cloud_masking_files.append(self.qaband)
+        self.do_qa_mask(self.qaband_for_process, self.qaband, codes_lut)
 
         ### ending process
         update_process_bar(self.process_bar, 100, self.process_status,
@@ -831,71 +833,17 @@ class CloudMaskingResult(object):
         ########################################
         # clipping the QA Mask (only if is activated selected area or shape area)
         self.qaband_clip_file = os.path.join(self.tmp_dir, "qaband_clip.tif")
-        self.qaband_for_process = self.clip(qabandc2_file, self.qaband_clip_file)
+        self.qaband_for_process = self.clip_filter_input(qabandc2_file, self.qaband_clip_file)
 
         ########################################
-        # convert selected items to binary and decimal values
-        values_combinations = []
-        # bits not used or not fill
-        static_bits = [0, 6]
-
-        # generate the values combinations for one bit items selected
-        qaband_items_1b = {"Dilated Cloud (bit 1)": [1], "Cirrus (bit 2)": [2], "Cloud (bit 3)": [3],
-                           "Cloud Shadow (bit 4)": [4], "Snow (bit 5)": [5], "Water (bit 7)": [7]}
-
-        for item, bits in qaband_items_1b.items():
-            binary = [0]*16
-            if checked_items[item]:
-                binary[(len(binary) - 1) - bits[0]] = 1
-                values_combinations += list(binary_combination(binary, static_bits + bits))
-
-        # generate the values combinations for two bits items selected
-        qaband_items_2b = {"Cloud Confidence (bits 8-9)": [8, 9]}
-        levels = {"Low": [0, 1], "Medium": [1, 0], "High": [1, 1]}
-        for item, bits in qaband_items_2b.items():
-            if item in checked_items.keys():
-                for level in checked_items[item]:
-                    binary = [0] * 16
-                    binary[bits[0]:bits[1]+1] = (levels[level])[::-1]
-                    binary.reverse()
-                    values_combinations += list(binary_combination(binary, static_bits + bits))
-
-        # generate the values combinations for two bits items selected
-        qaband_items_2b = {"Cloud Shadow Confidence (bits 10-11)": [10, 11], "Snow/Ice Confidence (bits 12-13)": [12, 13], "Cirrus Confidence (bits 14-15)": [14, 15]}
-        levels = {"Low": [0, 1], "High": [1, 1]}
-        for item, bits in qaband_items_2b.items():
-            if item in checked_items.keys():
-                for level in checked_items[item]:
-                    binary = [0] * 16
-                    binary[bits[0]:bits[1]+1] = (levels[level])[::-1]
-                    binary.reverse()
-                    values_combinations += list(binary_combination(binary, static_bits + bits))
-
-        # add the specific values
-        if specific_values:
-            values_combinations += specific_values
-
-        # delete duplicates
-        values_combinations = list(set(values_combinations))
-
-        # only left the values inside the image
-        values_combinations = check_values_in_image(self.qaband_for_process, values_combinations)
-
-        filter_values = ",".join(["A==" + str(x) for x in values_combinations])
-        not_filter_values = ",".join(["A!=" + str(x) for x in values_combinations])
+        # convert selected items to the lookup table of the QA values to mask
+        qa_lut = qa_bits.compile_checked_items(qa_bits.QABAND_C2, checked_items, specific_values)
+        # the selected values get the filter code, the other values and the nodata are valid (1)
+        codes_lut = qa_bits.lut_to_codes(qa_lut, 10, get_nodata_value_from_file(self.qaband_for_process))
 
         ########################################
         # do QA Mask filter
-        tmp_pqa_file = os.path.join(self.tmp_dir, "qaband.tif")
-        gdal_calc.Calc(calc="1*(numpy.all([{nfv}], axis=0)) + 10*(numpy.any([{fv}], axis=0))".format(fv=filter_values, nfv=not_filter_values),
-                       A=self.qaband_for_process, outfile=tmp_pqa_file, type="Byte", NoDataValue=1)
-        # unset the nodata, leave the 1 (valid fields)
-        gdal.Translate(self.qaband, tmp_pqa_file, noData="none")
-        # delete tmp files
-        os.remove(tmp_pqa_file)
-
-        # save final result of masking
-        self.cloud_masking_files.append(self.qaband)
+        self.do_qa_mask(self.qaband_for_process, self.qaband, codes_lut)
 
         ### ending process
         update_process_bar(self.process_bar, 100, self.process_status,
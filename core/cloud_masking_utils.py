@@ -74,3 +74,66 @@ def mtl2dict(filename, to_float=True):
             mtl["FILE_NAME_BAND_6"] = mtl["FILE_NAME_BAND_6_VCID_1"]
 
     return mtl
+
+
+def normalize_mtl(mtl):
+    """ Set the default and normalized metadata of the MTL for old formats
+    (old Landsat 4 and 5, collection 1)
+    """
+    if 'COLLECTION_NUMBER' not in mtl:
+        mtl['COLLECTION_NUMBER'] = 1
+    if 'PROCESSING_LEVEL' not in mtl:
+        mtl['PROCESSING_LEVEL'] = "L1"
+    # normalize metadata for old MLT format (old Landsat 4 and 5)
+    if 'BAND1_FILE_NAME' in mtl:
+        for N in [1, 2, 3, 4, 5, 7, 6]:
+            mtl['FILE_NAME_BAND_' + str(N)] = mtl['BAND' + str(N) + '_FILE_NAME']
+    if 'METADATA_L1_FILE_NAME' in mtl:
+        mtl['LANDSAT_SCENE_ID'] = mtl['METADATA_L1_FILE_NAME'].split('_MTL.txt')[0]
+
+    return mtl
+
+
+def get_prefer_name(file_path):
+    """Search the prefer name for band: band1 > B1"""
+    path_dir, band_file = os.path.split(file_path)
+    # prefer thermal b61/2 over band61/2 over B6_VCID_1/2 in Landsat 7
+    if band_file.startswith("LE7") or band_file.startswith("LE07"):
+        file_bandN = band_file.replace("_B6_VCID_", "_b6").replace(".TIF", ".tif")
+        if os.path.isfile(os.path.join(path_dir, file_bandN)):
+            return os.path.join(path_dir, file_bandN)
+        file_bandN = band_file.replace("_B6_VCID_", "_band6").replace(".TIF", ".tif")
+        if os.path.isfile(os.path.join(path_dir, file_bandN)):
+            return os.path.join(path_dir, file_bandN)
+    # prefer bN over bandN over BN (i.e. band1.tif over B1.TIF)
+    file_bandN = band_file.replace("_B", "_b").replace(".TIF", ".tif")
+    if os.path.isfile(os.path.join(path_dir, file_bandN)):
+        return os.path.join(path_dir, file_bandN)
+    file_bandN = band_file.replace("_B", "_band").replace(".TIF", ".tif")
+    if os.path.isfile(os.path.join(path_dir, file_bandN)):
+        return os.path.join(path_dir, file_bandN)
+    # return original
+    return file_path
+
+
+def binary_combination(binary, fix_bits=None):
+    """
+    Binary combination with fixed bit. For complete combination let
+    fix_bits as []
+
+    Example:
+        input: binary=[0,1,1,0], fix_bits=[0,1]
+        output: [0,0,1,0], [0,1,1,0], [1,0,1,0], [1,1,1,0] -> [2,6,10,14]
+    """
+    if fix_bits is None:
+        fix_bits = []
+
+    n = len(binary)
+    fix_bits = [n-x-1 for x in fix_bits]
+    for i in range(1 << n):
+        s = bin(i)[2:]
+        s = '0'*(n-len(s))+s
+        bit_string = list(map(int, list(s)))
+        if all([bit_string[fb] == int(binary[fb]) for fb in fix_bits]):
+            bit_string = [str(x) for x in bit_string]
+            yield int("".join(bit_string), 2)
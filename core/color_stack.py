@@ -25,7 +25,7 @@ from qgis.core import QgsProject, QgsRasterLayer
 
 # from plugins
 from CloudMasking.core.utils import get_prefer_name
-from CloudMasking.libs import gdal_merge
+from CloudMasking.core.raster_ops import build_stack
 
 
 class ColorStack(object):
@@ -62,14 +62,13 @@ class ColorStack(object):
                 os.path.join(self.input_dir, self.mtl_file['FILE_NAME_BAND_SR_' + str(N)])
                 for N in bands]
 
-    def do_color_stack(self):
+    def do_color_stack(self, materialize=False):
 
-        # tmp file for color bands stack
+        # tmp file for color bands stack, a virtual raster (VRT) unless it is materialized
         self.color_stack_file = os.path.join(self.tmp_dir, self.base_name + "_" +
                                              self.mtl_file['LANDSAT_SCENE_ID'] + ".tif")
 
-        gdal_merge.main(["", "-separate", "-of", "GTiff", "-o",
-                         self.color_stack_file] + self.color_bands)
+        self.color_stack_file = build_stack(self.color_bands, self.color_stack_file, materialize=materialize)
 
     def load_color_stack(self):
         """Add to QGIS the color stack file
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ Compositor
+                                 A QGIS plugin
+ Cloud masking for landsat products using different process suck as fmask
+                             -------------------
+        copyright            : (C) 2016-2022 by Xavier Corredor Llano, SMByC
+        email                : xcorredorl@ideam.gov.co
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 3 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import uuid
+
+import numpy
+from osgeo import gdal, gdal_array
+
+# from plugins
+from CloudMasking.core.raster_utils import HISTOGRAM_SIZE, is_histogram_type, save_histogram
+
+# rows of each block processed
+BLOCK_ROWS = 256
+# value for nodata in the final mask
+NODATA = 255
+# tolerance, relative to the pixel size of the base file, to take the pixel size
+# of the files as the same
+PIXEL_SIZE_TOLERANCE = 1e-6
+
+
+class MaskWindow(object):
+    """Raster file aligned to the grid of the base file, it could cover only
+    a part of the base file (e.g. clipped with a shape). The blocks are read
+    into a preallocated buffer with the data type of the file
+    """
+
+    def __init__(self, raster_file, base_geotransform, block_shape):
+        self.ds = gdal.Open(raster_file, gdal.GA_ReadOnly)
+        self.band = self.ds.GetRasterBand(1)
+        geotransform = self.ds.GetGeoTransform()
+        # the offsets are only valid in the same pixel size (and rotation)
+        if not numpy.allclose([geotransform[i] for i in (1, 2, 4, 5)],
+                              [base_geotransform[i] for i in (1, 2, 4, 5)],
+                              rtol=0, atol=PIXEL_SIZE_TOLERANCE * abs(base_geotransform[1])):
+            raise ValueError("The pixel size of the file {} ({}, {}) is not the same as the base file ({}, {})".format(
+                raster_file, geotransform[1], geotransform[5], base_geotransform[1], base_geotransform[5]))
+        # offset of the raster in pixels of the base grid
+        self.xoff = int(round((geotransform[0] - base_geotransform[0]) / base_geotransform[1]))
+        self.yoff = int(round((geotransform[3] - base_geotransform[3]) / base_geotransform[5]))
+        self.x_size = self.ds.RasterXSize
+        self.y_size = self.ds.RasterYSize
+        self.buffer = numpy.empty(block_shape, dtype=gdal_array.GDALTypeCodeToNumericTypeCode(self.band.DataType))
+        # values histogram of the pixels read of the raster, if it is computed
+        self.histogram = None
+        self.histogram_pixels = 0
+
+    def compute_histogram(self):
+        """Compute the values histogram of the raster while its blocks are read"""
+        if is_histogram_type(self.buffer):
+            self.histogram = numpy.zeros(HISTOGRAM_SIZE, dtype=numpy.int64)
+
+    def histogram_complete(self):
+        """All the pixels of the raster were read for the histogram"""
+        return self.histogram is not None and self.histogram_pixels == self.x_size * self.y_size
+
+    def add_to_histogram(self, values):
+        if self.histogram is not None:
+            self.histogram += numpy.bincount(values.ravel(), minlength=HISTOGRAM_SIZE)
+            self.histogram_pixels += values.size
+
+    def read(self, yoff, rows, fill_value=1):
+        """Read the rows from yoff of the base grid, the area not covered by
+        the raster is filled with fill_value"""
+        buffer = self.buffer[:rows]
+        cols = buffer.shape[1]
+        # intersection of the block with the raster in the base grid
+        x0, x1 = max(self.xoff, 0), min(self.xoff + self.x_size, cols)
+        y0, y1 = max(self.yoff, yoff), min(self.yoff + self.y_size, yoff + rows)
+
+        if x0 == 0 and x1 == cols and y0 == yoff and y1 == yoff + rows:
+            self.band.ReadAsArray(x0 - self.xoff, y0 - self.yoff, cols, rows, buf_obj=buffer)
+            self.add_to_histogram(buffer)
+            return buffer
+
+        buffer.fill(fill_value)
+        if x0 < x1 and y0 < y1:
+            buffer[y0 - yoff:y1 - yoff, x0:x1] = \
+                self.band.ReadAsArray(x0 - self.xoff, y0 - self.yoff, x1 - x0, y1 - y0)
+            self.add_to_histogram(buffer[y0 - yoff:y1 - yoff, x0:x1])
+        return buffer
+
+    def close(self):
+        self.band = None
+        self.ds = None
+
+
+def rasterize_cutline(cutline_file, base_ds):
+    """Rasterize the shapes of the cutline file (inside=1) in the grid of the base
+    file, as gdalwarp with cutline only the pixels with its center inside
+    the shapes are burned. Return the in-memory file"""
+    cutline_raster = "/vsimem/cutline_{}.tif".format(uuid.uuid4().hex)
+    cutline_ds = gdal.GetDriverByName("GTiff").Create(cutline_raster, base_ds.RasterXSize, base_ds.RasterYSize,
+                                                      1, gdal.GDT_Byte, ["COMPRESS=DEFLATE", "TILED=YES"])
+    cutline_ds.SetGeoTransform(base_ds.GetGeoTransform())
+    cutline_ds.SetProjection(base_ds.GetProjection())
+    gdal.Rasterize(cutline_ds, cutline_file, burnValues=[1])
+    cutline_ds.FlushCache()
+    del cutline_ds
+    return cutline_raster
+
+
+def composite_masks(masks, out_file, base_file, cutline_file=None, keep_outside_cutline=False, histogram_files=()):
+    """
+    Blend the masks of the filters in only one pass block by block over the
+    grid of the base file (the band 1 of the scene). Each mask is a mask file
+    or a (source file, block function) item, the block function evaluates the
+    filter codes over the block of the source file in memory (fused filters),
+    each file is read once by block even if it is used by several filters.
+    The files could cover only part of the base grid (clipped). For each pixel:
+
+    - the first mask in the list with a value different to 1 wins, else 1
+    - without cutline or cropping to the cutline: the pixels with 0 in the base
+      file or in the blended mask are nodata (255)
+    - with cutline: the pixels outside the shapes of the cutline are nodata
+      (255) or, with keep_outside_cutline, valid data (1); in the last case
+      the pixels inside with 0 in the blended mask are valid data too
+
+    The values histogram of the files in histogram_files is computed in the
+    same pass and cached, if the base grid covers the whole file.
+    """
+    base_ds = gdal.Open(base_file, gdal.GA_ReadOnly)
+    x_size, y_size = base_ds.RasterXSize, base_ds.RasterYSize
+    base_geotransform = base_ds.GetGeoTransform()
+    block_rows = min(BLOCK_ROWS, y_size)
+    block_shape = (block_rows, x_size)
+
+    # the files to read by block and the filters over them
+    windows = {}
+    filters = []
+    for mask in masks:
+        mask_file, block_function = mask if isinstance(mask, tuple) else (mask, None)
+        if mask_file not in windows:
+            windows[mask_file] = MaskWindow(mask_file, base_geotransform, block_shape)
+        filters.append((mask_file, block_function))
+    for histogram_file in histogram_files:
+        if histogram_file in windows:
+            windows[histogram_file].compute_histogram()
+    if cutline_file is None or not keep_outside_cutline:
+        if base_file not in windows:
+            windows[base_file] = MaskWindow(base_file, base_geotransform, block_shape)
+
+    cutline_raster = None
+    if cutline_file:
+        cutline_raster = rasterize_cutline(cutline_file, base_ds)
+        windows[cutline_raster] = MaskWindow(cutline_raster, base_geotransform, block_shape)
+
+    out_ds = gdal.GetDriverByName("GTiff").Create(out_file, x_size, y_size, 1, gdal.GDT_Byte)
+    out_ds.SetGeoTransform(base_geotransform)
+    out_ds.SetProjection(base_ds.GetProjection())
+    out_band = out_ds.GetRasterBand(1)
+
+    # preallocated buffers
+    out_buffer = numpy.empty(block_shape, dtype=numpy.uint8)
+    undecided_buffer = numpy.empty(block_shape, dtype=bool)
+    selected_buffer = numpy.empty(block_shape, dtype=bool)
+
+    for yoff in range(0, y_size, block_rows):
+        rows = min(block_rows, y_size - yoff)
+        out = out_buffer[:rows]
+        undecided = undecided_buffer[:rows]
+        selected = selected_buffer[:rows]
+
+        blocks = {raster_file: window.read(yoff, rows) for raster_file, window in windows.items()}
+
+        ########################################
+        # blend: the first value different to 1 wins
+        out.fill(1)
+        undecided.fill(True)
+        for mask_file, block_function in filters:
+            values = blocks[mask_file]
+            if block_function is not None:
+                values = block_function(values)
+            numpy.not_equal(values, 1, out=selected)
+            numpy.logical_and(selected, undecided, out=selected)
+            numpy.copyto(out, values, where=selected, casting="unsafe")
+            numpy.logical_xor(undecided, selected, out=undecided)
+
+        ########################################
+        # nodata, outside the cutline
+        inside = blocks[cutline_raster].astype(bool) if cutline_raster else None
+
+        if cutline_raster and keep_outside_cutline:
+            out[out == 0] = 1
+            out[~inside] = 1
+        else:
+            out[(blocks[base_file] == 0) | (out == 0)] = NODATA
+            if inside is not None:
+                out[~inside] = NODATA
+
+        out_band.WriteArray(out, 0, yoff)
+
+    out_band.FlushCache()
+    del out_band, out_ds
+    for raster_file, window in windows.items():
+        if window.histogram_complete():
+            save_histogram(raster_file, window.histogram)
+        window.close()
+    if cutline_raster:
+        gdal.Unlink(cutline_raster)
+    del base_ds
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ QA Bits
+                                 A QGIS plugin
+ Cloud masking for landsat products using different process suck as fmask
+                             -------------------
+        copyright            : (C) 2016-2022 by Xavier Corredor Llano, SMByC
+        email                : xcorredorl@ideam.gov.co
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 3 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import numpy
+
+# size of the lookup table for all QA values (8 and 16 bits QA files)
+LUT_SIZE = 1 << 16
+
+########################################
+# levels for two bits items, [bit high, bit low]
+
+CONFIDENCE_LEVELS = {"0% None": [0, 0], "0-33% Low": [0, 1],
+                     "34-66% Medium": [1, 0], "67-100% High": [1, 1]}
+
+SATURATION_LEVELS = {"No bands saturated": [0, 0], "1 to 2 bands saturated": [0, 1],
+                     "3 to 4 bands saturated": [1, 0], "> 4 bands saturated": [1, 1]}
+
+AEROSOL_LEVELS = {"Climatology content": [0, 0], "Low content": [0, 1],
+                  "Average content": [1, 0], "High content": [1, 1]}
+
+C2_CLOUD_CONFIDENCE_LEVELS = {"Low": [0, 1], "Medium": [1, 0], "High": [1, 1]}
+
+C2_CONFIDENCE_LEVELS = {"Low": [0, 1], "High": [1, 1]}
+
+########################################
+# bit fields of the QA files: the bits not used or not fill (static bits) that
+# must be 0, the one bit items and the two bits items with its levels
+
+CLOUD_QA_L457 = {
+    "n_bits": 8,
+    "static_bits": [6, 7],
+    "items_1b": {"Dark Dense Vegetation (bit 0)": [0], "Cloud (bit 1)": [1], "Cloud Shadow (bit 2)": [2],
+                 "Adjacent to cloud (bit 3)": [3], "Snow (bit 4)": [4], "Water (bit 5)": [5]},
+    "items_2b": {},
+}
+
+AEROSOL_L89 = {
+    "n_bits": 8,
+    "static_bits": [0, 4, 5],
+    "items_1b": {"Aerosol Retrieval - Valid (bit 1)": [1], "Aerosol Retrieval - Interpolated (bit 2)": [2],
+                 "Water Pixel (bit 3)": [3]},
+    "items_2b": {"Aerosol Content (bits 6-7)": ([6, 7], AEROSOL_LEVELS)},
+}
+
+PIXEL_QA_L457 = {
+    "n_bits": 16,
+    "static_bits": [0, 1, 8, 9, 10, 11, 12, 13, 14, 15],
+    "items_1b": {"Water (bit 2)": [2], "Cloud Shadow (bit 3)": [3], "Snow (bit 4)": [4], "Cloud (bit 5)": [5]},
+    "items_2b": {"Cloud Confidence (bits 6-7)": ([6, 7], CONFIDENCE_LEVELS)},
+}
+
+PIXEL_QA_L89 = {
+    "n_bits": 16,
+    "static_bits": [0, 1, 11, 12, 13, 14, 15],
+    "items_1b": {"Water (bit 2)": [2], "Cloud Shadow (bit 3)": [3], "Snow (bit 4)": [4], "Cloud (bit 5)": [5],
+                 "Terrain Occlusion (bit 10)": [10]},
+    "items_2b": {"Cloud Confidence (bits 6-7)": ([6, 7], CONFIDENCE_LEVELS),
+                 "Cirrus Confidence (bits 8-9)": ([8, 9], CONFIDENCE_LEVELS)},
+}
+
+QABAND_C1_L457 = {
+    "n_bits": 16,
+    "static_bits": [0, 11, 12, 13, 14, 15],
+    "items_1b": {"Dropped Pixel (bit 1)": [1], "Cloud (bit 4)": [4]},
+    "items_2b": {"Radiometric Saturation (bits 2-3)": ([2, 3], SATURATION_LEVELS),
+                 "Cloud Confidence (bits 5-6)": ([5, 6], CONFIDENCE_LEVELS),
+                 "Cloud Shadow (bits 7-8)": ([7, 8], CONFIDENCE_LEVELS),
+                 "Snow/Ice (bits 9-10)": ([9, 10], CONFIDENCE_LEVELS)},
+}
+
+QABAND_C1_L89 = {
+    "n_bits": 16,
+    "static_bits": [0, 13, 14, 15],
+    "items_1b": {"Terrain Occlusion (bit 1)": [1], "Cloud (bit 4)": [4]},
+    "items_2b": {"Radiometric Saturation (bits 2-3)": ([2, 3], SATURATION_LEVELS),
+                 "Cloud Confidence (bits 5-6)": ([5, 6], CONFIDENCE_LEVELS),
+                 "Cloud Shadow (bits 7-8)": ([7, 8], CONFIDENCE_LEVELS),
+                 "Snow/Ice (bits 9-10)": ([9, 10], CONFIDENCE_LEVELS),
+                 "Cirrus Confidence (bits 11-12)": ([11, 12], CONFIDENCE_LEVELS)},
+}
+
+QABAND_C2 = {
+    "n_bits": 16,
+    "static_bits": [0, 6],
+    "items_1b": {"Dilated Cloud (bit 1)": [1], "Cirrus (bit 2)": [2], "Cloud (bit 3)": [3],
+                 "Cloud Shadow (bit 4)": [4], "Snow (bit 5)": [5], "Water (bit 7)": [7]},
+    "items_2b": {"Cloud Confidence (bits 8-9)": ([8, 9], C2_CLOUD_CONFIDENCE_LEVELS),
+                 "Cloud Shadow Confidence (bits 10-11)": ([10, 11], C2_CONFIDENCE_LEVELS),
+                 "Snow/Ice Confidence (bits 12-13)": ([12, 13], C2_CONFIDENCE_LEVELS),
+                 "Cirrus Confidence (bits 14-15)": ([14, 15], C2_CONFIDENCE_LEVELS)},
+}
+
+
+def bits_mask(bits):
+    """Integer with the bits in 1"""
+    mask = 0
+    for bit in bits:
+        mask |= 1 << bit
+    return mask
+
+
+def get_predicates(qa_bits, checked_items):
+    """
+    Compile the checked items (as the items selected in the plugin) to a list
+    of (mask, pattern) predicates, a QA value A is selected if any of the
+    predicates is true for (A & mask) == pattern
+
+    The static bits and the bits above the size of the QA (8 bits QA) must
+    be 0, the other bits not fixed by the item can be any value
+    """
+    fixed_mask = bits_mask(qa_bits["static_bits"]) | ((LUT_SIZE - 1) & ~((1 << qa_bits["n_bits"]) - 1))
+    predicates = []
+
+    # one bit items selected
+    for item, bits in qa_bits["items_1b"].items():
+        if checked_items.get(item):
+            predicates.append((fixed_mask | bits_mask(bits), 1 << bits[0]))
+
+    # two bits items selected
+    for item, (bits, levels) in qa_bits["items_2b"].items():
+        for level in checked_items.get(item) or []:
+            value = int("".join(str(b) for b in levels[level]), 2)
+            predicates.append((fixed_mask | bits_mask(bits), value << bits[0]))
+
+    return predicates
+
+
+def compile_checked_items(qa_bits, checked_items, specific_values=None):
+    """
+    Compile the checked items and the specific values to a boolean lookup
+    table for all QA values, True for the values to mask
+    """
+    values = numpy.arange(LUT_SIZE, dtype=numpy.uint32)
+    lut = numpy.zeros(LUT_SIZE, dtype=bool)
+
+    for mask, pattern in get_predicates(qa_bits, checked_items):
+        lut |= (values & mask) == pattern
+
+    # add the specific values
+    for value in specific_values or []:
+        if 0 <= value < LUT_SIZE:
+            lut[value] = True
+
+    return lut
+
+
+def lut_to_codes(lut, code, nodata=None):
+    """
+    Convert the boolean lookup table to the lookup table of the filter
+    output, the code for the masked values and 1 (valid) otherwise, the
+    nodata value of the QA file is valid too
+    """
+    codes_lut = numpy.where(lut, code, 1).astype(numpy.uint8)
+    if nodata is not None and 0 <= nodata < LUT_SIZE and nodata == int(nodata):
+        codes_lut[int(nodata)] = 1
+    return codes_lut
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ Raster Ops
+                                 A QGIS plugin
+ Cloud masking for landsat products using different process suck as fmask
+                             -------------------
+        copyright            : (C) 2016-2022 by Xavier Corredor Llano, SMByC
+        email                : xcorredorl@ideam.gov.co
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 3 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import math
+import os
+
+from osgeo import gdal
+
+# from plugins
+from CloudMasking.libs import gdal_calc
+
+# warp options already built, by (cutline file, nodata, crop to cutline)
+_warp_options = {}
+
+
+def unset_nodata(img_path):
+    """Unset the nodata value of all bands of the file, in place (as gdal_edit -unsetnodata)"""
+    ds = gdal.Open(img_path, gdal.GA_Update)
+    if ds is None:
+        raise IOError("Cannot open the file to unset the nodata: {}\n{}".format(img_path, gdal.GetLastErrorMsg()))
+
+    for band_number in range(1, ds.RasterCount + 1):
+        band = ds.GetRasterBand(band_number)
+        if band.GetNoDataValue() is not None and band.DeleteNoDataValue() != gdal.CE_None:
+            raise RuntimeError("Cannot unset the nodata of the file: {}\n{}".format(img_path, gdal.GetLastErrorMsg()))
+        band = None
+    ds.FlushCache()
+    del ds
+
+
+def calc(calc, outfile, out_type=None, creation_options=None, nodata=None, all_bands='', **input_files):
+    """
+    Raster calculator with the gdal_calc lib in the same process (as
+    gdal_calc.py --quiet --overwrite), the errors are raised as exceptions
+    """
+    gdal_calc.Calc(calc=calc, outfile=outfile, NoDataValue=nodata, type=out_type,
+                   creation_options=creation_options or [], allBands=all_bands, overwrite=True, quiet=True,
+                   **input_files)
+    if not os.path.isfile(outfile):
+        raise RuntimeError("Error in the raster calculation '{}': {}".format(calc, gdal.GetLastErrorMsg()))
+
+
+def get_warp_options(cutline_file, nodata, crop_to_cutline=False):
+    """Warp options for clip with the cutline using all CPUs, reused by cutline, nodata and crop"""
+    key = (cutline_file, nodata, crop_to_cutline)
+    if key not in _warp_options:
+        _warp_options[key] = gdal.WarpOptions(cutlineDSName=cutline_file, cropToCutline=crop_to_cutline,
+                                              dstNodata=nodata, multithread=True,
+                                              warpOptions=["NUM_THREADS=ALL_CPUS"])
+    return _warp_options[key]
+
+
+def clip_with_cutline(in_file, out_file, cutline_file, nodata=0, crop_to_cutline=False):
+    """Clip the file with the shapes of the cutline file (as gdalwarp -cutline)"""
+    ignore_bad_cutline = gdal.GetConfigOption("GDALWARP_IGNORE_BAD_CUTLINE")
+    gdal.SetConfigOption("GDALWARP_IGNORE_BAD_CUTLINE", "YES")
+    try:
+        ds = gdal.Warp(out_file, in_file, options=get_warp_options(cutline_file, nodata, crop_to_cutline))
+    finally:
+        gdal.SetConfigOption("GDALWARP_IGNORE_BAD_CUTLINE", ignore_bad_cutline)
+
+    if ds is None:
+        raise RuntimeError("Error clipping the file {} with the shape {}\n{}".format(
+            in_file, cutline_file, gdal.GetLastErrorMsg()))
+    ds.FlushCache()
+    del ds
+
+
+def build_stack(band_files, out_file, materialize=False, out_type=None):
+    """
+    Stack the band files, one band by file (as gdal_merge -separate), as a
+    virtual raster (VRT) referencing the original band files without copy
+    them, the out_file extension is set to .vrt. With materialize the stack
+    is written to a GeoTIFF file. Return the stack file
+    """
+    vrt_options = gdal.BuildVRTOptions(separate=True, outputType=gdal.GetDataTypeByName(out_type)) \
+        if out_type else gdal.BuildVRTOptions(separate=True)
+
+    if not materialize:
+        stack_file = os.path.splitext(out_file)[0] + ".vrt"
+        ds = gdal.BuildVRT(stack_file, band_files, options=vrt_options)
+        if ds is None:
+            raise RuntimeError("Error making the stack {}\n{}".format(stack_file, gdal.GetLastErrorMsg()))
+        ds.FlushCache()
+        del ds
+        return stack_file
+
+    vrt_file = "/vsimem/{}.vrt".format(os.path.splitext(os.path.basename(out_file))[0])
+    vrt_ds = gdal.BuildVRT(vrt_file, band_files, options=vrt_options)
+    if vrt_ds is None:
+        raise RuntimeError("Error making the stack {}\n{}".format(out_file, gdal.GetLastErrorMsg()))
+    ds = gdal.Translate(out_file, vrt_ds, format="GTiff")
+    del vrt_ds
+    gdal.Unlink(vrt_file)
+    if ds is None:
+        raise RuntimeError("Error making the stack {}\n{}".format(out_file, gdal.GetLastErrorMsg()))
+    ds.FlushCache()
+    del ds
+    return out_file
+
+
+def decimate(in_file, out_file, factor):
+    """
+    Decimate the file by the factor (e.g. 4 for 1/4 of the resolution) as a
+    virtual raster (VRT) read with the nearest neighbour, using the overviews
+    of the file if any, the out_file extension is set to .vrt. Return the
+    decimated file
+    """
+    ds = gdal.Open(in_file)
+    if ds is None:
+        raise IOError("Cannot open the file to decimate: {}\n{}".format(in_file, gdal.GetLastErrorMsg()))
+    width = max(1, int(math.ceil(ds.RasterXSize / factor)))
+    height = max(1, int(math.ceil(ds.RasterYSize / factor)))
+    del ds
+
+    decimated_file = os.path.splitext(out_file)[0] + ".vrt"
+    ds = gdal.Translate(decimated_file, in_file, format="VRT", width=width, height=height, resampleAlg="nearest")
+    if ds is None:
+        raise RuntimeError("Error decimating the file {}\n{}".format(in_file, gdal.GetLastErrorMsg()))
+    ds.FlushCache()
+    del ds
+    return decimated_file
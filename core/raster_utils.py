@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ RasterUtils
+                                 A QGIS plugin
+ Cloud masking for landsat products using different process suck as fmask
+                             -------------------
+        copyright            : (C) 2016-2022 by Xavier Corredor Llano, SMByC
+        email                : xcorredorl@ideam.gov.co
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 3 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import hashlib
+import os
+import tempfile
+
+import numpy
+from osgeo import gdal
+
+# sidecar cache of the values histogram of the files, only the most recently
+# used files are kept (each file is 512 KB)
+HISTOGRAM_CACHE_DIR = os.path.join(tempfile.gettempdir(), "CloudMasking", "histograms")
+HISTOGRAM_CACHE_MAX_FILES = 64
+# size of the values histogram (uint8 and uint16 files)
+HISTOGRAM_SIZE = 1 << 16
+
+# histograms cached in memory by key
+_histograms = {}
+
+
+def _histogram_key(img, band=1):
+    """Key of the histogram of the file by its path, size and modification time"""
+    stat = os.stat(img)
+    key = "{}|{}|{}|{}".format(os.path.realpath(img), stat.st_size, stat.st_mtime_ns, band)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def get_cached_histogram(img, band=1):
+    """
+    Return the values histogram of the file if it was already computed and
+    the file has not changed, from memory or the sidecar cache, else None
+    """
+    key = _histogram_key(img, band)
+    if key in _histograms:
+        return _histograms[key]
+
+    histogram_file = os.path.join(HISTOGRAM_CACHE_DIR, key + ".npy")
+    if os.path.isfile(histogram_file):
+        try:
+            histogram = numpy.load(histogram_file)
+        except (IOError, ValueError):
+            return None
+        # mark it as recently used for the eviction
+        try:
+            os.utime(histogram_file)
+        except OSError:
+            pass
+        _histograms[key] = histogram
+        return histogram
+
+
+def save_histogram(img, histogram, band=1):
+    """Save the values histogram of the file in memory and in the sidecar cache"""
+    key = _histogram_key(img, band)
+    _histograms[key] = histogram
+
+    os.makedirs(HISTOGRAM_CACHE_DIR, exist_ok=True)
+    histogram_file = os.path.join(HISTOGRAM_CACHE_DIR, key + ".npy")
+    # write and move, other process could be reading the same file
+    tmp_fd, tmp_file = tempfile.mkstemp(suffix=".npy.tmp", dir=HISTOGRAM_CACHE_DIR)
+    with os.fdopen(tmp_fd, "wb") as f:
+        numpy.save(f, histogram)
+    os.replace(tmp_file, histogram_file)
+    evict_histograms()
+
+
+def evict_histograms(max_files=None):
+    """
+    Delete the least recently used files of the sidecar cache of histograms
+    until only max_files are kept, the files of modified or deleted inputs
+    (e.g. the clip files rewritten each run) are never used again
+    """
+    max_files = HISTOGRAM_CACHE_MAX_FILES if max_files is None else max_files
+    try:
+        entries = [entry for entry in os.scandir(HISTOGRAM_CACHE_DIR)
+                   if entry.is_file() and entry.name.endswith(".npy")]
+    except OSError:
+        return
+    if len(entries) <= max_files:
+        return
+
+    def last_used(entry):
+        try:
+            return entry.stat().st_mtime_ns
+        except OSError:
+            return 0
+
+    entries.sort(key=last_used)
+    for entry in entries[:len(entries) - max_files]:
+        try:
+            os.remove(entry.path)
+        except OSError:
+            # deleted or in use by other process
+            pass
+
+
+def is_histogram_type(array):
+    """The values histogram is only for unsigned integers of 8 or 16 bits"""
+    return array.dtype in (numpy.uint8, numpy.uint16)
+
+
+def get_values_histogram(img, band=1):
+    """
+    Return the histogram of the values of the file (uint8 or uint16), the
+    count of pixels for all the 65536 values. It is computed streaming the
+    file block by block only if it is not cached
+    """
+    histogram = get_cached_histogram(img, band)
+    if histogram is not None:
+        return histogram
+
+    ds = gdal.Open(img, gdal.GA_ReadOnly)
+    ds_band = ds.GetRasterBand(band)
+    x_size, y_size = ds.RasterXSize, ds.RasterYSize
+
+    histogram = numpy.zeros(HISTOGRAM_SIZE, dtype=numpy.int64)
+    block_y_size = ds_band.GetBlockSize()[1]
+    for yoff in range(0, y_size, block_y_size):
+        block = ds_band.ReadAsArray(0, yoff, x_size, min(block_y_size, y_size - yoff))
+        if not is_histogram_type(block):
+            raise ValueError("The values histogram is only for uint8 or uint16 files: {}".format(img))
+        histogram += numpy.bincount(block.ravel(), minlength=HISTOGRAM_SIZE)
+    del ds_band, ds
+
+    save_histogram(img, histogram, band)
+    return histogram
+
+
+def check_values_in_image(img, values, band=1):
+    """
+    Return only the list values that is in the image
+    """
+    histogram = get_values_histogram(img, band)
+    values = numpy.unique(values)
+    values = values[(values >= 0) & (values < HISTOGRAM_SIZE)]
+    return values[histogram[values] > 0]
+
+
+def get_extent(img_path):
+    data = gdal.Open(img_path, gdal.GA_ReadOnly)
+    geoTransform = data.GetGeoTransform()
+    minx = geoTransform[0]
+    maxy = geoTransform[3]
+    maxx = minx + geoTransform[1] * data.RasterXSize
+    miny = maxy + geoTransform[5] * data.RasterYSize
+    del data
+
+    return [round(minx), round(maxy), round(maxx), round(miny)]
+
+
+def get_nodata_value_from_file(img_path):
+    src_ds = gdal.Open(img_path)
+    return src_ds.GetRasterBand(1).GetNoDataValue()
+
+
+def make_constant_raster(template_file, out_file, value, creation_options=None):
+    """Make a Byte file with the same size and georeference of the template with a constant value"""
+    src_ds = gdal.Open(template_file, gdal.GA_ReadOnly)
+
+    driver = gdal.GetDriverByName("GTiff")
+    out_ds = driver.Create(out_file, src_ds.RasterXSize, src_ds.RasterYSize, 1, gdal.GDT_Byte,
+                           creation_options or [])
+    out_ds.SetGeoTransform(src_ds.GetGeoTransform())
+    out_ds.SetProjection(src_ds.GetProjection())
+    out_ds.GetRasterBand(1).Fill(value)
+
+    out_ds.FlushCache()
+    del out_ds, src_ds
+
+
+def apply_lut(in_file, out_file, lut, band=1, creation_options=None, cache_histogram=False):
+    """
+    Apply the lookup table to the values of the raster file block by block
+    (full rows of the file block height), the output is a Byte file. With
+    cache_histogram the values histogram of the input file is computed in
+    the same pass (if it is not cached yet)
+    """
+    src_ds = gdal.Open(in_file, gdal.GA_ReadOnly)
+    src_band = src_ds.GetRasterBand(band)
+    x_size, y_size = src_ds.RasterXSize, src_ds.RasterYSize
+
+    driver = gdal.GetDriverByName("GTiff")
+    out_ds = driver.Create(out_file, x_size, y_size, 1, gdal.GDT_Byte, creation_options or [])
+    out_ds.SetGeoTransform(src_ds.GetGeoTransform())
+    out_ds.SetProjection(src_ds.GetProjection())
+    out_band = out_ds.GetRasterBand(1)
+
+    histogram = None
+    if cache_histogram and get_cached_histogram(in_file, band) is None:
+        histogram = numpy.zeros(HISTOGRAM_SIZE, dtype=numpy.int64)
+
+    block_y_size = src_band.GetBlockSize()[1]
+    for yoff in range(0, y_size, block_y_size):
+        win_y_size = min(block_y_size, y_size - yoff)
+        block = src_band.ReadAsArray(0, yoff, x_size, win_y_size)
+        out_band.WriteArray(numpy.take(lut, block), 0, yoff)
+        if histogram is not None:
+            if is_histogram_type(block):
+                histogram += numpy.bincount(block.ravel(), minlength=HISTOGRAM_SIZE)
+            else:
+                histogram = None
+
+    out_band.FlushCache()
+    del out_band, out_ds, src_band, src_ds
+
+    if histogram is not None:
+        save_histogram(in_file, histogram, band)
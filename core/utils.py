@@ -22,9 +22,6 @@ import functools
 import os
 import traceback
 
-from osgeo import gdal
-from numpy import intersect1d
-
 from qgis.PyQt.QtCore import Qt
 from qgis.PyQt.QtGui import QColor, QCursor
 from qgis.PyQt.QtWidgets import QApplication, QMessageBox, QPushButton
@@ -32,6 +29,10 @@ from qgis.core import QgsProject, QgsRasterShader, QgsColorRampShader, QgsSingle
     QgsRasterRange, QgsRasterLayer, QgsVectorLayer, Qgis
 from qgis.utils import iface
 
+# from plugins (QGIS independent utils, kept here for compatibility)
+from CloudMasking.core.cloud_masking_utils import get_prefer_name, binary_combination
+from CloudMasking.core.raster_utils import check_values_in_image, get_extent, get_nodata_value_from_file
+
 
 def error_handler(func):
     @functools.wraps(func)
@@ -147,28 +148,6 @@ def load_and_select_filepath_in(combo_box, file_path):
     return get_layer_by_name(filename)
 
 
-def get_prefer_name(file_path):
-    """Search the prefer name for band: band1 > B1"""
-    path_dir, band_file = os.path.split(file_path)
-    # prefer thermal b61/2 over band61/2 over B6_VCID_1/2 in Landsat 7
-    if band_file.startswith("LE7") or band_file.startswith("LE07"):
-        file_bandN = band_file.replace("_B6_VCID_", "_b6").replace(".TIF", ".tif")
-        if os.path.isfile(os.path.join(path_dir, file_bandN)):
-            return os.path.join(path_dir, file_bandN)
-        file_bandN = band_file.replace("_B6_VCID_", "_band6").replace(".TIF", ".tif")
-        if os.path.isfile(os.path.join(path_dir, file_bandN)):
-            return os.path.join(path_dir, file_bandN)
-    # prefer bN over bandN over BN (i.e. band1.tif over B1.TIF)
-    file_bandN = band_file.replace("_B", "_b").replace(".TIF", ".tif")
-    if os.path.isfile(os.path.join(path_dir, file_bandN)):
-        return os.path.join(path_dir, file_bandN)
-    file_bandN = band_file.replace("_B", "_band").replace(".TIF", ".tif")
-    if os.path.isfile(os.path.join(path_dir, file_bandN)):
-        return os.path.join(path_dir, file_bandN)
-    # return original
-    return file_path
-
-
 def apply_symbology(rlayer, symbology, symbology_enabled, transparent=255):
     """ Apply classification symbology to raster layer """
     # See: QgsRasterRenderer* QgsSingleBandPseudoColorRendererWidget::renderer()
@@ -239,53 +218,3 @@ def update_process_bar(bar_inst=None, bar=None, status_inst=None, status=None):
         # set status
         status_inst.setText(str(status))
         QApplication.processEvents()
-
-
-def binary_combination(binary, fix_bits=None):
-    """
-    Binary combination with fixed bit. For complete combination let
-    fix_bits as []
-
-    Example:
-        input: binary=[0,1,1,0], fix_bits=[0,1]
-        output: [0,0,1,0], [0,1,1,0], [1,0,1,0], [1,1,1,0] -> [2,6,10,14]
-    """
-    if fix_bits is None:
-        fix_bits = []
-
-    n = len(binary)
-    fix_bits = [n-x-1 for x in fix_bits]
-    for i in range(1 << n):
-        s = bin(i)[2:]
-        s = '0'*(n-len(s))+s
-        bit_string = list(map(int, list(s)))
-        if all([bit_string[fb] == int(binary[fb]) for fb in fix_bits]):
-            bit_string = [str(x) for x in bit_string]
-            yield int("".join(bit_string), 2)
-
-
-def check_values_in_image(img, values, band=1):
-    """
-    Return only the list values that is in the image
-    """
-    ds = gdal.Open(img)
-    raster_array = ds.GetRasterBand(band).ReadAsArray().ravel()
-    del ds
-    return intersect1d(raster_array, values)
-
-
-def get_extent(img_path):
-    data = gdal.Open(img_path, gdal.GA_ReadOnly)
-    geoTransform = data.GetGeoTransform()
-    minx = geoTransform[0]
-    maxy = geoTransform[3]
-    maxx = minx + geoTransform[1] * data.RasterXSize
-    miny = maxy + geoTransform[5] * data.RasterYSize
-    del data
-
-    return [round(minx), round(maxy), round(maxx), round(miny)]
-
-
-def get_nodata_value_from_file(img_path):
-    src_ds = gdal.Open(img_path)
-    return src_ds.GetRasterBand(1).GetNoDataValue()
@@ -318,25 +318,11 @@ class CloudMaskingDockWidget(QDockWidget, FORM_CLASS):
 
         # parse the new MTL file
         try:
-            self.mtl_file = cloud_masking_utils.mtl2dict(self.mtl_path)
+            self.mtl_file = cloud_masking_utils.normalize_mtl(cloud_masking_utils.mtl2dict(self.mtl_path))
             # get the landsat version
             self.landsat_version = int(self.mtl_file['SPACECRAFT_ID'][-1])
-            if 'COLLECTION_NUMBER' in self.mtl_file:
-                self.collection = int(self.mtl_file['COLLECTION_NUMBER'])
-            else:
-                self.collection = 1
-                self.mtl_file['COLLECTION_NUMBER'] = 1
-            if 'PROCESSING_LEVEL' in self.mtl_file:
-                self.processing_level = self.mtl_file['PROCESSING_LEVEL'][0:2]
-            else:
-                self.processing_level = "L1"
-                self.mtl_file['PROCESSING_LEVEL'] = "L1"
-            # normalize metadata for old MLT format (old Landsat 4 and 5)
-            if 'BAND1_FILE_NAME' in self.mtl_file:
-                for N in [1, 2, 3, 4, 5, 7, 6]:
-                    self.mtl_file['FILE_NAME_BAND_' + str(N)] = self.mtl_file['BAND' + str(N) + '_FILE_NAME']
-            if 'METADATA_L1_FILE_NAME' in self.mtl_file:
-                self.mtl_file['LANDSAT_SCENE_ID'] = self.mtl_file['METADATA_L1_FILE_NAME'].split('_MTL.txt')[0]
+            self.collection = int(self.mtl_file['COLLECTION_NUMBER'])
+            self.processing_level = self.mtl_file['PROCESSING_LEVEL'][0:2]
         except:
             self.status_LoadedMTL.setText(self.tr("Error: Cannot parse MTL file"))
             self.unload_MTL()
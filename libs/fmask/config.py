@@ -76,9 +76,18 @@ class FmaskConfig(object):
     keepIntermediates = False
     cloudBufferSize = 5
     shadowBufferSize = 10
+    bufferEngine = 'runs'
+    fillMinimaMemoryBudget = 2 * 1024**3
+    fillMinimaWorkers = 1
+    dedupShadowShapes = False
     verbose = False
     strictFmask = False
     tempDir = '.'
+    stageCache = None
+    shadowMatchWorkers = 1
+    shadowMatchUseProcesses = False
+    riosReadWorkers = 0
+    riosComputeWorkers = 0
     TOARefScaling = 10000.0
     TOARefDNoffsetDict = None
     # Minimum number of pixels in a single cloud (before buffering). A non-zero value
@@ -237,7 +246,48 @@ class FmaskConfig(object):
         
         """
         self.keepIntermediates = keepIntermediates
+
+    def setStageCache(self, stageCache):
+        """
+        Set an instance of :class:`fmask.fmask.FmaskStageCache` to keep the
+        results of the stages between runs, then a run only recomputes the
+        stages affected by the parameters changed since the previous run.
+        This is None by default (all the stages are computed).
+        
+        """
+        self.stageCache = stageCache
     
+    def setShadowMatchWorkers(self, numWorkers, useProcesses=False):
+        """
+        Match the cloud shadows in parallel with this many workers, in a pool of
+        threads, or of processes with useProcesses (the images are shared
+        through shared memory, requires Python 3.8 or later, else threads are
+        used). The result is the same as the serial matching. Defaults to 1
+        (serial).
+        
+        """
+        self.shadowMatchWorkers = numWorkers
+        self.shadowMatchUseProcesses = useProcesses
+    
+    def setRiosWorkers(self, numReadWorkers, numComputeWorkers):
+        """
+        Run the RIOS passes through the images with this many read workers
+        (threads reading the blocks of the inputs) and compute workers 
+        (threads processing whole blocks at once, see 
+        :func:`makeConcurrencyStyle`). Compute workers need at least one
+        read worker, which is used if numReadWorkers is 0. The result is the
+        same as without workers. Defaults to 0 and 0 (serial).
+        
+        """
+        self.riosReadWorkers = numReadWorkers
+        self.riosComputeWorkers = numComputeWorkers
+    
+    def __deepcopy__(self, memo):
+        # The config is only read during a run, so the copies of the otherargs
+        # given to the RIOS compute workers share it, with the stage cache
+        # and the angles it holds
+        return self
+
     def setCloudBufferSize(self, bufferSize):
         """
         Extra buffer of this many pixels on cloud layer. Defaults to 5.
@@ -251,6 +301,45 @@ class FmaskConfig(object):
         
         """
         self.shadowBufferSize = bufferSize
+
+    def setBufferEngine(self, engine):
+        """
+        How the cloud and shadow buffers are made, one of 'runs', 'distance'
+        or 'kernel' (see fmask.bufferMask). All give the same buffers. 
+        Defaults to 'runs'.
+        
+        """
+        self.bufferEngine = engine
+
+    def setFillMinimaMemoryBudget(self, budget):
+        """
+        Memory, in bytes, for filling the minima of the NIR band to find the
+        potential cloud shadows. Larger images are filled in tiles, which is
+        slower but gives the same result, as are images of more rows than 
+        fillminima.MAX_ROWS. None to fill the other images at once. Defaults
+        to 2 GiB.
+        
+        """
+        self.fillMinimaMemoryBudget = budget
+
+    def setFillMinimaWorkers(self, numWorkers):
+        """
+        Fill the minima of the NIR band in tiles (see setFillMinimaMemoryBudget)
+        in parallel with this many workers, in a pool of processes. The result
+        is the same as with one worker. Defaults to 1 (serial).
+        
+        """
+        self.fillMinimaWorkers = numWorkers
+
+    def setDedupShadowShapes(self, dedupShadowShapes):
+        """
+        Remove the duplicated pixels of the cloud shadow shapes when they are
+        dense in their bounding box, to keep less memory for the shapes of 
+        all the clouds, at some cost in time. The shadows are the same. 
+        Defaults to False.
+        
+        """
+        self.dedupShadowShapes = dedupShadowShapes
     
     def setMinCloudSize(self, minCloudSize):
         """
@@ -401,6 +490,46 @@ class FmaskConfig(object):
         self.gdalDriverName = driverName
 
 
+def makeConcurrencyStyle(fmaskConfig=None, computeWorkers=True):
+    """
+    Make the RIOS ConcurrencyStyle for the read and compute workers of
+    fmaskConfig (see :func:`FmaskConfig.setRiosWorkers`), for the controls
+    of a pass. The compute workers are threads, each with its own copy of
+    the otherargs, so the values accumulated on them must be summed over
+    the otherArgsList returned by applier.apply (see :func:`sumOtherArgs`).
+
+    Set computeWorkers to False for the passes which can't be split between
+    workers (e.g. a single block, or extremes kept in the otherargs), they
+    only use the read workers. With no fmaskConfig there are no workers.
+
+    """
+    numReadWorkers = 0
+    numComputeWorkers = 0
+    if fmaskConfig is not None:
+        numReadWorkers = fmaskConfig.riosReadWorkers
+        if computeWorkers:
+            numComputeWorkers = fmaskConfig.riosComputeWorkers
+
+    if numComputeWorkers > 0:
+        concurrency = applier.ConcurrencyStyle(numReadWorkers=max(numReadWorkers, 1),
+            numComputeWorkers=numComputeWorkers, computeWorkerKind=applier.CW_THREADS)
+    else:
+        concurrency = applier.ConcurrencyStyle(numReadWorkers=numReadWorkers)
+    return concurrency
+
+
+def sumOtherArgs(otherargs, rtn, *names):
+    """
+    Sum the named values accumulated by the RIOS compute workers on their
+    copies of otherargs (in rtn.otherArgsList, rtn being returned by
+    applier.apply) into otherargs. The values must start at zero.
+
+    """
+    if rtn.otherArgsList != [otherargs]:
+        for name in names:
+            setattr(otherargs, name, sum([getattr(args, name) for args in rtn.otherArgsList]))
+
+
 class FmaskFilenames(object):
     """
     Class that contains the filenames used in the fmask run.
@@ -660,6 +789,24 @@ class AnglesInfo(object):
         Set scaling factor to get radians from angles image values. 
         """
 
+    def getMeanAngles(self, valueIndexes):
+        """
+        Return the average angles for every value of the given 
+        valueindexes.ValueIndexes object, as a tuple of arrays 
+        (solarZenith, solarAzimuth, viewZenith, viewAzimuth), in the
+        order of valueIndexes.values. 
+        
+        This default queries the angles value by value, derived classes 
+        should do all the values at once. 
+        """
+        angles = ([], [], [], [])
+        for (val, indices) in valueIndexes.iterIndexes():
+            angles[0].append(self.getSolarZenithAngle(indices))
+            angles[1].append(self.getSolarAzimuthAngle(indices))
+            angles[2].append(self.getViewZenithAngle(indices))
+            angles[3].append(self.getViewAzimuthAngle(indices))
+        return tuple(numpy.array(a, dtype=numpy.float64) for a in angles)
+
 
 class AnglesFileInfo(AnglesInfo):
     """
@@ -745,6 +892,27 @@ class AnglesFileInfo(AnglesInfo):
         """
         return self.viewAzimuthData[indices].mean() * self.scaleToRadians
 
+    def getMeanAngles(self, valueIndexes):
+        """
+        Return the average angles for every value of the given 
+        valueindexes.ValueIndexes object, as a tuple of arrays 
+        (solarZenith, solarAzimuth, viewZenith, viewAzimuth). 
+        The indexes of all the values are used at once, summing the angles 
+        over the segment of each value. 
+        """
+        indices = valueIndexes.getAllIndexes()
+        start = valueIndexes.start
+        counts = valueIndexes.counts
+        angles = ()
+        for data in (self.solarZenithData, self.solarAzimuthData, 
+                self.viewZenithData, self.viewAzimuthData):
+            if len(start) > 0:
+                sums = numpy.add.reduceat(data[indices], start, dtype=numpy.float64)
+            else:
+                sums = numpy.zeros(0, dtype=numpy.float64)
+            angles += (sums / counts * self.scaleToRadians, )
+        return angles
+
     def setScaleToRadians(self, scale):
         """
         Set scaling factor to get radians from angles image values. 
@@ -788,6 +956,17 @@ class AngleConstantInfo(AnglesInfo):
         """
         return self.viewAzimuthAngle
 
+    def getMeanAngles(self, valueIndexes):
+        """
+        Return the angles for every value of the given 
+        valueindexes.ValueIndexes object, as a tuple of arrays 
+        (solarZenith, solarAzimuth, viewZenith, viewAzimuth)
+        """
+        numValues = len(valueIndexes.values)
+        return tuple(numpy.full(numValues, angle, dtype=numpy.float64) 
+            for angle in (self.solarZenithAngle, self.solarAzimuthAngle, 
+                self.viewZenithAngle, self.viewAzimuthAngle))
+
 
 def readMTLFile(mtl):
     """
@@ -29,12 +29,18 @@ represent potential shadow objects.
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
 import os
+from concurrent import futures
+
 import numpy
 from scipy.ndimage import grey_dilation
 
 # load _fillminima
 from CloudMasking.libs.fmask import _fillminima
 
+#: Largest number of rows of an image given to _fillminima, which stops the
+#: process beyond it
+MAX_ROWS = 20000
+
 
 def fillMinima(img, nullval, boundaryval):
     """
@@ -75,3 +81,221 @@ def fillMinima(img, nullval, boundaryval):
     img2[nullmask] = nullval
     
     return img2
+
+
+def fillMinimaTiled(readTile, shape, nullval, boundaryval, tileSize, numWorkers=1):
+    """
+    Fill all local minima as fillMinima, of an image of the given (nrows, ncols)
+    shape which is read by tiles with readTile(row, col, numRows, numCols), 
+    returning an int16 array. This is a generator of (row, col, img, img2) for 
+    each tile of (up to) tileSize x tileSize pixels, where img is the tile of
+    the input image and img2 the same tile of fillMinima of the whole image. 
+    
+    Each tile is filled with the ring of pixels around it holding the current
+    values of the neighbouring tiles, which start at the image maximum. The 
+    tiles are filled again, sweeping back and forth, until the values on
+    their edges do not change, then once more to return them. Only the edges 
+    are kept between the sweeps. 
+    
+    With numWorkers > 1, as many tiles are filled at once in a pool of 
+    processes (_fillminima holds the GIL, so threads would not run at the
+    same time). The tiles are read here, readTile is only called from this 
+    process. 
+    
+    """
+    (nrows, ncols) = shape
+    tiles = [(row, col, min(row + tileSize, nrows), min(col + tileSize, ncols)) 
+        for row in range(0, nrows, tileSize) for col in range(0, ncols, tileSize)]
+
+    (hMin, hMax, anyNull) = (None, None, False)
+    for (row, col, rowEnd, colEnd) in tiles:
+        img = readTile(row, col, rowEnd - row, colEnd - col)
+        nullmask = (img == nullval)
+        anyNull = anyNull or nullmask.any()
+        if not nullmask.all():
+            nonNull = img[~nullmask]
+            (tileMax, tileMin) = (int(nonNull.max()), int(nonNull.min()))
+            hMax = tileMax if hMax is None else max(hMax, tileMax)
+            hMin = tileMin if hMin is None else min(hMin, tileMin)
+    if hMax is None:
+        raise ValueError("Image has only null values")
+    boundaryval = max(boundaryval, hMin)
+    fillArgs = (readTile, shape, nullval, boundaryval, hMin, hMax, anyNull)
+
+    # The first and last rows and columns of each tile, over the whole image
+    edgeRows = {}
+    edgeCols = {}
+    for (row, col, rowEnd, colEnd) in tiles:
+        for r in (row, rowEnd - 1):
+            edgeRows[r] = numpy.full(ncols, hMax, dtype=numpy.int16)
+        for c in (col, colEnd - 1):
+            edgeCols[c] = numpy.full(nrows, hMax, dtype=numpy.int16)
+
+    executor = None
+    if numWorkers > 1:
+        executor = futures.ProcessPoolExecutor(max_workers=numWorkers)
+
+    try:
+        dirty = set(tiles)
+        forward = True
+        while len(dirty) > 0:
+            for batch in takeTiles(tiles if forward else tiles[::-1], dirty, numWorkers):
+                for (tile, (img, img2)) in zip(batch, fillTiles(batch, edgeRows, edgeCols, 
+                        executor, *fillArgs)):
+                    changed = updateEdges(tile, img2, edgeRows, edgeCols)
+                    dirty.update(other for other in tiles 
+                        if edgesChanged(tile, other, changed))
+            forward = not forward
+
+        for batch in takeTiles(tiles, set(tiles), numWorkers):
+            for (tile, (img, img2)) in zip(batch, fillTiles(batch, edgeRows, edgeCols, 
+                    executor, *fillArgs)):
+                yield (tile[0], tile[1], img, img2)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+def takeTiles(tiles, dirty, batchSize):
+    """
+    Generator of the batches of up to batchSize tiles of the list which are in 
+    the dirty set, removing them from it. The set can grow between the batches.
+    """
+    batch = []
+    for tile in tiles:
+        if tile in dirty:
+            dirty.discard(tile)
+            batch.append(tile)
+            if len(batch) == batchSize:
+                yield batch
+                batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def fillTiles(batch, edgeRows, edgeCols, executor, readTile, shape, nullval, 
+        boundaryval, hMin, hMax, anyNull):
+    """
+    Fill the local minima of a batch of tiles of fillMinimaTiled, with the 
+    executor or here if None. Returns the list of the input and the filled
+    tile of each. 
+    
+    """
+    tileArrays = [tileForFill(tile, edgeRows, edgeCols, readTile, shape, nullval, 
+        hMax, anyNull) for tile in batch]
+    fillArgs = [(img, nullmask, hMin, hMax, boundaryval, boundaryRows, boundaryCols)
+        for (img, nullmask, boundaryRows, boundaryCols) in tileArrays]
+    if executor is None:
+        filled = [fillArrays(*args) for args in fillArgs]
+    else:
+        filled = list(executor.map(fillArrays, *zip(*fillArgs)))
+
+    inner = (slice(2, -2), slice(2, -2))
+    results = []
+    for ((img, nullmask, boundaryRows, boundaryCols), img2) in zip(tileArrays, filled):
+        img2 = img2[inner]
+        img2[nullmask[inner]] = nullval
+        results.append((img[inner], img2))
+    return results
+
+
+def fillArrays(img, nullmask, hMin, hMax, boundaryval, boundaryRows, boundaryCols):
+    """
+    Fill the local minima of img from the given boundary with _fillminima, 
+    the filled image is returned
+    """
+    img2 = numpy.full(img.shape, hMax, dtype=numpy.int16)
+    _fillminima.fillMinima(img, img2, hMin, hMax, nullmask, boundaryval,
+                        boundaryRows, boundaryCols)
+    return img2
+
+
+def tileForFill(tile, edgeRows, edgeCols, readTile, shape, nullval, hMax, anyNull):
+    """
+    Read one tile of fillMinimaTiled, returns the (img, nullmask, boundaryRows,
+    boundaryCols) arguments of _fillminima to fill it. 
+    
+    The tile is filled inside two rings of pixels. The inner ring holds the
+    current values of the neighbouring pixels (null outside the image), and 
+    the outer ring is a boundary at boundaryval, from which the fill enters 
+    the inner ring at those values. 
+    
+    """
+    (nrows, ncols) = shape
+    (row, col, rowEnd, colEnd) = tile
+    (tileRows, tileCols) = (rowEnd - row, colEnd - col)
+    # The tile and its neighbouring pixels within the image
+    (winRow, winCol) = (max(row - 1, 0), max(col - 1, 0))
+    (winRowEnd, winColEnd) = (min(rowEnd + 1, nrows), min(colEnd + 1, ncols))
+    window = readTile(winRow, winCol, winRowEnd - winRow, winColEnd - winCol)
+    winNullmask = (window == nullval)
+
+    img = numpy.full((tileRows + 4, tileCols + 4), hMax, dtype=numpy.int16)
+    nullmask = numpy.ones(img.shape, dtype=bool)
+    winRows = slice(winRow - row + 2, winRowEnd - row + 2)
+    winCols = slice(winCol - col + 2, winColEnd - col + 2)
+    img[winRows, winCols] = window
+    nullmask[winRows, winCols] = winNullmask
+    if row > 0:
+        img[1, winCols] = edgeRows[row - 1][winCol:winColEnd]
+    if rowEnd < nrows:
+        img[-2, winCols] = edgeRows[rowEnd][winCol:winColEnd]
+    if col > 0:
+        img[winRows, 1] = edgeCols[col - 1][winRow:winRowEnd]
+    if colEnd < ncols:
+        img[winRows, -2] = edgeCols[colEnd][winRow:winRowEnd]
+
+    # The boundary of fillMinima within the tile
+    inner = (slice(2, -2), slice(2, -2))
+    boundary = numpy.zeros(img.shape, dtype=bool)
+    if anyNull:
+        nullmaskDilated = grey_dilation(winNullmask, size=(3, 3))
+        winBoundary = numpy.zeros(img.shape, dtype=bool)
+        winBoundary[winRows, winCols] = nullmaskDilated ^ winNullmask
+        boundary[inner] = winBoundary[inner]
+    else:
+        imgEdges = numpy.zeros((tileRows, tileCols), dtype=bool)
+        imgEdges[0, :] = (row == 0)
+        imgEdges[-1, :] |= (rowEnd == nrows)
+        imgEdges[:, 0] |= (col == 0)
+        imgEdges[:, -1] |= (colEnd == ncols)
+        boundary[inner] = imgEdges & (img[inner] != hMax)
+    boundary[[0, -1], :] = True
+    boundary[:, [0, -1]] = True
+    (boundaryRows, boundaryCols) = numpy.where(boundary)
+    return (img, nullmask, boundaryRows.astype(numpy.int64), boundaryCols.astype(numpy.int64))
+
+
+def updateEdges(tile, img2, edgeRows, edgeCols):
+    """
+    Copy the edges of the filled tile to the edgeRows and edgeCols of 
+    fillMinimaTiled. Returns the masks of where its (top, bottom, left, right)
+    edges have changed. 
+    
+    """
+    (row, col, rowEnd, colEnd) = tile
+    changed = []
+    for (edge, values) in ((edgeRows[row][col:colEnd], img2[0]), 
+            (edgeRows[rowEnd - 1][col:colEnd], img2[-1]), 
+            (edgeCols[col][row:rowEnd], img2[:, 0]), 
+            (edgeCols[colEnd - 1][row:rowEnd], img2[:, -1])):
+        changed.append(edge != values)
+        edge[...] = values
+    return changed
+
+
+def edgesChanged(tile, other, changed):
+    """
+    Return True if the pixels of the tile which are around the other tile 
+    (its neighbour, or not) have changed, given the masks from updateEdges
+    """
+    (row, col, rowEnd, colEnd) = tile
+    (otherRow, otherCol, otherRowEnd, otherColEnd) = other
+    (top, bottom, left, right) = changed
+    # The columns and rows of the tile next to the other tile
+    cols = slice(max(otherCol - 1, col) - col, max(min(otherColEnd + 1, colEnd) - col, 0))
+    rows = slice(max(otherRow - 1, row) - row, max(min(otherRowEnd + 1, rowEnd) - row, 0))
+    return ((otherRowEnd == row and top[cols].any()) or 
+        (otherRow == rowEnd and bottom[cols].any()) or
+        (otherColEnd == col and left[rows].any()) or 
+        (otherCol == colEnd and right[rows].any()))
@@ -47,11 +47,15 @@ from __future__ import print_function, division
 
 import os
 import tempfile
+import functools
+import threading
+from concurrent import futures
 
 import numpy
 from osgeo import gdal
-from scipy.ndimage import uniform_filter, maximum_filter, label
-import scipy.stats
+from scipy.ndimage import uniform_filter, maximum_filter, maximum_filter1d, label
+from scipy.ndimage import distance_transform_edt
+import scipy.ndimage
 
 # We use RIOS intensively here
 from rios import applier
@@ -70,6 +74,18 @@ from . import fmaskerrors
 # so we can check if thermal all zeroes
 from . import zerocheck
 
+# faster evaluation of the first pass expressions, if available
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+# shared memory for the process pool of the shadow matching, Python >= 3.8
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
 numpy.seterr(all='raise')
 gdal.UseExceptions()
 
@@ -78,6 +94,19 @@ SATURATION_BLUE = 0
 SATURATION_GREEN = 1
 SATURATION_RED = 2
 
+# The pass1 file has a layer of flags for the boolean results of the first
+# pass, and a layer of the variability probability (percent)
+PASS1_FLAGS_LAYER = 0
+PASS1_PROB_LAYER = 1
+#: Flags of the pass1 file
+PASS1_PCP = 1
+PASS1_WATERTEST = 2
+PASS1_CLEARLAND = 4
+PASS1_NULLMASK = 8
+PASS1_SNOWMASK = 16
+PASS1_REFNULLMASK = 32
+PASS1_THERMNULLMASK = 64
+
 # The values used in the final output raster
 #: Output pixel value for null
 OUTCODE_NULL = 0
@@ -153,72 +182,265 @@ def doFmask(fmaskFilenames, fmaskConfig):
         fmaskConfig.setCloudBufferSize(0)
         fmaskConfig.setShadowBufferSize(3)
     
+    # Run the stages of the algorithm, each stage is only computed if its
+    # result is needed and it's not in the stage cache from a previous run
+    stageCache = fmaskConfig.stageCache
+    if stageCache is None:
+        stageCache = FmaskStageCache()
+    stages = FmaskStages(stageCache, fmaskFilenames, fmaskConfig, missingThermal)
+
+    interimShadowmask = stages.get('shadowBuffer')
+
+    (pass1file, pass2file) = (stages.get('pass1')[0], stages.get('pass2')[0])
+    interimCloudmask = stages.get('cloud')
+    potentialShadowsFile = stages.get('potentialShadows')
+
+    if fmaskConfig.verbose:
+        print("Doing final tidy up")
+    finalizeAll(fmaskFilenames, fmaskConfig, interimCloudmask, interimShadowmask, 
+        pass1file)
+    
+    # Remove temporary files
+    retVal = None
+    if fmaskConfig.keepIntermediates:
+        # create a dictionary with the intermediate filenames so we can return them.
+        retVal = {'pass1': pass1file, 'pass2': pass2file, 
+            'interimCloud': interimCloudmask, 
+            'potentialShadows': potentialShadowsFile, 
+            'interimShadow': interimShadowmask}
+        if fmaskConfig.stageCache is None:
+            stageCache.discard('matchedShadows')
+    elif fmaskConfig.stageCache is None:
+        stageCache.clear()
+
+    if fmaskConfig.verbose:
+        print('finished fmask')
+    
+    return retVal
+
+
+class FmaskStageCache(object):
+    """
+    Results of the stages of :func:`doFmask` kept between runs, see
+    :func:`fmask.config.FmaskConfig.setStageCache`. Each result is kept with
+    the signature of the inputs and of the config fields it was made from (and
+    of the stages before it), so a run with other parameters only recomputes
+    the stages invalidated by them. The intermediate files of the kept results
+    are owned by this object, call :meth:`clear` to delete them.
+    
+    """
+    def __init__(self):
+        # stage name -> (signature, result, intermediate files)
+        self.results = {}
+
+    def isValid(self, name, signature):
+        """
+        Check if the kept result of the stage was made with the same signature
+        and its files still exist
+        """
+        if name not in self.results:
+            return False
+        (keptSignature, result, files) = self.results[name]
+        return keptSignature == signature and all(os.path.exists(f) for f in files)
+
+    def getResult(self, name):
+        return self.results[name][1]
+
+    def put(self, name, signature, result, files):
+        """
+        Keep the result of the stage, replacing (and deleting the files of)
+        the previous one
+        """
+        self.discard(name)
+        self.results[name] = (signature, result, files)
+
+    def discard(self, name):
+        """
+        Delete the kept result of the stage and its files
+        """
+        if name in self.results:
+            for filename in self.results.pop(name)[2]:
+                if os.path.exists(filename):
+                    deleteRaster(filename)
+
+    def clear(self):
+        """
+        Delete all the kept results and their files
+        """
+        for name in list(self.results.keys()):
+            self.discard(name)
+
+
+def stagePass1(fmaskFilenames, fmaskConfig, missingThermal):
     if fmaskConfig.verbose:
         print("Cloud layer, pass 1")
-    (pass1file, Twater, Tlow, Thigh, NIR_17, nonNullCount) = doPotentialCloudFirstPass(
-        fmaskFilenames, fmaskConfig, missingThermal)
+    result = doPotentialCloudFirstPass(fmaskFilenames, fmaskConfig, missingThermal)
+    (pass1file, Twater, Tlow, Thigh, NIR_17, nonNullCount) = result
     if fmaskConfig.verbose:
         print("  Twater=", Twater, "Tlow=", Tlow, "Thigh=", Thigh, "NIR_17=", 
             NIR_17, "nonNullCount=", nonNullCount)
-    
+    return (result, [pass1file])
+
+
+def stagePass2(fmaskFilenames, fmaskConfig, missingThermal, pass1):
     if fmaskConfig.verbose:
         print("Cloud layer, pass 2")
-    (pass2file, landThreshold) = doPotentialCloudSecondPass(fmaskFilenames, 
-        fmaskConfig, pass1file, Twater, Tlow, Thigh, missingThermal, nonNullCount)
+    (pass1file, Twater, Tlow, Thigh, NIR_17, nonNullCount) = pass1
+    (pass2file, lCloudProb_hist) = doPotentialCloudSecondPassLayer(fmaskFilenames, 
+        fmaskConfig, pass1file, Twater, Tlow, Thigh, missingThermal)
+    return ((pass2file, lCloudProb_hist), [pass2file])
+
+
+def stageLandThreshold(fmaskFilenames, fmaskConfig, missingThermal, pass1, pass2):
+    landThreshold = calcLandThreshold(pass2[1], pass1[5], fmaskConfig)
     if fmaskConfig.verbose:
         print("  landThreshold=", landThreshold)
+    return (landThreshold, [])
+
 
+def stageCloud(fmaskFilenames, fmaskConfig, missingThermal, pass1, pass2, landThreshold):
     if fmaskConfig.verbose:
         print("Cloud layer, pass 3")
     interimCloudmask = doCloudLayerFinalPass(fmaskFilenames, fmaskConfig, 
-        pass1file, pass2file, landThreshold, Tlow, missingThermal)
-        
+        pass1[0], pass2[0], landThreshold, pass1[2], missingThermal)
+    return (interimCloudmask, [interimCloudmask])
+
+
+def stagePotentialShadows(fmaskFilenames, fmaskConfig, missingThermal, pass1):
     if fmaskConfig.verbose:
         print("Potential shadows")
-    potentialShadowsFile = doPotentialShadows(fmaskFilenames, fmaskConfig, NIR_17)
-    
+    potentialShadowsFile = doPotentialShadows(fmaskFilenames, fmaskConfig, pass1[4])
+    return (potentialShadowsFile, [potentialShadowsFile])
+
+
+def stageClumps(fmaskFilenames, fmaskConfig, missingThermal, interimCloudmask):
     if fmaskConfig.verbose:
         print("Clumping clouds")
-    (clumps, numClumps) = clumpClouds(interimCloudmask)
-    
+    return (clumpClouds(interimCloudmask), [])
+
+
+def stage3Dclouds(fmaskFilenames, fmaskConfig, missingThermal, clumps):
     if fmaskConfig.verbose:
         print("Making 3d clouds")
-    (cloudShape, cloudBaseTemp, cloudClumpNdx) = make3Dclouds(fmaskFilenames, 
-        fmaskConfig, clumps, numClumps, missingThermal)
-    
+    (clumps, numClumps) = clumps
+    return (make3Dclouds(fmaskFilenames, fmaskConfig, clumps, numClumps, missingThermal), [])
+
+
+def stageShadowShapes(fmaskFilenames, fmaskConfig, missingThermal, clouds3D):
     if fmaskConfig.verbose:
         print("Making cloud shadow shapes")
-    shadowShapesDict = makeCloudShadowShapes(fmaskFilenames, fmaskConfig,
-        cloudShape, cloudClumpNdx)
-    
-    if fmaskConfig.verbose:
-        print("Matching shadows")
-    interimShadowmask = matchShadows(fmaskConfig, interimCloudmask, 
-        potentialShadowsFile, shadowShapesDict, cloudBaseTemp, Tlow, Thigh, 
-        pass1file)
-    
-    if fmaskConfig.verbose:
-        print("Doing final tidy up")
-    finalizeAll(fmaskFilenames, fmaskConfig, interimCloudmask, interimShadowmask, 
-        pass1file)
-    
-    # Remove temporary files
-    retVal = None
-    if not fmaskConfig.keepIntermediates:
-        for filename in [pass1file, pass2file, interimCloudmask, potentialShadowsFile,
-                interimShadowmask]:
-            deleteRaster(filename)
-    else:
-        # create a dictionary with the intermediate filenames so we can return them.
-        retVal = {'pass1': pass1file, 'pass2': pass2file, 
-            'interimCloud': interimCloudmask, 
-            'potentialShadows': potentialShadowsFile, 
-            'interimShadow': interimShadowmask}
+    (cloudShape, cloudBaseTemp, cloudClumpNdx) = clouds3D
+    return (makeCloudShadowShapes(fmaskFilenames, fmaskConfig, cloudShape, cloudClumpNdx), [])
 
+
+def stageMatchedShadows(fmaskFilenames, fmaskConfig, missingThermal, pass1, interimCloudmask,
+        potentialShadowsFile, clouds3D, shadowShapesDict):
     if fmaskConfig.verbose:
-        print('finished fmask')
-    
-    return retVal
+        print("Matching shadows")
+    (pass1file, Twater, Tlow, Thigh, NIR_17, nonNullCount) = pass1
+    matchedShadowmask = matchShadows(fmaskConfig, interimCloudmask, potentialShadowsFile, 
+        shadowShapesDict, clouds3D[1], Tlow, Thigh, pass1file, shadowBufferSize=0)
+    return (matchedShadowmask, [matchedShadowmask])
+
+
+def stageShadowBuffer(fmaskFilenames, fmaskConfig, missingThermal, matchedShadowmask):
+    interimShadowmask = bufferShadowmask(fmaskConfig, matchedShadowmask)
+    return (interimShadowmask, [interimShadowmask])
+
+
+#: The stages of :func:`doFmask`, by name: (function, stages it depends on,
+#: FmaskConfig fields it depends on, result kept in the stage cache). The
+#: function is called with the results of the stages it depends on and returns
+#: the result and its intermediate files. The stages not kept are only
+#: computed in a run when a stage after them must be recomputed. The final
+#: output (finalizeAll, with the cloud buffer) is always made.
+FMASK_STAGES = {
+    'pass1': (stagePass1, (), 
+        ('sensor', 'bands', 'thermalInfo', 'TOARefScaling', 'TOARefDNoffsetDict',
+         'Eqn1Swir2Thresh', 'Eqn1ThermThresh', 'Eqn2WhitenessThresh', 'cirrusBandTestThresh',
+         'Eqn7Swir2Thresh', 'Eqn20ThermThresh', 'Eqn20NirSnowThresh', 'Eqn20GreenSnowThresh',
+         'sen2displacementTest', 'sen2cdiWindow'), True),
+    'pass2': (stagePass2, ('pass1',), 
+        ('sensor', 'bands', 'thermalInfo', 'TOARefScaling', 'TOARefDNoffsetDict', 
+         'cirrusProbRatio'), True),
+    'landThreshold': (stageLandThreshold, ('pass1', 'pass2'), ('Eqn17CloudProbThresh',), True),
+    'cloud': (stageCloud, ('pass1', 'pass2', 'landThreshold'), 
+        ('sensor', 'thermalInfo', 'minCloudSize_pixels'), True),
+    'potentialShadows': (stagePotentialShadows, ('pass1',), 
+        ('bands', 'TOARefScaling', 'TOARefDNoffsetDict', 'Eqn19NIRFillThresh'), True),
+    'clumps': (stageClumps, ('cloud',), (), False),
+    'clouds3D': (stage3Dclouds, ('clumps',), ('thermalInfo',), False),
+    'shadowShapes': (stageShadowShapes, ('clouds3D',), ('anglesInfo',), False),
+    'matchedShadows': (stageMatchedShadows, 
+        ('pass1', 'cloud', 'potentialShadows', 'clouds3D', 'shadowShapes'), (), True),
+    'shadowBuffer': (stageShadowBuffer, ('matchedShadows',), ('shadowBufferSize', 'bufferEngine'), True),
+}
+
+
+def valueSignature(value):
+    """
+    Comparable signature of a config field or input value. The files are
+    identified by name, size and modification time, and the objects (like
+    the thermal and angles info) by their attributes
+    """
+    if isinstance(value, str) and os.path.isfile(value):
+        stat = os.stat(value)
+        return (value, stat.st_size, stat.st_mtime_ns)
+    if isinstance(value, numpy.ndarray):
+        return (value.shape, str(value.dtype), hash(value.tobytes()))
+    if isinstance(value, dict):
+        return tuple(sorted((key, valueSignature(v)) for (key, v) in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(valueSignature(v) for v in value)
+    if hasattr(value, '__dict__'):
+        return (type(value).__name__, valueSignature(vars(value)))
+    return value
+
+
+class FmaskStages(object):
+    """
+    Lazy evaluation of the stages of one run of :func:`doFmask`, the results
+    are taken from the stage cache when their signature is unchanged
+    """
+    def __init__(self, stageCache, fmaskFilenames, fmaskConfig, missingThermal):
+        self.stageCache = stageCache
+        self.fmaskFilenames = fmaskFilenames
+        self.fmaskConfig = fmaskConfig
+        self.missingThermal = missingThermal
+        self.inputsSignature = valueSignature((fmaskFilenames.toaRef, fmaskFilenames.thermal,
+            fmaskFilenames.saturationMask, missingThermal))
+        self.signatures = {}
+        # results of the stages not kept in the stage cache, only for this run
+        self.results = {}
+
+    def signature(self, name):
+        if name not in self.signatures:
+            (func, dependsOn, fields, keep) = FMASK_STAGES[name]
+            self.signatures[name] = (self.inputsSignature,
+                tuple((field, valueSignature(getattr(self.fmaskConfig, field))) for field in fields),
+                tuple(self.signature(dependency) for dependency in dependsOn))
+        return self.signatures[name]
+
+    def get(self, name):
+        """
+        Result of the stage, computing it (and the stages it depends on) only
+        if needed
+        """
+        (func, dependsOn, fields, keep) = FMASK_STAGES[name]
+        if keep:
+            signature = self.signature(name)
+            if self.stageCache.isValid(name, signature):
+                return self.stageCache.getResult(name)
+        elif name in self.results:
+            return self.results[name]
+
+        dependencies = [self.get(dependency) for dependency in dependsOn]
+        (result, files) = func(self.fmaskFilenames, self.fmaskConfig, self.missingThermal, *dependencies)
+        if keep:
+            self.stageCache.put(name, signature, result, files)
+        else:
+            self.results[name] = result
+        return result
 
 
 #: An offset so we can scale brightness temperature (BT, in deg C) to the range 0-255, for use in histograms.
@@ -273,6 +495,7 @@ def doPotentialCloudFirstPass(fmaskFilenames, fmaskConfig, missingThermal):
     otherargs.clearLandBT_hist = numpy.zeros(BT_HISTSIZE, dtype=numpy.uint32)
     otherargs.clearLandB4_hist = numpy.zeros(BT_HISTSIZE, dtype=numpy.uint32)
     otherargs.fmaskConfig = fmaskConfig
+    otherargs.scratch = ScratchBuffers()
     refImgInfo = fileinfo.ImageInfo(fmaskFilenames.toaRef)
     otherargs.refNull = refImgInfo.nodataval[0]
     if otherargs.refNull is None:
@@ -307,8 +530,11 @@ def doPotentialCloudFirstPass(fmaskFilenames, fmaskConfig, missingThermal):
         raise fmaskerrors.FmaskParameterError(msg)
 
     otherargs.bandsForRefNull = numpy.array([fmaskConfig.bands[i] for i in nullBandNdx])
+    controls.setConcurrencyStyle(config.makeConcurrencyStyle(fmaskConfig))
 
-    applier.apply(potentialCloudFirstPass, infiles, outfiles, otherargs, controls=controls)
+    rtn = applier.apply(potentialCloudFirstPass, infiles, outfiles, otherargs, controls=controls)
+    config.sumOtherArgs(otherargs, rtn, 'waterBT_hist', 'clearLandBT_hist', 'clearLandB4_hist',
+        'nonNullCount')
     
     (Twater, Tlow, Thigh) = calcBTthresholds(otherargs)
     
@@ -323,18 +549,62 @@ def doPotentialCloudFirstPass(fmaskFilenames, fmaskConfig, missingThermal):
     return (outfiles.pass1, Twater, Tlow, Thigh, b4_17, otherargs.nonNullCount)
 
 
+class ScratchBuffers(object):
+    """
+    Scratch arrays reused from one RIOS block to the next, by name. Each thread
+    has its own arrays, and they are not pickled (e.g. with otherargs to a
+    compute worker), so they can be shared by parallel block functions. 
+    """
+    def __init__(self):
+        self.buffers = {}
+
+    def get(self, name, shape, dtype=numpy.float32):
+        """
+        Return the scratch array of this name, with undefined values, of the 
+        given shape and dtype
+        """
+        threadBuffers = self.buffers.setdefault(threading.get_ident(), {})
+        buf = threadBuffers.get(name)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = numpy.empty(shape, dtype=dtype)
+            threadBuffers[name] = buf
+        return buf
+
+    def __getstate__(self):
+        return {'buffers': {}}
+
+
+def ratio(a, b, out, scratch):
+    """
+    (a - b) / (a + b) into the float32 array out
+    """
+    if numexpr is not None:
+        return numexpr.evaluate('(a - b) / (a + b)', out=out, casting='same_kind')
+    numpy.subtract(a, b, out=out)
+    numpy.add(a, b, out=scratch)
+    return numpy.divide(out, scratch, out=out)
+
+
 def potentialCloudFirstPass(info, inputs, outputs, otherargs):
     """
     Called from RIOS. 
     
     Calculate the first pass potential cloud layer (equation 6)
+    
+    The reflectances are float32, as are all the indices calculated from them, 
+    and the temporary arrays are taken from otherargs.scratch, so a block 
+    allocates little more than its output stack. The larger expressions are 
+    evaluated with numexpr, if it is installed. 
         
     """
     fmaskConfig = otherargs.fmaskConfig
+    scratch = otherargs.scratch
 
     ref = refDNtoUnits(inputs.toaref, fmaskConfig)
     # Clamp off any reflectance <= 0
-    ref[ref<=0] = 0.00001
+    numpy.maximum(ref, 0, out=ref)
+    ref[ref == 0] = 0.00001
+    shape = ref[0].shape
 
     # Extract the bands we need
     blue = otherargs.refBands[config.BAND_BLUE]
@@ -345,6 +615,8 @@ def potentialCloudFirstPass(info, inputs, outputs, otherargs):
     swir2 = otherargs.refBands[config.BAND_SWIR2]
     if hasattr(inputs, 'thermal'):
         THERM = otherargs.thermalInfo.thermalBand1040um
+
+    boolBuf = scratch.get('bool', shape, bool)
     
     # Special mask needed only for resets in final pass
     refNullmask = (inputs.toaref[otherargs.bandsForRefNull] == otherargs.refNull).any(axis=0)
@@ -358,32 +630,56 @@ def potentialCloudFirstPass(info, inputs, outputs, otherargs):
         nullmask = refNullmask
     
     # Equation 1
-    ndsi = (ref[green] - ref[swir1]) / (ref[green] + ref[swir1])
-    ndvi = (ref[nir] - ref[red]) / (ref[nir] + ref[red])
+    ndsi = ratio(ref[green], ref[swir1], scratch.get('ndsi', shape), scratch.get('tmp', shape))
+    ndvi = ratio(ref[nir], ref[red], scratch.get('ndvi', shape), scratch.get('tmp', shape))
     # In two parts, in case we have no thermal.
-    basicTest = (ref[swir2] > fmaskConfig.Eqn1Swir2Thresh) & (ndsi < 0.8) & (ndvi < 0.8)
+    basicTest = numpy.greater(ref[swir2], fmaskConfig.Eqn1Swir2Thresh, out=scratch.get('pcp', shape, bool))
+    basicTest &= numpy.less(ndsi, 0.8, out=boolBuf)
+    basicTest &= numpy.less(ndvi, 0.8, out=boolBuf)
     if hasattr(inputs, 'thermal'):
-        basicTest = (basicTest & (bt < fmaskConfig.Eqn1ThermThresh))
+        basicTest &= numpy.less(bt, fmaskConfig.Eqn1ThermThresh, out=boolBuf)
     
     # Equation 2
-    meanVis = (ref[blue] + ref[green] + ref[red]) / 3.0
-    whiteness = numpy.zeros(ref[0].shape)
-    for n in [blue, green, red]:
-        whiteness = whiteness + numpy.absolute((ref[n] - meanVis) / meanVis)
-
-    whitenessTest = (whiteness < fmaskConfig.Eqn2WhitenessThresh)
-    
-    # Haze test, equation 3
-    hazeTest = ((ref[blue] - 0.5 * ref[red] - 0.08) > 0)
+    meanVis = scratch.get('meanVis', shape)
+    whiteness = scratch.get('whiteness', shape)
+    (b, g, r) = (ref[blue], ref[green], ref[red])
+    if numexpr is not None:
+        numexpr.evaluate('(b + g + r) / 3', out=meanVis, casting='same_kind')
+        numexpr.evaluate('abs((b - meanVis) / meanVis) + abs((g - meanVis) / meanVis) + '
+            'abs((r - meanVis) / meanVis)', out=whiteness, casting='same_kind')
+    else:
+        numpy.add(b, g, out=meanVis)
+        meanVis += r
+        meanVis /= 3
+        whiteness.fill(0)
+        tmp = scratch.get('tmp', shape)
+        for n in [blue, green, red]:
+            numpy.subtract(ref[n], meanVis, out=tmp)
+            tmp /= meanVis
+            numpy.absolute(tmp, out=tmp)
+            whiteness += tmp
+
+    # whitenessTest, and the haze test, equation 3
+    pcp = basicTest
+    pcp &= numpy.less(whiteness, fmaskConfig.Eqn2WhitenessThresh, out=boolBuf)
+    tmp = scratch.get('tmp', shape)
+    numpy.multiply(ref[red], 0.5, out=tmp)
+    numpy.subtract(ref[blue], tmp, out=tmp)
+    pcp &= numpy.greater(tmp, 0.08, out=boolBuf)
     
     # Equation 4
-    b45test = ((ref[nir] / ref[swir1]) > 0.75)
+    numpy.divide(ref[nir], ref[swir1], out=tmp)
+    pcp &= numpy.greater(tmp, 0.75, out=boolBuf)
+    # So pcp is now equation 6, potential cloud pixels (first pass)
     
     # Equation 5
-    waterTest = numpy.logical_or(
-        numpy.logical_and(ndvi < 0.01, ref[nir] < 0.11),
-        numpy.logical_and(ndvi < 0.1, ref[nir] < 0.05)
-    )
+    waterTest = scratch.get('waterTest', shape, bool)
+    numpy.less(ndvi, 0.01, out=waterTest)
+    waterTest &= numpy.less(ref[nir], 0.11, out=boolBuf)
+    boolBuf2 = scratch.get('bool2', shape, bool)
+    numpy.less(ndvi, 0.1, out=boolBuf)
+    boolBuf &= numpy.less(ref[nir], 0.05, out=boolBuf2)
+    waterTest |= boolBuf
 
     waterTest[nullmask] = False
     
@@ -392,9 +688,6 @@ def potentialCloudFirstPass(info, inputs, outputs, otherargs):
         cirrus = otherargs.refBands[config.BAND_CIRRUS]
         cirrusBandTest = (ref[cirrus] > fmaskConfig.cirrusBandTestThresh)
     
-    # Equation 6. Potential cloud pixels (first pass)
-    pcp = basicTest & whitenessTest & hazeTest & b45test
-    
     # If Sentinel-2, we can use the Frantz 2018 displacement test
     if (fmaskConfig.sensor == config.FMASK_SENTINEL2) and fmaskConfig.sen2displacementTest:
         (ratio8a8, ratio8a7, v8a8, v8a7, cdi) = calcCDI(ref, fmaskConfig, otherargs.refBands)
@@ -410,7 +703,7 @@ def potentialCloudFirstPass(info, inputs, outputs, otherargs):
     # supposed to be combined with previous tests using AND or OR, so I tried both
     # and picked what seemed best. 
     if config.BAND_CIRRUS in otherargs.refBands:
-        pcp = (pcp | cirrusBandTest)
+        pcp |= cirrusBandTest
     
     # This is an extra saturation test added by DERM, and is not part of the Fmask algorithm. 
     # However, some cloud centres are saturated, and thus fail the whiteness and haze tests
@@ -424,52 +717,80 @@ def potentialCloudFirstPass(info, inputs, outputs, otherargs):
     pcp[nullmask] = False
     
     # Equation 7
-    clearSkyWater = numpy.logical_and(waterTest, ref[swir2] < fmaskConfig.Eqn7Swir2Thresh)
+    clearSkyWater = numpy.less(ref[swir2], fmaskConfig.Eqn7Swir2Thresh, out=scratch.get('clearSkyWater', shape, bool))
+    clearSkyWater &= waterTest
     clearSkyWater[nullmask] = False
     
     # Equation 12
-    clearLand = numpy.logical_and(numpy.logical_not(pcp), numpy.logical_not(waterTest))
+    clearLand = scratch.get('clearLand', shape, bool)
+    numpy.logical_or(pcp, waterTest, out=clearLand)
+    numpy.logical_not(clearLand, out=clearLand)
     clearLand[nullmask] = False
     
     # Equation 15
     # Need to modify ndvi/ndsi by saturation......
-    if hasattr(inputs, 'saturationMask'):
-        modNdvi = numpy.where((inputs.saturationMask[SATURATION_GREEN] != 0), 0, ndvi)
-        modNdsi = numpy.where((inputs.saturationMask[SATURATION_RED] != 0), 0, ndsi)
-    else:
-        modNdvi = ndvi
-        modNdsi = ndsi
     # Maximum of three indices
-    maxNdx = numpy.absolute(modNdvi)
-    maxNdx = numpy.maximum(maxNdx, numpy.absolute(modNdsi))
-    maxNdx = numpy.maximum(maxNdx, whiteness)
-    variabilityProb = 1 - maxNdx
+    maxNdx = numpy.absolute(ndvi, out=scratch.get('maxNdx', shape))
+    if hasattr(inputs, 'saturationMask'):
+        maxNdx[inputs.saturationMask[SATURATION_GREEN] != 0] = 0
+    numpy.absolute(ndsi, out=tmp)
+    if hasattr(inputs, 'saturationMask'):
+        tmp[inputs.saturationMask[SATURATION_RED] != 0] = 0
+    numpy.maximum(maxNdx, tmp, out=maxNdx)
+    numpy.maximum(maxNdx, whiteness, out=maxNdx)
+    # variabilityProb = 1 - maxNdx
+    variabilityProb = numpy.subtract(1, maxNdx, out=maxNdx)
     variabilityProb[nullmask] = 0
-    variabilityProbPcnt = numpy.round(variabilityProb * PROB_SCALE)
-    variabilityProbPcnt = variabilityProbPcnt.clip(BYTE_MIN, BYTE_MAX).astype(numpy.uint8)
+    variabilityProb *= PROB_SCALE
+    numpy.round(variabilityProb, out=variabilityProb)
+    numpy.clip(variabilityProb, BYTE_MIN, BYTE_MAX, out=variabilityProb)
     
     # Equation 20
     # In two parts, in case we are missing thermal
-    snowmask = ((ndsi > 0.15) & (ref[nir] > fmaskConfig.Eqn20NirSnowThresh) & 
-        (ref[green] > fmaskConfig.Eqn20GreenSnowThresh))
+    snowmask = scratch.get('snowmask', shape, bool)
+    numpy.greater(ndsi, 0.15, out=snowmask)
+    snowmask &= numpy.greater(ref[nir], fmaskConfig.Eqn20NirSnowThresh, out=boolBuf)
+    snowmask &= numpy.greater(ref[green], fmaskConfig.Eqn20GreenSnowThresh, out=boolBuf)
     if hasattr(inputs, 'thermal'):
-        snowmask = snowmask & (bt < fmaskConfig.Eqn20ThermThresh)
+        snowmask &= numpy.less(bt, fmaskConfig.Eqn20ThermThresh, out=boolBuf)
     snowmask[nullmask] = False
     
-    # Output the pcp and water test layers. 
-    outputs.pass1 = numpy.array([pcp, waterTest, clearLand, variabilityProbPcnt, 
-        nullmask, snowmask, refNullmask, thermNullmask])
+    # Output the pcp and water test layers, and the others, as flags
+    pass1 = numpy.empty((2, ) + shape, dtype=numpy.uint8)
+    packFlags(pass1[PASS1_FLAGS_LAYER], [(PASS1_PCP, pcp), (PASS1_WATERTEST, waterTest), 
+        (PASS1_CLEARLAND, clearLand), (PASS1_NULLMASK, nullmask), (PASS1_SNOWMASK, snowmask), 
+        (PASS1_REFNULLMASK, refNullmask), (PASS1_THERMNULLMASK, thermNullmask)])
+    pass1[PASS1_PROB_LAYER] = variabilityProb
+    outputs.pass1 = pass1
     
     # Accumulate histograms of temperature for land and water separately
     if hasattr(inputs, 'thermal'):
         scaledBT = (bt + BT_OFFSET).clip(0, BT_HISTSIZE)
         otherargs.waterBT_hist = accumHist(otherargs.waterBT_hist, scaledBT[clearSkyWater])
         otherargs.clearLandBT_hist = accumHist(otherargs.clearLandBT_hist, scaledBT[clearLand])
-    scaledB4 = (ref[nir] * B4_SCALE).astype(numpy.uint8)
+    numpy.multiply(ref[nir], B4_SCALE, out=tmp)
+    scaledB4 = tmp.astype(numpy.uint8)
     otherargs.clearLandB4_hist = accumHist(otherargs.clearLandB4_hist, scaledB4[clearLand])
     otherargs.nonNullCount += numpy.count_nonzero(~nullmask)
 
 
+def packFlags(flags, masks):
+    """
+    Set the uint8 flags array from the list of (flag, mask) pairs, the flag
+    is set where the boolean mask is True
+    """
+    flags.fill(0)
+    for (flag, mask) in masks:
+        flags |= mask.view(numpy.uint8) * numpy.uint8(flag)
+
+
+def pass1Flag(pass1, flag):
+    """
+    Unpack the boolean layer of the given flag from a block of the pass1 file
+    """
+    return (pass1[PASS1_FLAGS_LAYER] & flag) != 0
+
+
 def accumHist(counts, vals):
     """
     Accumulate the given values into the given (partial) counts
@@ -571,6 +892,18 @@ def doPotentialCloudSecondPass(fmaskFilenames, fmaskConfig, pass1file,
     """
     Second pass for potential cloud layer
     """
+    (pass2file, lCloudProb_hist) = doPotentialCloudSecondPassLayer(fmaskFilenames, 
+        fmaskConfig, pass1file, Twater, Tlow, Thigh, missingThermal)
+    landThreshold = calcLandThreshold(lCloudProb_hist, nonNullCount, fmaskConfig)
+    return (pass2file, landThreshold)
+
+
+def doPotentialCloudSecondPassLayer(fmaskFilenames, fmaskConfig, pass1file, 
+                Twater, Tlow, Thigh, missingThermal):
+    """
+    Make the second pass layer of potential cloud, and the histogram of the
+    land cloud probability of clear land, used for the land threshold
+    """
     infiles = applier.FilenameAssociations()
     outfiles = applier.FilenameAssociations()
     otherargs = applier.OtherInputs()
@@ -597,22 +930,31 @@ def doPotentialCloudSecondPass(fmaskFilenames, fmaskConfig, pass1file,
     controls.setReferenceImage(fmaskFilenames.toaRef)
     controls.setCalcStats(False)
     controls.setOmitPyramids(True)
+    controls.setConcurrencyStyle(config.makeConcurrencyStyle(fmaskConfig))
 
-    applier.apply(potentialCloudSecondPass, infiles, outfiles, otherargs, controls=controls)
+    rtn = applier.apply(potentialCloudSecondPass, infiles, outfiles, otherargs, controls=controls)
+    config.sumOtherArgs(otherargs, rtn, 'lCloudProb_hist')
     
-    # Equation 17
+    return (outfiles.pass2, otherargs.lCloudProb_hist)
+
+
+def calcLandThreshold(lCloudProb_hist, nonNullCount, fmaskConfig):
+    """
+    Dynamic land cloud probability threshold (equation 17), from the histogram
+    of the land cloud probability of clear land
+    """
     # Need at least 3% of nonnull pixels as clear land for this to be reliable. 
     minPixelsReqd = 0.03 * nonNullCount
-    if otherargs.lCloudProb_hist.sum() < minPixelsReqd:
+    if lCloudProb_hist.sum() < minPixelsReqd:
         # Almost no clear land pixels
         landThreshold = None
     else:
-        landThreshold = scoreatpcnt(otherargs.lCloudProb_hist, 82.5)
+        landThreshold = scoreatpcnt(lCloudProb_hist, 82.5)
     if landThreshold is not None:
         landThreshold = landThreshold / PROB_SCALE + fmaskConfig.Eqn17CloudProbThresh
     else:
         landThreshold = fmaskConfig.Eqn17CloudProbThresh
-    return (outfiles.pass2, landThreshold)
+    return landThreshold
 
 
 def potentialCloudSecondPass(info, inputs, outputs, otherargs):
@@ -634,8 +976,8 @@ def potentialCloudSecondPass(info, inputs, outputs, otherargs):
     Twater = otherargs.Twater
     (Tlow, Thigh) = (otherargs.Tlow, otherargs.Thigh)
     # Values from first pass
-    clearLand = inputs.pass1[2].astype(bool)
-    variabilityProbPcnt = inputs.pass1[3]
+    clearLand = pass1Flag(inputs.pass1, PASS1_CLEARLAND)
+    variabilityProbPcnt = inputs.pass1[PASS1_PROB_LAYER]
     variability_prob = variabilityProbPcnt / PROB_SCALE
     
     # Cirrus band. From Zhu et al 2015, equation 1
@@ -716,6 +1058,7 @@ def doCloudLayerFinalPass(fmaskFilenames, fmaskConfig, pass1file, pass2file,
     controls.setReferenceImage(pass1file)
     controls.setCalcStats(False)
     controls.setOmitPyramids(True)
+    controls.setConcurrencyStyle(config.makeConcurrencyStyle(fmaskConfig))
 
     applier.apply(cloudFinalPass, infiles, outfiles, otherargs, controls=controls)
     
@@ -728,9 +1071,9 @@ def cloudFinalPass(info, inputs, outputs, otherargs):
     
     Final pass of cloud mask layer
     """
-    nullmask = inputs.pass1[4].astype(bool)
-    pcp = inputs.pass1[0].astype(bool)
-    waterTest = inputs.pass1[1].astype(bool)
+    nullmask = pass1Flag(inputs.pass1, PASS1_NULLMASK)
+    pcp = pass1Flag(inputs.pass1, PASS1_PCP)
+    waterTest = pass1Flag(inputs.pass1, PASS1_WATERTEST)
     notWater = numpy.logical_not(waterTest)
     notWater[nullmask] = False
     wCloud_prob = inputs.pass2[0] / PROB_SCALE
@@ -792,14 +1135,11 @@ def doPotentialShadows(fmaskFilenames, fmaskConfig, NIR_17):
     # convert from numpy (0 based) to GDAL (1 based) indexing
     NIR_lyr = fmaskConfig.bands[config.BAND_NIR] + 1
     
-    # Read in whole of band 4
     ds = gdal.Open(fmaskFilenames.toaRef)
     band = ds.GetRasterBand(NIR_lyr)
     nullval = band.GetNoDataValue()
     if nullval is None:
         nullval = 0
-    # Sentinel2 is uint16 which causes problems...
-    scaledNIR = band.ReadAsArray().astype(numpy.int16)
     # Check for ESA's stoopid offset, for NIR band only
     NIRoffset = 0
     if (fmaskConfig.TOARefDNoffsetDict is not None and 
@@ -808,15 +1148,6 @@ def doPotentialShadows(fmaskFilenames, fmaskConfig, NIR_17):
     scaleVal = fmaskConfig.TOARefScaling
     NIR_17_dn = NIR_17 * scaleVal - NIRoffset
     
-    scaledNIR_filled = fillminima.fillMinima(scaledNIR, nullval, NIR_17_dn)
-
-    NIR = singleRefDNtoUnits(scaledNIR, scaleVal, NIRoffset)
-    NIR_filled = singleRefDNtoUnits(scaledNIR_filled, scaleVal, NIRoffset)
-    del scaledNIR, scaledNIR_filled
-    
-    # Equation 19
-    potentialShadows = ((NIR_filled - NIR) > fmaskConfig.Eqn19NIRFillThresh)
-    
     driver = gdal.GetDriverByName(applier.DEFAULTDRIVERNAME)
     creationOptions = applier.dfltDriverOptions[applier.DEFAULTDRIVERNAME]
     outds = driver.Create(potentialShadowsFile, ds.RasterXSize, ds.RasterYSize, 
@@ -826,13 +1157,69 @@ def doPotentialShadows(fmaskFilenames, fmaskConfig, NIR_17):
     transform = ds.GetGeoTransform()
     outds.SetGeoTransform(transform)
     outband = outds.GetRasterBand(1)
-    outband.WriteArray(potentialShadows)
+
+    tileSize = fillMinimaTileSize(fmaskConfig, ds.RasterYSize, ds.RasterXSize)
+    if tileSize is None:
+        # Read in whole of band 4
+        # Sentinel2 is uint16 which causes problems...
+        scaledNIR = band.ReadAsArray().astype(numpy.int16)
+        scaledNIR_filled = fillminima.fillMinima(scaledNIR, nullval, NIR_17_dn)
+
+        NIR = singleRefDNtoUnits(scaledNIR, scaleVal, NIRoffset)
+        NIR_filled = singleRefDNtoUnits(scaledNIR_filled, scaleVal, NIRoffset)
+        del scaledNIR, scaledNIR_filled
+        
+        # Equation 19
+        potentialShadows = ((NIR_filled - NIR) > fmaskConfig.Eqn19NIRFillThresh)
+        outband.WriteArray(potentialShadows)
+    else:
+        if fmaskConfig.verbose:
+            print("  Filling the NIR minima in tiles of", tileSize, "pixels")
+
+        def readTile(row, col, numRows, numCols):
+            return band.ReadAsArray(col, row, numCols, numRows).astype(numpy.int16)
+
+        tiles = fillminima.fillMinimaTiled(readTile, (ds.RasterYSize, ds.RasterXSize), 
+            nullval, NIR_17_dn, tileSize, fmaskConfig.fillMinimaWorkers)
+        for (row, col, scaledNIR, scaledNIR_filled) in tiles:
+            NIR = singleRefDNtoUnits(scaledNIR, scaleVal, NIRoffset)
+            NIR_filled = singleRefDNtoUnits(scaledNIR_filled, scaleVal, NIRoffset)
+            del scaledNIR, scaledNIR_filled
+            potentialShadows = ((NIR_filled - NIR) > fmaskConfig.Eqn19NIRFillThresh)
+            outband.WriteArray(potentialShadows, col, row)
     outband.SetNoDataValue(0)
     del outds
 
     return potentialShadowsFile
 
 
+#: Approximate memory used by doPotentialShadows, in bytes per pixel of the
+#: image it fills at once
+POTENTIALSHADOWS_BYTES_PER_PIXEL = 24
+#: Smallest tiles of the tiled fillMinima
+FILLMINIMA_MIN_TILESIZE = 256
+
+
+def fillMinimaTileSize(fmaskConfig, nrows, ncols):
+    """
+    Return the size of the tiles to fill the minima of the NIR band in 
+    doPotentialShadows, so that it fits in fmaskConfig.fillMinimaMemoryBudget, 
+    or None to fill the whole image at once. The tiles filled at once by the 
+    fmaskConfig.fillMinimaWorkers share the budget. 
+    """
+    budget = fmaskConfig.fillMinimaMemoryBudget
+    if budget is None:
+        budget = nrows * ncols * POTENTIALSHADOWS_BYTES_PER_PIXEL
+    # The image and the ring of the tiled fill must fit in the rows of fillminima
+    maxSize = fillminima.MAX_ROWS - 4
+    tileSize = None
+    if nrows * ncols * POTENTIALSHADOWS_BYTES_PER_PIXEL > budget or nrows > maxSize:
+        numWorkers = max(fmaskConfig.fillMinimaWorkers, 1)
+        tileSize = int(numpy.sqrt(budget / numWorkers / POTENTIALSHADOWS_BYTES_PER_PIXEL))
+        tileSize = max(min(tileSize, maxSize), FILLMINIMA_MIN_TILESIZE)
+    return tileSize
+
+
 def clumpClouds(cloudmaskfile):
     """
     Clump cloud pixels to make a layer of cloud objects. Currently assumes
@@ -891,6 +1278,8 @@ def make3Dclouds(fmaskFilenames, fmaskConfig, clumps, numClumps, missingThermal)
     controls.setReferencePixgrid(referencePixgrid)
     controls.setCalcStats(False)
     controls.setOmitPyramids(True)
+    # a single block, so no compute workers
+    controls.setConcurrencyStyle(config.makeConcurrencyStyle(fmaskConfig, computeWorkers=False))
 
     applier.apply(cloudShapeFunc, infiles, outfiles, otherargs, controls=controls)
     
@@ -918,35 +1307,31 @@ def cloudShapeFunc(info, inputs, outputs, otherargs):
         bt = otherargs.thermalInfo.scaleThermalDNtoC(inputs.thermal)
         cloudShape = numpy.zeros(bt.shape, dtype=numpy.uint8)
         
-        cloudIDlist = otherargs.cloudClumpNdx.values
-        for cloudID in cloudIDlist:
-            cloudNdx = otherargs.cloudClumpNdx.getIndexes(cloudID)
-            btCloud = bt[cloudNdx]
-        
-            numPixInCloud = len(cloudNdx[0])
+        # The indexes of the clouds pixels are packed cloud by cloud, so all 
+        # the clouds are done at once on the segments of their temperatures
+        cloudClumpNdx = otherargs.cloudClumpNdx
+        if len(cloudClumpNdx.values) > 0:
+            cloudNdx = cloudClumpNdx.getAllIndexes()
+            btClouds = bt[cloudNdx]
+            Tcloudbase = cloudBaseTemperatures(btClouds, cloudClumpNdx.start, 
+                cloudClumpNdx.counts)
         
-            # Equation 22, in several pieces
-            R = numpy.sqrt(numPixInCloud / (2 * numpy.pi))
-            if R >= 8:
-                percentile = 100.0 * (R - 8.0)**2 / (R**2)
-                Tcloudbase = scipy.stats.scoreatpercentile(btCloud, percentile)
-            else:
-                Tcloudbase = btCloud.min()
-        
-            # Equation 23
-            btCloud[btCloud>Tcloudbase] = Tcloudbase
+            # Equation 23, in the data type of bt as the clipping of each cloud 
+            # temperatures, so the heights are rounded the same
+            TcloudbasePix = numpy.repeat(Tcloudbase.astype(bt.dtype), cloudClumpNdx.counts)
+            btClouds = numpy.minimum(btClouds, TcloudbasePix)
         
             # Equation 24 (relative to cloud base). 
             # N.B. Equation given in paper appears to be wrong, it multiplies by lapse
             # rate instead of dividing by it. 
             LAPSE_RATE_WET = 6.5        # degrees/km
-            Htop_relative = (Tcloudbase - btCloud) / LAPSE_RATE_WET
+            Htop_relative = (TcloudbasePix - btClouds) / LAPSE_RATE_WET
         
             # Put this back into the cloudShape array at the right place
             cloudShape[cloudNdx] = numpy.round(Htop_relative * CLOUD_HEIGHT_SCALE).astype(numpy.uint8)
         
-            # Save the Tcloudbase for this cloudID
-            cloudBaseTemp[cloudID] = Tcloudbase
+            # Save the Tcloudbase for each cloudID
+            cloudBaseTemp = dict(zip(cloudClumpNdx.values, Tcloudbase))
     else:
         # fake it
         cloudShape = numpy.zeros(inputs.toaRef[0].shape, dtype=numpy.uint8)
@@ -955,6 +1340,43 @@ def cloudShapeFunc(info, inputs, outputs, otherargs):
     otherargs.cloudBaseTemp = cloudBaseTemp
 
 
+def cloudBaseTemperatures(btClouds, start, counts):
+    """
+    Equation 22 for all the clouds at once. btClouds is the brightness temperature
+    of the pixels of all the clouds, packed cloud by cloud, with the start and the 
+    count of the pixels of each cloud. 
+    
+    The base temperature of a cloud is the minimum of its temperatures, or for 
+    the clouds with radius R >= 8 pixels the percentile 100 * (R - 8)**2 / R**2 
+    of them, as computed by scipy.stats.scoreatpercentile. The temperatures are 
+    sorted once, within each cloud, instead of once for each cloud. 
+    
+    Returns an array of the base temperature of each cloud. 
+    
+    """
+    Tcloudbase = numpy.minimum.reduceat(btClouds, start).astype(numpy.float64)
+    
+    R = numpy.sqrt(counts / (2 * numpy.pi))
+    large = (R >= 8)
+    if large.any():
+        # sort the temperatures of each cloud, keeping the clouds in order
+        cloudNum = numpy.repeat(numpy.arange(len(counts)), counts)
+        btSorted = btClouds[numpy.lexsort((btClouds, cloudNum))]
+        
+        # the percentile interpolated between the sorted temperatures around it, 
+        # with the same weights as scoreatpercentile
+        R = R[large]
+        percentile = 100.0 * (R - 8.0)**2 / (R**2)
+        idx = percentile / 100.0 * (counts[large] - 1)
+        i = numpy.floor(idx).astype(numpy.int64)
+        frac = idx - i
+        lower = btSorted[start[large] + i].astype(numpy.float64)
+        upper = btSorted[start[large] + numpy.minimum(i + 1, counts[large] - 1)]
+        Tcloudbase[large] = numpy.where(frac > 0, lower * (1 - frac) + upper * frac, lower)
+    
+    return Tcloudbase
+
+
 METRES_PER_KM = 1000.0
 BYTES_PER_VOXEL = 4
 SOLIDCLOUD_MAXMEM = float(1024 * 1024 * 1024)
@@ -979,14 +1401,12 @@ def makeCloudShadowShapes(fmaskFilenames, fmaskConfig,
     
     shadowShapesDict = {}
     
-    cloudIDlist = cloudClumpNdx.values
-    for cloudID in cloudIDlist:
-        cloudNdx = cloudClumpNdx.getIndexes(cloudID)
-        
-        sunAz = fmaskConfig.anglesInfo.getSolarAzimuthAngle(cloudNdx)
-        sunZen = fmaskConfig.anglesInfo.getSolarZenithAngle(cloudNdx)
-        satAz = fmaskConfig.anglesInfo.getViewAzimuthAngle(cloudNdx)
-        satZen = fmaskConfig.anglesInfo.getViewZenithAngle(cloudNdx)
+    # The average angles of all the clouds at once
+    (sunZenAll, sunAzAll, satZenAll, satAzAll) = fmaskConfig.anglesInfo.getMeanAngles(cloudClumpNdx)
+    
+    for (i, (cloudID, cloudNdx)) in enumerate(cloudClumpNdx.iterIndexes()):
+        (sunAz, sunZen) = (sunAzAll[i], sunZenAll[i])
+        (satAz, satZen) = (satAzAll[i], satZenAll[i])
         
         # Cloudtop height of each pixel in cloud, in metres
         cloudHgt = METRES_PER_KM * cloudShape[cloudNdx] / CLOUD_HEIGHT_SCALE
@@ -1039,21 +1459,18 @@ def makeCloudShadowShapes(fmaskFilenames, fmaskConfig,
         rows = (yDash / yRes).astype(numpy.uint32).clip(0, nrows - 1)
         cols = (xDash / xRes).astype(numpy.uint32).clip(0, ncols - 1)
         
-        # Make the row/col arrays have the right shape, and store as a single tuple
-        shadowNdx = (rows.flatten(), cols.flatten())
-        
         # The row/cols can contain duplicates, as many 3-d points will project
-        # into the same 2-d location at cloudbase height. 
-        # So, we must remove the duplicates and give them the right shape. It seems
-        # that the most efficient way of doing this is to use them as indexes to 
-        # set pixels, then get back the indexes of the pixels which were set. Seems
-        # a bit roundabout, but I can't think of a better way. 
-        # Sadly, I have had to comment this bit out, as it makes the whole
-        # thing take several times as long. Obviously I need a better method of removing
-        # the duplicates. Sigh.....
-        # blankImg[shadowNdx] = True
-        # shadowNdx = numpy.where(blankImg)
-        # blankImg[shadowNdx] = False
+        # into the same 2-d location at cloudbase height. They are harmless for 
+        # the shadow templates, but take memory while all the shapes are kept. 
+        # Removing them trades time for memory, so it is only done if asked 
+        # (see FmaskConfig.setDedupShadowShapes), and only when the points are 
+        # dense in the bounding box of the shadow, where duplicates are many and
+        # the bitmap of the box is cheap, not by sorting sparse points (see 
+        # test/benchmarks/benchmark_shadow_shapes.py in the plugin). 
+        shadowNdx = (rows.flatten(), cols.flatten())
+        if fmaskConfig.dedupShadowShapes:
+            shadowNdx = uniqueIndexes(*shadowNdx, denseOnly=True)
+        del rows, cols
         
         # Stash these shapes in a dictionary, along with the corresponding sun and satellite angles
         shadowShapesDict[cloudID] = (shadowNdx, satAz, satZen, sunAz, sunZen)
@@ -1064,6 +1481,44 @@ def makeCloudShadowShapes(fmaskFilenames, fmaskConfig,
     return shadowShapesDict
 
 
+#: Largest ratio of the area of the bounding box of a set of (row, col) indexes
+#: to their number, for which uniqueIndexes removes the duplicates with a bitmap 
+#: of the box instead of sorting them
+UNIQUE_BITMAP_MAX_RATIO = 16
+
+
+def uniqueIndexes(rows, cols, denseOnly=False):
+    """
+    Remove the duplicated (row, col) pairs from the given index arrays. When the
+    pairs are dense in their bounding box, they are set in a bitmap of the box and
+    read back, which is linear in the box area, otherwise their linear indexes
+    are sorted by numpy.unique. Returns the (rows, cols) tuple of unique pairs,
+    in row-major order. 
+    
+    With denseOnly, the pairs which are not dense in their bounding box, and 
+    so have fewer duplicates, are returned as they are instead of sorting them. 
+    """
+    if len(rows) == 0:
+        return (rows, cols)
+    (row0, rowN) = (int(rows.min()), int(rows.max()))
+    (col0, colN) = (int(cols.min()), int(cols.max()))
+    (nrows, ncols) = (rowN - row0 + 1, colN - col0 + 1)
+    
+    if nrows * ncols <= UNIQUE_BITMAP_MAX_RATIO * len(rows):
+        bitmap = numpy.zeros((nrows, ncols), dtype=bool)
+        bitmap[rows - row0, cols - col0] = True
+        (uniqueRows, uniqueCols) = numpy.nonzero(bitmap)
+    elif denseOnly:
+        return (rows, cols)
+    else:
+        linearNdx = (rows - row0).astype(numpy.int64) * ncols + (cols - col0)
+        (uniqueRows, uniqueCols) = numpy.divmod(numpy.unique(linearNdx), ncols)
+    
+    uniqueRows = (uniqueRows + row0).astype(rows.dtype)
+    uniqueCols = (uniqueCols + col0).astype(cols.dtype)
+    return (uniqueRows, uniqueCols)
+
+
 def getIntersectionCoords(filelist):
     """
     Use the RIOS utilities to get the correct area of intersection
@@ -1101,12 +1556,76 @@ def makeBufferKernel(buffsize):
     return bufferkernel
 
 
+def bufferMask(mask, buffsize, engine=None):
+    """
+    Buffer the 2-d boolean mask by a circle of radius buffsize pixels, as
+    maximum_filter with the footprint of makeBufferKernel(buffsize). The
+    engine is 'kernel' (that maximum_filter, whose cost grows with the square
+    of buffsize), 'runs' or 'distance', by default
+    FmaskConfig.bufferEngine. All give the same mask, except when the 
+    footprint is more than twice the size of the image, then the reflected
+    border of maximum_filter buffers pixels beyond the circle (even of an 
+    empty mask), and only 'runs' and 'distance' give the circular buffer. 
+    
+    The 'runs' engine dilates the rows of the mask once for each half-width of
+    the circle, and combines the rows of the dilations shifted by each row 
+    offset of the circle. The 'distance' engine thresholds the Euclidean 
+    distance transform of the mask, whose cost does not depend on buffsize,
+    but which needs 16 bytes per pixel. The mask is returned as it is if
+    buffsize is 0, else a boolean mask. 
+    
+    """
+    if buffsize <= 0:
+        return mask
+    if engine is None:
+        engine = config.FmaskConfig.bufferEngine
+    mask = mask.astype(bool, copy=False)
+    if engine == 'kernel':
+        buffered = maximum_filter(mask, footprint=makeBufferKernel(buffsize))
+    elif engine == 'distance':
+        if mask.any():
+            buffered = (distance_transform_edt(~mask) <= buffsize)
+        else:
+            buffered = mask.copy()
+    elif engine == 'runs':
+        buffered = bufferMaskRuns(mask, buffsize)
+    else:
+        raise fmaskerrors.FmaskParameterError("Unknown buffer engine '%s'" % engine)
+    return buffered
+
+
+def bufferMaskRuns(mask, buffsize):
+    """
+    Buffer the boolean mask with the 'runs' engine of bufferMask. The circle
+    of makeBufferKernel is the union of the runs centred on each of its rows,
+    so each row offset adds the rows of the mask dilated by the half-width
+    of the run, shifted by the offset. 
+    
+    """
+    nrows = mask.shape[0]
+    halfWidths = makeBufferKernel(buffsize).sum(axis=1) // 2
+    buffered = numpy.zeros_like(mask)
+    prevHalfWidth = None
+    # The half-widths shrink away from the centre row, so only the current
+    # dilation is kept
+    for dy in range(min(buffsize + 1, nrows)):
+        halfWidth = halfWidths[buffsize + dy]
+        if halfWidth != prevHalfWidth:
+            rowDilated = maximum_filter1d(mask, 2 * halfWidth + 1, axis=1)
+            prevHalfWidth = halfWidth
+        buffered[:nrows - dy] |= rowDilated[dy:]
+        if dy > 0:
+            buffered[dy:] |= rowDilated[:nrows - dy]
+    return buffered
+
+
 def matchShadows(fmaskConfig, interimCloudmask, potentialShadowsFile, 
-        shadowShapesDict, cloudBaseTemp, Tlow, Thigh, pass1file):
+        shadowShapesDict, cloudBaseTemp, Tlow, Thigh, pass1file, shadowBufferSize=None):
     """
     Match the cloud shadow shapes to the potential cloud shadows. 
     Write an output file of the resulting shadow layer. 
-    Includes a 3-pixel buffer on the final shadows. 
+    Includes a 3-pixel buffer on the final shadows, or shadowBufferSize
+    pixels if given (see :func:`bufferShadowmask`). 
     """
     # Do a bunch of fancy footwork to read the same region from the whole
     # raster, of each of three separate rasters. Really RIOS should be able to do this
@@ -1134,9 +1653,9 @@ def matchShadows(fmaskConfig, interimCloudmask, potentialShadowsFile,
     proj = ds.GetProjection()
     del ds
     ds = gdal.Open(pass1file)
-    band = ds.GetRasterBand(5)
+    band = ds.GetRasterBand(PASS1_FLAGS_LAYER + 1)
     (xoff, yoff) = topLeftDict[pass1file]
-    nullmask = band.ReadAsArray(xoff, yoff, ncols, nrows).astype(bool)
+    nullmask = pass1Flag(band.ReadAsArray(xoff, yoff, ncols, nrows)[numpy.newaxis], PASS1_NULLMASK)
     del ds
 
     (fd, interimShadowmask) = tempfile.mkstemp(prefix='matchedshadows', dir=fmaskConfig.tempDir, 
@@ -1147,16 +1666,12 @@ def matchShadows(fmaskConfig, interimCloudmask, potentialShadowsFile,
     
     unmatchedCount = 0
     cloudIDlist = shadowShapesDict.keys()
-    for cloudID in cloudIDlist:
-        shadowEntry = shadowShapesDict[cloudID]
-        if cloudID in cloudBaseTemp:
-            Tcloudbase = cloudBaseTemp[cloudID]
-        else:
-            Tcloudbase = 0
-
-        matchedShadowNdx = matchOneShadow(cloudmask, shadowEntry, potentialShadow, Tcloudbase, 
-            Tlow, Thigh, xRes, yRes, cloudID, nullmask)
-        
+    clouds = [(cloudID, shadowShapesDict[cloudID], cloudBaseTemp.get(cloudID, 0))
+        for cloudID in cloudIDlist]
+    # The clouds are matched independently, the matched shadows of each one are
+    # merged at the end, so the result is the same in serial or in parallel
+    for matchedShadowNdx in matchAllShadows(fmaskConfig, clouds, cloudmask, potentialShadow, 
+            nullmask, Tlow, Thigh, xRes, yRes):
         if matchedShadowNdx is not None:
             shadowmask[matchedShadowNdx] = True
         else:
@@ -1170,11 +1685,149 @@ def matchShadows(fmaskConfig, interimCloudmask, potentialShadowsFile,
     # Now apply a 3-pixel buffer, as per section 3.2 (2nd-last paragraph)
     # I have the buffer size settable from the commandline, with our default
     # being larger than the original. 
-    if fmaskConfig.shadowBufferSize > 0:
-        kernel = makeBufferKernel(fmaskConfig.shadowBufferSize)
-        shadowmaskBuffered = maximum_filter(shadowmask, footprint=kernel)
+    if shadowBufferSize is None:
+        shadowBufferSize = fmaskConfig.shadowBufferSize
+    shadowmaskBuffered = bufferMask(shadowmask, shadowBufferSize, fmaskConfig.bufferEngine)
+
+    driver = gdal.GetDriverByName(applier.DEFAULTDRIVERNAME)
+    creationOptions = applier.dfltDriverOptions[applier.DEFAULTDRIVERNAME]
+    ds = driver.Create(interimShadowmask, xsize, ysize, 1, gdal.GDT_Byte,
+                creationOptions)
+    ds.SetProjection(proj)
+    ds.SetGeoTransform(geotrans)
+    band = ds.GetRasterBand(1)
+    band.WriteArray(shadowmaskBuffered)
+    del ds
+    
+    return interimShadowmask
+
+
+#: Number of chunks of clouds for each worker in the parallel shadow matching
+SHADOWMATCH_CHUNKS_PER_WORKER = 4
+#: Minimum number of clouds to do the shadow matching in parallel
+SHADOWMATCH_MIN_PARALLEL = 64
+
+
+def matchAllShadows(fmaskConfig, clouds, cloudmask, potentialShadow, nullmask, 
+        Tlow, Thigh, xRes, yRes):
+    """
+    Match the shadow of all the clouds, a list of (cloudID, shadowEntry, Tcloudbase).
+    Returns the list of matched shadow indexes (or None) of each cloud, in the same
+    order. With fmaskConfig.shadowMatchWorkers > 1 the clouds are matched in 
+    parallel in a pool of threads, or processes (see 
+    :func:`fmask.config.FmaskConfig.setShadowMatchWorkers`) sharing the 
+    images read-only through shared memory. 
+    """
+    numWorkers = fmaskConfig.shadowMatchWorkers
+    if numWorkers <= 1 or len(clouds) < SHADOWMATCH_MIN_PARALLEL:
+        return matchShadowsChunk(clouds, cloudmask, potentialShadow, nullmask, 
+            Tlow, Thigh, xRes, yRes)
+
+    # Clouds sorted by size, largest first, dealt to the chunks in turn so the
+    # chunks have a similar amount of work
+    bySize = sorted(range(len(clouds)), key=lambda i: len(clouds[i][1][0][0]), reverse=True)
+    numChunks = min(len(clouds), numWorkers * SHADOWMATCH_CHUNKS_PER_WORKER)
+    chunkNdx = [bySize[n::numChunks] for n in range(numChunks)]
+    chunks = [[clouds[i] for i in ndx] for ndx in chunkNdx]
+
+    if fmaskConfig.shadowMatchUseProcesses and shared_memory is not None:
+        sharedImages = [SharedImage(img) for img in (cloudmask, potentialShadow, nullmask)]
+        try:
+            with futures.ProcessPoolExecutor(max_workers=numWorkers, 
+                    initializer=initSharedImagesWorker, 
+                    initargs=([img.info() for img in sharedImages],)) as executor:
+                chunkResults = list(executor.map(functools.partial(matchShadowsChunkShared, 
+                    Tlow=Tlow, Thigh=Thigh, xRes=xRes, yRes=yRes), chunks))
+        finally:
+            for img in sharedImages:
+                img.release()
     else:
-        shadowmaskBuffered = shadowmask
+        with futures.ThreadPoolExecutor(max_workers=numWorkers) as executor:
+            chunkResults = list(executor.map(lambda chunk: matchShadowsChunk(chunk, cloudmask, 
+                potentialShadow, nullmask, Tlow, Thigh, xRes, yRes), chunks))
+
+    # back in the order of the clouds
+    results = [None] * len(clouds)
+    for (ndx, chunkResult) in zip(chunkNdx, chunkResults):
+        for (i, matchedShadowNdx) in zip(ndx, chunkResult):
+            results[i] = matchedShadowNdx
+    return results
+
+
+def matchShadowsChunk(clouds, cloudmask, potentialShadow, nullmask, Tlow, Thigh, xRes, yRes):
+    """
+    Match the shadow of each cloud of the list of (cloudID, shadowEntry, Tcloudbase)
+    """
+    return [matchOneShadow(cloudmask, shadowEntry, potentialShadow, Tcloudbase, 
+                Tlow, Thigh, xRes, yRes, cloudID, nullmask)
+            for (cloudID, shadowEntry, Tcloudbase) in clouds]
+
+
+class SharedImage(object):
+    """
+    Copy of an image in shared memory, for the process pool workers
+    """
+    def __init__(self, img):
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, img.nbytes))
+        self.shape = img.shape
+        self.dtype = img.dtype.str
+        numpy.ndarray(img.shape, dtype=img.dtype, buffer=self.shm.buf)[...] = img
+
+    def info(self):
+        return (self.shm.name, self.shape, self.dtype)
+
+    def release(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+#: The images shared with the worker process, (cloudmask, potentialShadow, nullmask)
+workerSharedImages = None
+workerSharedMemories = None
+
+
+def initSharedImagesWorker(sharedImagesInfo):
+    """
+    Initializer of the process pool workers, attach the images in shared memory
+    as read-only arrays
+    """
+    global workerSharedImages, workerSharedMemories
+    workerSharedMemories = [shared_memory.SharedMemory(name=name) for (name, shape, dtype) in sharedImagesInfo]
+    workerSharedImages = []
+    for (shm, (name, shape, dtype)) in zip(workerSharedMemories, sharedImagesInfo):
+        img = numpy.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        img.flags.writeable = False
+        workerSharedImages.append(img)
+
+
+def matchShadowsChunkShared(clouds, Tlow, Thigh, xRes, yRes):
+    """
+    Called in the process pool workers, match the shadows of the chunk of clouds
+    with the images in shared memory
+    """
+    (cloudmask, potentialShadow, nullmask) = workerSharedImages
+    return matchShadowsChunk(clouds, cloudmask, potentialShadow, nullmask, Tlow, Thigh, xRes, yRes)
+
+
+def bufferShadowmask(fmaskConfig, shadowmaskFile):
+    """
+    Apply the shadow buffer of fmaskConfig.shadowBufferSize pixels to the
+    (not buffered) matched shadows file. Write an output file of the
+    buffered shadow layer. 
+    """
+    ds = gdal.Open(shadowmaskFile)
+    shadowmask = ds.GetRasterBand(1).ReadAsArray().astype(bool)
+    geotrans = ds.GetGeoTransform()
+    (xsize, ysize) = (ds.RasterXSize, ds.RasterYSize)
+    proj = ds.GetProjection()
+    del ds
+
+    (fd, interimShadowmask) = tempfile.mkstemp(prefix='bufferedshadows', dir=fmaskConfig.tempDir, 
+                                        suffix=fmaskConfig.defaultExtension)
+    os.close(fd)
+
+    shadowmaskBuffered = bufferMask(shadowmask, fmaskConfig.shadowBufferSize, 
+        fmaskConfig.bufferEngine)
 
     driver = gdal.GetDriverByName(applier.DEFAULTDRIVERNAME)
     creationOptions = applier.dfltDriverOptions[applier.DEFAULTDRIVERNAME]
@@ -1190,10 +1843,12 @@ def matchShadows(fmaskConfig, interimCloudmask, potentialShadowsFile,
 
 
 def matchOneShadow(cloudmask, shadowEntry, potentialShadow, Tcloudbase, Tlow, Thigh, 
-        xRes, yRes, cloudID, nullmask):
+        xRes, yRes, cloudID, nullmask, engine=None):
     """
     Given the temperatures and sun angles for a single cloud object, and a shadow
-    shape, search along the sun vector for a matching shadow object. 
+    shape, search along the sun vector for a matching shadow object. The engine
+    to compute the overlap is 'direct', 'runs' or 'auto', by default the one 
+    set in SHADOWMATCH_ENGINE. 
     
     """
     (imgNrows, imgNcols) = cloudmask.shape
@@ -1245,11 +1900,9 @@ def matchOneShadow(cloudmask, shadowEntry, potentialShadow, Tcloudbase, Tlow, Th
     shadowTemplate = numpy.zeros((nrows, ncols), dtype=bool)
     shadowTemplate[shapeNdx[0] - row0, shapeNdx[1] - col0] = True
     
-    # Step this template across the potential shadows until we match. 
-    i = 0
-    bestSimilarity = 0
-    bestRC = (0, 0)
-    bestOverlapRegion = None
+    # The top-left corners of the regions where the template is stepped
+    # across the potential shadows, only the steps inside the image
+    stepsRC = []
     for i in range(numSteps):
         # Cloudbase height for this step
         H = (Xoff_min + i * Xstep) / (tanSunZen * sinSunAz)
@@ -1266,52 +1919,179 @@ def matchOneShadow(cloudmask, shadowEntry, potentialShadow, Tcloudbase, Tlow, Th
         rowOff = int(Yoff / yRes)
         colOff = int(Xoff / xRes)
         
-        # Extract the potential shadow, and also the cloud, from the shifted region of
-        # the full images
         r = row0 - rowOff
         c = col0 - colOff
         if r >= 0 and r + nrows <= imgNrows and c >= 0 and c + ncols <= imgNcols:
-            cloud = cloudmask[r:r + nrows, c:c + ncols]
-            potShadow = potentialShadow[r:r + nrows, c:c + ncols]
-            null = nullmask[r:r + nrows, c:c + ncols]
-            # mask the potential shadow layer, so we don't include anything we think is cloud
-            potShadow[cloud] = 0
-            # Similarly with the areas which are null in the imagery
-            potShadow[null] = 0
-
-            # Mask the shadow template with the cloud from this area
-            shadowTemplateMasked = shadowTemplate.copy()
-            shadowTemplateMasked[cloud] = False
-            shadowTemplateMasked[null] = False
-
-            similarity = 0
-            overlap = numpy.logical_and(potShadow, shadowTemplateMasked)
-            # Calculate overlap area (by counting pixels)
-            overlapArea = overlap.sum()
-            # Remaining area of shadow shape
-            shadowArea = shadowTemplateMasked.sum()
-            if shadowArea > 0:
-                similarity = float(overlapArea) / shadowArea
-
-            # We don't use the Zhu & Woodcock termination condition, as this
-            # very often results in stopping search too soon. We just check the whole
-            # transect, and save the best position. 
-            # TODO: strict version should use new threshold
-            if similarity > bestSimilarity:
-                bestRC = (r, c)
-                bestSimilarity = similarity
-                bestOverlapRegion = overlap
+            stepsRC.append((r, c))
+    
+    if len(stepsRC) == 0:
+        return None
+
+    if engine is None:
+        engine = SHADOWMATCH_ENGINE
+    if engine == 'auto':
+        engine = chooseShadowMatchEngine(stepsRC, shadowTemplate)
+
+    # For each step, the area of the shadow template masked with the cloud and
+    # the null areas of the region, and its overlap with the potential shadows
+    if engine == 'runs':
+        (overlapAreas, shadowAreas) = shadowOverlapAreasRuns(shadowTemplate, stepsRC, 
+            cloudmask, potentialShadow, nullmask)
+    else:
+        (overlapAreas, shadowAreas) = shadowOverlapAreasDirect(shadowTemplate, stepsRC, 
+            cloudmask, potentialShadow, nullmask)
+
+    # We don't use the Zhu & Woodcock termination condition, as this
+    # very often results in stopping search too soon. We just check the whole
+    # transect, and save the best position (the first one, for equal similarity). 
+    # TODO: strict version should use new threshold
+    bestSimilarity = 0
+    bestRC = None
+    for ((r, c), overlapArea, shadowArea) in zip(stepsRC, overlapAreas, shadowAreas):
+        similarity = 0
+        if shadowArea > 0:
+            similarity = float(overlapArea) / shadowArea
+        if similarity > bestSimilarity:
+            bestRC = (r, c)
+            bestSimilarity = similarity
     
     if bestSimilarity > 0.3:
         # We accept the match, now save the index for the pixels in the overlap region
+        (r, c) = bestRC
+        cloud = cloudmask[r:r + nrows, c:c + ncols]
+        potShadow = potentialShadow[r:r + nrows, c:c + ncols]
+        null = nullmask[r:r + nrows, c:c + ncols]
+        bestOverlapRegion = potShadow & shadowTemplate & ~cloud & ~null
         overlapNdx = numpy.where(bestOverlapRegion)
-        matchedShadowNdx = (bestRC[0] + overlapNdx[0], bestRC[1] + overlapNdx[1])
+        matchedShadowNdx = (r + overlapNdx[0], c + overlapNdx[1])
     else:
         matchedShadowNdx = None
     
     return matchedShadowNdx
 
 
+#: Engine to compute the overlap of the shadow template with the potential
+#: shadows along the sun vector in matchOneShadow: 'direct' steps the template
+#: across the image, 'runs' computes all the steps at once from the runs of the
+#: template rows and the row-wise summed-area tables of the region searched, 
+#: 'auto' chooses the fastest for each cloud
+SHADOWMATCH_ENGINE = 'auto'
+#: Overhead of one step of the 'direct' engine, in pixels
+SHADOWMATCH_STEP_COST = 1000
+#: Maximum number of (step, run) pairs evaluated at once by the 'runs' engine
+SHADOWMATCH_RUNS_CHUNK = 1 << 22
+
+
+def chooseShadowMatchEngine(stepsRC, shadowTemplate):
+    """
+    Choose the fastest engine for the shadow matching, 'direct' or 'runs', by
+    the number of steps and the size of the template and of the region searched
+    """
+    (nrows, ncols) = shadowTemplate.shape
+    (rows, cols) = zip(*stepsRC)
+    regionSize = (max(rows) - min(rows) + nrows) * (max(cols) - min(cols) + ncols)
+    # each step of the direct engine also costs some python calls
+    directCost = len(stepsRC) * (nrows * ncols + SHADOWMATCH_STEP_COST)
+    # each run is a few gathers, and the summed-area tables cost some passes over the region
+    runsCost = 4 * len(stepsRC) * nrows + 2 * regionSize
+    if runsCost < directCost:
+        return 'runs'
+    return 'direct'
+
+
+def shadowOverlapAreasDirect(shadowTemplate, stepsRC, cloudmask, potentialShadow, nullmask):
+    """
+    Step the shadow template across the regions with top-left corners stepsRC, 
+    for each one returns the area of the template masked with the cloud and the 
+    null areas, and its overlap with the potential shadows
+    """
+    (nrows, ncols) = shadowTemplate.shape
+    overlapAreas = []
+    shadowAreas = []
+    for (r, c) in stepsRC:
+        # Extract the potential shadow, and also the cloud, from the shifted region of
+        # the full images
+        cloud = cloudmask[r:r + nrows, c:c + ncols]
+        potShadow = potentialShadow[r:r + nrows, c:c + ncols]
+        null = nullmask[r:r + nrows, c:c + ncols]
+
+        # Mask the shadow template with the cloud from this area, and similarly with 
+        # the areas which are null in the imagery. So the overlap doesn't include 
+        # anything we think is cloud, the images are only read. 
+        shadowTemplateMasked = shadowTemplate.copy()
+        shadowTemplateMasked[cloud] = False
+        shadowTemplateMasked[null] = False
+
+        overlap = numpy.logical_and(potShadow, shadowTemplateMasked)
+        # Calculate overlap area (by counting pixels)
+        overlapAreas.append(overlap.sum())
+        # Remaining area of shadow shape
+        shadowAreas.append(shadowTemplateMasked.sum())
+    return (overlapAreas, shadowAreas)
+
+
+def templateRuns(shadowTemplate):
+    """
+    Runs of consecutive pixels of the template rows, as arrays of the row, the
+    start column and the end column (exclusive) of each run
+    """
+    (nrows, ncols) = shadowTemplate.shape
+    padded = numpy.zeros((nrows, ncols + 2), dtype=numpy.int8)
+    padded[:, 1:-1] = shadowTemplate
+    edges = numpy.diff(padded, axis=1)
+    (startRows, startCols) = numpy.nonzero(edges == 1)
+    (endRows, endCols) = numpy.nonzero(edges == -1)
+    # nonzero is in row-major order, so the starts and ends of the runs are paired
+    return (startRows, startCols, endCols)
+
+
+def shadowOverlapAreasRuns(shadowTemplate, stepsRC, cloudmask, potentialShadow, nullmask):
+    """
+    Same as :func:`shadowOverlapAreasDirect` computing the areas of all the steps 
+    at once. The count of pixels of an image under the template is the sum, over 
+    the runs of the template rows, of the differences of the row-wise summed-area 
+    table of the image at the ends of the run. So each step costs the number of 
+    runs (the height of the template, for compact shapes) instead of its area. 
+    The areas are exact pixel counts. 
+    """
+    (nrows, ncols) = shadowTemplate.shape
+    rows = numpy.array([rc[0] for rc in stepsRC], dtype=numpy.int64)
+    cols = numpy.array([rc[1] for rc in stepsRC], dtype=numpy.int64)
+    (r0, c0) = (rows.min(), cols.min())
+    (r1, c1) = (rows.max() + nrows, cols.max() + ncols)
+
+    # masked areas (cloud or null), and potential shadows out of them, in the region
+    masked = cloudmask[r0:r1, c0:c1] | nullmask[r0:r1, c0:c1]
+    potShadow = potentialShadow[r0:r1, c0:c1] & ~masked
+
+    # row-wise summed-area tables, with a leading column of zeros
+    maskedSums = numpy.zeros((r1 - r0, c1 - c0 + 1), dtype=numpy.int32)
+    numpy.cumsum(masked, axis=1, out=maskedSums[:, 1:])
+    potShadowSums = numpy.zeros((r1 - r0, c1 - c0 + 1), dtype=numpy.int32)
+    numpy.cumsum(potShadow, axis=1, out=potShadowSums[:, 1:])
+    del masked, potShadow
+
+    (runRows, runStarts, runEnds) = templateRuns(shadowTemplate)
+    templateArea = int((runEnds - runStarts).sum())
+
+    numSteps = len(stepsRC)
+    overlapAreas = numpy.zeros(numSteps, dtype=numpy.int64)
+    maskedAreas = numpy.zeros(numSteps, dtype=numpy.int64)
+    chunkSize = max(1, SHADOWMATCH_RUNS_CHUNK // max(1, len(runRows)))
+    for i in range(0, numSteps, chunkSize):
+        # (step, run) indexes of the summed-area tables
+        stepRows = (rows[i:i + chunkSize] - r0)[:, None] + runRows[None, :]
+        stepCols = (cols[i:i + chunkSize] - c0)[:, None]
+        (startNdx, endNdx) = (stepCols + runStarts[None, :], stepCols + runEnds[None, :])
+        maskedAreas[i:i + chunkSize] = (maskedSums[stepRows, endNdx] - 
+            maskedSums[stepRows, startNdx]).sum(axis=1)
+        overlapAreas[i:i + chunkSize] = (potShadowSums[stepRows, endNdx] - 
+            potShadowSums[stepRows, startNdx]).sum(axis=1)
+
+    shadowAreas = templateArea - maskedAreas
+    return (overlapAreas, shadowAreas)
+
+
 def finalizeAll(fmaskFilenames, fmaskConfig, interimCloudmask, interimShadowmask, 
         pass1file):
     """
@@ -1336,8 +2116,9 @@ def finalizeAll(fmaskFilenames, fmaskConfig, interimCloudmask, interimShadowmask
     controls.setCalcStats(False)
     controls.setOmitPyramids(True)
 
-    if fmaskConfig.cloudBufferSize > 0:
-        otherargs.bufferkernel = makeBufferKernel(fmaskConfig.cloudBufferSize)
+    otherargs.bufferSize = fmaskConfig.cloudBufferSize
+    otherargs.bufferEngine = fmaskConfig.bufferEngine
+    controls.setConcurrencyStyle(config.makeConcurrencyStyle(fmaskConfig))
 
     applier.apply(maskAndBuffer, infiles, outfiles, otherargs, controls=controls)
     
@@ -1373,17 +2154,16 @@ def maskAndBuffer(info, inputs, outputs, otherargs):
            mask, even after buffering, etc. 
     
     """
-    snow = inputs.pass1[5].astype(bool)
-    nullmask = inputs.pass1[4].astype(bool)
+    snow = pass1Flag(inputs.pass1, PASS1_SNOWMASK)
+    nullmask = pass1Flag(inputs.pass1, PASS1_NULLMASK)
     resetNullmask = nullmask
 
     cloud = inputs.cloud[0].astype(bool)
     shadow = inputs.shadow[0].astype(bool)
-    water = inputs.pass1[1].astype(bool)
+    water = pass1Flag(inputs.pass1, PASS1_WATERTEST)
     
     # Buffer the cloud
-    if hasattr(otherargs, 'bufferkernel'):
-        cloud = maximum_filter(cloud, footprint=otherargs.bufferkernel)
+    cloud = bufferMask(cloud, otherargs.bufferSize, otherargs.bufferEngine)
     
     # now convert these masks to
     # 0 - null
@@ -25,6 +25,7 @@ import numpy
 from osgeo import gdal
 from rios import applier, cuiprogress, fileinfo
 from . import config
+from . import saturationcheck
 
 gdal.UseExceptions()
 
@@ -126,7 +127,13 @@ def riosTOA(info, inputs, outputs, otherinputs):
     if inIgnore is None:
         inIgnore = 0
 
-    cosSunZen = numpy.cos(inputs.angles[3] * otherinputs.anglesToRadians)
+    if otherinputs.anglesModel is not None:
+        # sun zenith of the block from the angles model, instead of an angles image
+        (xblock, yblock) = info.getBlockCoordArrays()
+        sunZen = otherinputs.anglesModel.sunAnglesForCoords(xblock, yblock)[1]
+        cosSunZen = numpy.cos(sunZen)
+    else:
+        cosSunZen = numpy.cos(inputs.angles[3] * otherinputs.anglesToRadians)
     
     nullMask = (inputs.infile == inIgnore).any(axis=0)
     
@@ -147,8 +154,14 @@ def riosTOA(info, inputs, outputs, otherinputs):
     for i in range(len(outputs.outfile)):
         outputs.outfile[i][nullMask] = otherinputs.outNull
 
+    # The saturation mask from the same block of the radiance, when asked for
+    if otherinputs.radianceBands is not None:
+        outputs.saturationMask = saturationcheck.saturationMask(inputs.infile, 
+            otherinputs.radianceBands)
+
 
-def makeTOAReflectance(infile, mtlFile, anglesfile, outfile):
+def makeTOAReflectance(infile, mtlFile, anglesfile, outfile, anglesModel=None, 
+        saturationMaskFile=None, fmaskConfig=None):
     """
     Main routine - does the calculation
 
@@ -168,6 +181,17 @@ def makeTOAReflectance(infile, mtlFile, anglesfile, outfile):
     angles image file is scaled as radians*100, and has layers for
     satAzimuth, satZenith, sunAzimuth, sunZenith, in that order. 
     
+    Alternatively, anglesfile can be None and anglesModel a 
+    landsatangles.LandsatAnglesModelInfo, which gives the solar zenith 
+    of each block of infile. 
+    
+    If saturationMaskFile is given, the saturation mask of 
+    saturationcheck.makeSaturationMask is also made, in the same pass 
+    through infile, with the visible bands of fmaskConfig. 
+    
+    The RIOS read and compute workers are those of fmaskConfig, if given
+    (see config.FmaskConfig.setRiosWorkers). 
+    
     """
     mtlInfo = config.readMTLFile(mtlFile)
     spaceCraft = mtlInfo['SPACECRAFT_ID']
@@ -176,10 +200,13 @@ def makeTOAReflectance(infile, mtlFile, anglesfile, outfile):
     
     inputs = applier.FilenameAssociations()
     inputs.infile = infile
-    inputs.angles = anglesfile
+    if anglesfile is not None:
+        inputs.angles = anglesfile
 
     outputs = applier.FilenameAssociations()
     outputs.outfile = outfile
+    if saturationMaskFile is not None:
+        outputs.saturationMask = saturationMaskFile
 
     otherinputs = applier.OtherInputs()
     otherinputs.earthSunDistance = earthSunDistance(date)
@@ -189,6 +216,10 @@ def makeTOAReflectance(infile, mtlFile, anglesfile, outfile):
     otherinputs.gains = gains
     otherinputs.offsets = offsets
     otherinputs.anglesToRadians = 0.01
+    otherinputs.anglesModel = anglesModel
+    otherinputs.radianceBands = None
+    if saturationMaskFile is not None:
+        otherinputs.radianceBands = fmaskConfig.bands
     otherinputs.outNull = 32767
     imginfo = fileinfo.ImageInfo(infile)
     otherinputs.inNull = imginfo.nodataval[0]
@@ -198,6 +229,7 @@ def makeTOAReflectance(infile, mtlFile, anglesfile, outfile):
     controls.setStatsIgnore(otherinputs.outNull)
     controls.setCalcStats(False)
     controls.setOmitPyramids(True)
+    controls.setConcurrencyStyle(config.makeConcurrencyStyle(fmaskConfig))
 
     applier.apply(riosTOA, inputs, outputs, otherinputs, controls=controls)
     
@@ -63,15 +63,18 @@ from __future__ import print_function, division
 import datetime
 
 import numpy
+from osgeo import gdal
 from osgeo import osr
 
 from rios import applier
 from rios import fileinfo
 
+from . import config
+
 osr.UseExceptions()
 
 
-def findImgCorners(img, imgInfo):
+def findImgCorners(img, imgInfo, fmaskConfig=None):
     """
     Find the corners of the data within the given template image
     Return a numpy array of (x, y) coordinates. The array has 2 columns, for X and Y.
@@ -85,10 +88,14 @@ def findImgCorners(img, imgInfo):
 
     Each list element is a numpy array of (x, y)
 
+    The extremes are kept in otherargs from one block to the next, so only the
+    RIOS read workers of fmaskConfig, if given, are used.
+
     """
     infiles = applier.FilenameAssociations()
     outfiles = applier.FilenameAssociations()
     otherargs = applier.OtherInputs()
+    controls = applier.ApplierControls()
 
     infiles.img = img
     otherargs.tl = None
@@ -98,8 +105,9 @@ def findImgCorners(img, imgInfo):
     otherargs.nullVal = imgInfo.nodataval[0]
     if otherargs.nullVal is None:
         otherargs.nullVal = 0
+    controls.setConcurrencyStyle(config.makeConcurrencyStyle(fmaskConfig, computeWorkers=False))
 
-    applier.apply(findCorners, infiles, outfiles, otherargs)
+    applier.apply(findCorners, infiles, outfiles, otherargs, controls=controls)
 
     corners = numpy.array([
         otherargs.tl,
@@ -150,6 +158,119 @@ def findCorners(info, inputs, outputs, otherargs):
             otherargs.br = bottomXY
 
 
+#: Size, in pixels, of the longest side of the decimated read of findImgCornersFast
+CORNERS_DECIMATED_SIZE = 1024
+#: Margin, in decimated pixels, of the full resolution windows around the
+#: extremes found in the decimated read
+CORNERS_REFINE_MARGIN = 2
+
+
+def findImgCornersFast(img, imgInfo):
+    """
+    Same as findImgCorners, without a full pass through the image. The extremes
+    of the non-null data are first found on a decimated read of the image (from 
+    its overviews, if any), then refined by reading only the full resolution 
+    strips around them. The strips are widened until the extreme is inside, so 
+    the corners are the same as the ones of findImgCorners for a swathe, only
+    isolated non-null pixels out of it can be missed. 
+
+    """
+    nullVal = imgInfo.nodataval[0]
+    if nullVal is None:
+        nullVal = 0
+
+    ds = gdal.Open(img)
+    (nrows, ncols) = (ds.RasterYSize, ds.RasterXSize)
+    factor = max(1, int(numpy.ceil(max(nrows, ncols) / CORNERS_DECIMATED_SIZE)))
+    (bufRows, bufCols) = (int(numpy.ceil(nrows / factor)), int(numpy.ceil(ncols / factor)))
+    nonnull = readNonnull(ds, nullVal, 0, 0, ncols, nrows, bufCols, bufRows)
+    (dataRows, dataCols) = (numpy.nonzero(nonnull.any(axis=1))[0], numpy.nonzero(nonnull.any(axis=0))[0])
+    if len(dataRows) == 0:
+        return numpy.array([None, None, None, None])
+    (rowScale, colScale) = (nrows / bufRows, ncols / bufCols)
+
+    def window(ndx, scale, size):
+        lo = int(numpy.floor((ndx - CORNERS_REFINE_MARGIN) * scale))
+        hi = int(numpy.ceil((ndx + 1 + CORNERS_REFINE_MARGIN) * scale))
+        return (max(0, lo), min(size, hi))
+
+    def rowsStrip(lo, hi):
+        return readNonnull(ds, nullVal, 0, lo, ncols, hi - lo)
+
+    def colsStrip(lo, hi):
+        return readNonnull(ds, nullVal, lo, 0, hi - lo, nrows).T
+
+    # The top and bottom rows with data, and the left and right columns, each
+    # as the (row, col) of the first pixel of the row or column. Ties are 
+    # taken as in findCorners. 
+    top = refineExtreme(rowsStrip, window(dataRows[0], rowScale, nrows), nrows, first=True)
+    bottom = refineExtreme(rowsStrip, window(dataRows[-1], rowScale, nrows), nrows, first=False)
+    (leftCol, leftRow) = refineExtreme(colsStrip, window(dataCols[0], colScale, ncols), ncols, first=True)
+    (rightCol, rightRow) = refineExtreme(colsStrip, window(dataCols[-1], colScale, ncols), ncols, first=False)
+    del ds
+    if None in (top[0], bottom[0], leftCol, rightCol):
+        return numpy.array([None, None, None, None])
+
+    def coords(row, col):
+        # centre of the pixel, as given by RIOS
+        x = imgInfo.xMin + (col + 0.5) * imgInfo.xRes
+        y = imgInfo.yMax - (row + 0.5) * imgInfo.yRes
+        return (x, y)
+
+    corners = numpy.array([
+        coords(*top),
+        coords(rightRow, rightCol),
+        coords(leftRow, leftCol),
+        coords(*bottom),
+    ])
+    return corners
+
+
+def readNonnull(ds, nullVal, xoff, yoff, xsize, ysize, bufXsize=None, bufYsize=None):
+    """
+    Read the window of the dataset, decimated to the buffer size if given, and
+    return the 2-d mask of the pixels which are not null in any band
+    """
+    data = ds.ReadAsArray(xoff, yoff, xsize, ysize, buf_xsize=bufXsize, buf_ysize=bufYsize)
+    if data.ndim == 2:
+        data = data[numpy.newaxis]
+    return (data != nullVal).all(axis=0)
+
+
+def refineExtreme(readStrip, window, size, first):
+    """
+    Find the first (or last) line with data of the image, along the axis of the 
+    strips given by readStrip(lo, hi), starting from the window (lo, hi) around
+    the decimated extreme, and widening it while the extreme is at its edge. 
+    Returns the (line, position) of the first pixel with data on that line. 
+
+    """
+    (lo, hi) = window
+    while True:
+        strip = readStrip(lo, hi)
+        lines = numpy.nonzero(strip.any(axis=1))[0]
+        if len(lines) > 0:
+            line = lines[0] if first else lines[-1]
+            if first:
+                atEdge = (line == 0 and lo > 0)
+            else:
+                atEdge = (line == hi - lo - 1 and hi < size)
+            if not atEdge:
+                break
+        elif lo == 0 and hi == size:
+            # no data at all
+            return (None, None)
+
+        # the extreme can be out of the window, widen it on that side
+        width = hi - lo
+        if first or len(lines) == 0:
+            lo = max(0, lo - width)
+        if not first or len(lines) == 0:
+            hi = min(size, hi + width)
+    position = numpy.nonzero(strip[line])[0][0]
+    return (lo + line, position)
+
+
 def findNadirLine(corners):
     """
     Return the equation of the nadir line, from the given corners of the swathe.
@@ -312,10 +433,12 @@ def sunAnglesForPoints(latDeg, longDeg, hourGMT, jdp):
     return (sunAz, sunZen)
 
 
-def makeAnglesImage(templateimg, outfile, nadirLine, extentSunAngles, satAzimuth, imgInfo):
+def makeAnglesImage(templateimg, outfile, nadirLine, extentSunAngles, satAzimuth, imgInfo,
+        fmaskConfig=None):
     """
     Make a single output image file of the sun and satellite angles for every
-    pixel in the template image.
+    pixel in the template image, with the RIOS read and compute workers of 
+    fmaskConfig, if given.
 
     """
     imgInfo = fileinfo.ImageInfo(templateimg)
@@ -342,6 +465,7 @@ def makeAnglesImage(templateimg, outfile, nadirLine, extentSunAngles, satAzimuth
     controls.setStatsIgnore(500)
     controls.setCalcStats(False)
     controls.setOmitPyramids(True)
+    controls.setConcurrencyStyle(config.makeConcurrencyStyle(fmaskConfig))
 
     applier.apply(makeAngles, infiles, outfiles, otherargs, controls=controls)
 
@@ -354,34 +478,160 @@ def makeAngles(info, inputs, outputs, otherargs):
 
     """
     (xblock, yblock) = info.getBlockCoordArrays()
+
+    (satAzimuth, satZenith) = satAnglesForCoords(xblock, yblock, otherargs.nadirLine,
+        otherargs.satAzimuth, otherargs.satAltitude, otherargs.R)
+
+    # Interpolate the sun angles from those calculated at the corners of the whole raster extent
+    extent = (otherargs.xMin, otherargs.xMax, otherargs.yMin, otherargs.yMax)
+    (sunAzimuth, sunZenith) = sunAnglesForCoords(xblock, yblock, extent, otherargs.extentSunAngles)
+
+    angleStack = numpy.array([satAzimuth, satZenith, sunAzimuth, sunZenith])
+    angleStackDN = angleStack * otherargs.radianScale
+
+    outputs.angles = numpy.round(angleStackDN).astype(numpy.int16)
+
+
+def satAnglesForCoords(x, y, nadirLine, satAzimuth, satAltitude, R):
+    """
+    Return a tuple of (satAzimuth, satZenith), in radians, for the given (x, y)
+    coordinates (arrays, of the same shape as the returned ones), from the 
+    distance to the nadir line. 
+
+    """
     # Nadir line coefficients of y=mx+b
-    (b, m) = otherargs.nadirLine
+    (b, m) = nadirLine
 
     # Distance of each pixel from the nadir line
-    dist = numpy.absolute((m * xblock - yblock + b) / numpy.sqrt(m**2 + 1))
+    dist = numpy.absolute((m * x - y + b) / numpy.sqrt(m**2 + 1))
 
     # Zenith angle assuming a flat earth
-    satZenith = numpy.arctan(dist / otherargs.satAltitude)
+    satZenith = numpy.arctan(dist / satAltitude)
 
     # Adjust satZenith for earth curvature. This is a very simple approximation, but
     # the adjustment is less than one degree anyway, so this is accurate enough.
-    curveAngle = numpy.arctan(dist / otherargs.R)
+    curveAngle = numpy.arctan(dist / R)
     satZenith += curveAngle
 
     # Work out whether we are left or right of the nadir line
-    isLeft = (yblock - (m * xblock + b)) > 0
-    (satAzimuthLeft, satAzimuthRight) = otherargs.satAzimuth
+    isLeft = (y - (m * x + b)) > 0
+    (satAzimuthLeft, satAzimuthRight) = satAzimuth
     satAzimuth = numpy.where(isLeft, satAzimuthLeft, satAzimuthRight)
 
-    # Interpolate the sun angles from those calculated at the corners of the whole raster extent
-    (xMin, xMax, yMin, yMax) = (otherargs.xMin, otherargs.xMax, otherargs.yMin, otherargs.yMax)
-    sunAzimuth = bilinearInterp(xMin, xMax, yMin, yMax, otherargs.extentSunAngles[:, 0], xblock, yblock)
-    sunZenith = bilinearInterp(xMin, xMax, yMin, yMax, otherargs.extentSunAngles[:, 1], xblock, yblock)
+    return (satAzimuth, satZenith)
 
-    angleStack = numpy.array([satAzimuth, satZenith, sunAzimuth, sunZenith])
-    angleStackDN = angleStack * otherargs.radianScale
 
-    outputs.angles = numpy.round(angleStackDN).astype(numpy.int16)
+def sunAnglesForCoords(x, y, extent, extentSunAngles):
+    """
+    Return a tuple of (sunAzimuth, sunZenith), in radians, for the given (x, y)
+    coordinates, interpolated from the sun angles at the corners of the raster
+    extent (xMin, xMax, yMin, yMax). 
+
+    """
+    (xMin, xMax, yMin, yMax) = extent
+    sunAzimuth = bilinearInterp(xMin, xMax, yMin, yMax, extentSunAngles[:, 0], x, y)
+    sunZenith = bilinearInterp(xMin, xMax, yMin, yMax, extentSunAngles[:, 1], x, y)
+    return (sunAzimuth, sunZenith)
+
+
+class LandsatAnglesModelInfo(config.AnglesInfo):
+    """
+    An implementation of AnglesInfo that evaluates the same angles model as 
+    makeAnglesImage, for the pixels queried only, so the angles image is 
+    never written nor read into memory. The angles are not rounded to the 
+    int16 scaling of the angles image. 
+
+    The pixel grid is the one of the template image of imgInfo, and the 
+    coordinates of a pixel are those of its centre, as given by RIOS. 
+
+    """
+    def __init__(self, imgInfo, nadirLine, extentSunAngles, satAzimuth):
+        self.xMin = imgInfo.xMin
+        self.xMax = imgInfo.xMax
+        self.yMin = imgInfo.yMin
+        self.yMax = imgInfo.yMax
+        self.xRes = imgInfo.xRes
+        self.yRes = imgInfo.yRes
+        self.nadirLine = numpy.asarray(nadirLine)
+        self.extentSunAngles = numpy.asarray(extentSunAngles)
+        self.satAzimuth = numpy.asarray(satAzimuth)
+        (ctrLat, ctrLong) = getCtrLatLong(imgInfo)
+        self.R = localRadius(ctrLat)
+        self.satAltitude = 705000      # Landsat nominal altitude in metres
+
+    def coordsForIndices(self, indices):
+        """
+        Return the (x, y) coordinates of the centres of the pixels with the
+        given (row, col) indices
+        """
+        (row, col) = indices
+        x = self.xMin + (numpy.asarray(col, dtype=numpy.float64) + 0.5) * self.xRes
+        y = self.yMax - (numpy.asarray(row, dtype=numpy.float64) + 0.5) * self.yRes
+        return (x, y)
+
+    def satAngles(self, indices):
+        (x, y) = self.coordsForIndices(indices)
+        return satAnglesForCoords(x, y, self.nadirLine, self.satAzimuth, 
+            self.satAltitude, self.R)
+
+    def sunAngles(self, indices):
+        (x, y) = self.coordsForIndices(indices)
+        return self.sunAnglesForCoords(x, y)
+
+    def sunAnglesForCoords(self, x, y):
+        """
+        Return a tuple of (sunAzimuth, sunZenith) for the given (x, y) 
+        coordinates, such as those of a RIOS block
+        """
+        extent = (self.xMin, self.xMax, self.yMin, self.yMax)
+        return sunAnglesForCoords(x, y, extent, self.extentSunAngles)
+
+    def getSolarZenithAngle(self, indices):
+        """
+        Return the average solar zenith angle for the given indices
+        """
+        return self.sunAngles(indices)[1].mean()
+
+    def getSolarAzimuthAngle(self, indices):
+        """
+        Return the average solar azimuth angle for the given indices
+        """
+        return self.sunAngles(indices)[0].mean()
+
+    def getViewZenithAngle(self, indices):
+        """
+        Return the average view zenith angle for the given indices
+        """
+        return self.satAngles(indices)[1].mean()
+
+    def getViewAzimuthAngle(self, indices):
+        """
+        Return the average view azimuth angle for the given indices
+        """
+        return self.satAngles(indices)[0].mean()
+
+    def getMeanAngles(self, valueIndexes):
+        """
+        Return the average angles for every value of the given 
+        valueindexes.ValueIndexes object, as a tuple of arrays 
+        (solarZenith, solarAzimuth, viewZenith, viewAzimuth). 
+        """
+        start = valueIndexes.start
+        counts = valueIndexes.counts
+        if len(start) == 0:
+            return tuple(numpy.zeros(0, dtype=numpy.float64) for i in range(4))
+
+        (x, y) = self.coordsForIndices(valueIndexes.getAllIndexes())
+        (sunAzimuth, sunZenith) = self.sunAnglesForCoords(x, y)
+        (satAzimuth, satZenith) = satAnglesForCoords(x, y, self.nadirLine, 
+            self.satAzimuth, self.satAltitude, self.R)
+        return tuple(numpy.add.reduceat(angle, start) / counts 
+            for angle in (sunZenith, sunAzimuth, satZenith, satAzimuth))
+
+    def setScaleToRadians(self, scale):
+        """
+        The angles are computed in radians, nothing to scale. 
+        """
 
 
 def bilinearInterp(xMin, xMax, yMin, yMax, cornerVals, x, y):
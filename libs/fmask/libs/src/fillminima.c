@@ -297,6 +297,7 @@ static PyObject *fillminima_fillMinima(PyObject *self, PyObject *args)
         hCrt++;
     } while (hCrt < hMax);
     
+    free(pixQ->q);
     free(pixQ);
 
     Py_RETURN_NONE;
@@ -35,7 +35,7 @@ def makeSaturationMask(fmaskConfig, radiancefile, outMask):
     
     The fmaskConfig parameter should be an instance of
     :class:`fmask.config.FmaskConfig`. This is used to determine
-    which bands are visible.
+    which bands are visible, and the RIOS read and compute workers.
     
     This mask is advisible since the whiteness test Eqn 2. 
     and Equation 6 are affected by saturated pixels and
@@ -60,6 +60,7 @@ def makeSaturationMask(fmaskConfig, radiancefile, outMask):
     controls = applier.ApplierControls()
     controls.setCalcStats(False)
     controls.setOmitPyramids(True)
+    controls.setConcurrencyStyle(config.makeConcurrencyStyle(fmaskConfig))
 
     controls.progress = cuiprogress.GDALProgressBar()
     
@@ -74,18 +75,28 @@ def riosSaturationMask(info, inputs, outputs, otherargs):
     not to be true, we can come back to this. 
     
     """
-    if inputs.radiance.dtype == numpy.uint8:
-        blue = otherargs.radianceBands[config.BAND_BLUE]
-        green = otherargs.radianceBands[config.BAND_GREEN]
-        red = otherargs.radianceBands[config.BAND_RED]
+    outputs.mask = saturationMask(inputs.radiance, otherargs.radianceBands)
+
+
+def saturationMask(radiance, radianceBands):
+    """
+    The saturation mask of the blue, green and red bands for a block of the 
+    radiance bands, as a 3-layer uint8 array. Also used by the combined TOA 
+    and saturation pass of landsatTOA. 
+    
+    """
+    if radiance.dtype == numpy.uint8:
+        blue = radianceBands[config.BAND_BLUE]
+        green = radianceBands[config.BAND_GREEN]
+        red = radianceBands[config.BAND_RED]
 
         satMaskList = []
         for band in [blue, green, red]:
-            satMaskList.append(inputs.radiance[band] == 255)
+            satMaskList.append(radiance[band] == 255)
 
-        outputs.mask = numpy.array(satMaskList).astype(numpy.uint8)
+        mask = numpy.array(satMaskList).astype(numpy.uint8)
     else:
         # Assume that anything larger than 8-bit is immune to saturation
-        outShape = (3, ) + inputs.radiance[0].shape
-        outputs.mask = numpy.zeros(outShape, dtype=numpy.uint8)
-    
+        outShape = (3, ) + radiance[0].shape
+        mask = numpy.zeros(outShape, dtype=numpy.uint8)
+    return mask
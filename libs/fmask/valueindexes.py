@@ -87,18 +87,25 @@ class ValueIndexes(object):
     * **end**               End points in indexes for each value
     * **valLU**             Lookup table for each value, to find it in the values array without explicitly searching. 
     * **nullVals**          Array of the null values requested. 
+    * **shape**             Shape of the original array
+    * **compact**           True if the indexes are stored as flat offsets
     
-    Limitations:
-    The array index values are handled using unsigned 32bit int values, so 
-    it won't work if the data array is larger than 4Gb. I don't think it would
-    fail very gracefully, either. 
+    The indexes of a value can be got in constant time, through valLU. The 
+    iterIndexes() method gives the indexes of all the values in turn. 
+    
+    The array index values are handled using unsigned 32bit int values, or 
+    64bit ones when the array has more than 4G elements. In the compact mode, 
+    the indexes are stored as flat offsets into the array (int32, or int64 for 
+    arrays over 2G elements), instead of one index for each dimension, which 
+    takes less memory for multi-dimensional arrays. 
     
     """
-    def __init__(self, a, nullVals=[]):
+    def __init__(self, a, nullVals=[], compact=False):
         """
         Creates a ValueIndexes object for the given array a. 
         A sequence of null values can be given, and these will not be included
         in the results, so that indexes for these cannot be determined. 
+        If compact is True, the indexes are stored as flat offsets. 
         
         """
         if not numpy.issubdtype(a.dtype, numpy.integer):
@@ -122,31 +129,70 @@ class ValueIndexes(object):
         self.values = binEdges[:-1][maskedCounts>0].astype(a.dtype)
         self.counts = maskedCounts[maskedCounts>0]
         
-        # Allocate space to store all indexes
-        totalCounts = self.counts.sum()
         self.nDims = a.ndim
-        self.indexes = numpy.zeros((totalCounts, a.ndim), dtype=numpy.uint32)
+        self.shape = a.shape
+        self.compact = compact
         self.end = self.counts.cumsum()
         self.start = self.end - self.counts
         
+        maxUint32 = 2**32 - 1
+        self.valLU = None
         if len(self.values) > 0:
             # A lookup table to make searching for a value very fast.
             valrange = numpy.array([self.values.min(), self.values.max()])
             numLookups = valrange[1] - valrange[0] + 1
-            maxUint32 = 2**32 - 1
             if numLookups > maxUint32:
                 raise RangeError("Range of different values is too great for uint32")
             self.valLU = numpy.zeros(numLookups, dtype=numpy.uint32)
             self.valLU.fill(maxUint32)     # A value to indicate "not found", must match _valndxFunc below
             self.valLU[self.values - self.values[0]] = range(len(self.values))
 
-            # For use within C. For each value, the current index 
-            # into the indexes array. A given element is incremented whenever it finds
-            # a new element of that value. 
-            currentIndex = self.start.copy().astype(numpy.uint32)
+        if compact or a.size > maxUint32:
+            # Too large for the uint32 indexes of _valueindexes, or flat offsets
+            # wanted, so sort the offsets by value
+            self.indexes = self.sortedOffsets(a)
+            if not compact:
+                self.indexes = numpy.stack(numpy.unravel_index(self.indexes, a.shape), 
+                    axis=1).astype(numpy.uint64)
+        else:
+            # Allocate space to store all indexes
+            totalCounts = self.counts.sum()
+            self.indexes = numpy.zeros((totalCounts, a.ndim), dtype=numpy.uint32)
+            
+            if len(self.values) > 0:
+                # For use within C. For each value, the current index 
+                # into the indexes array. A given element is incremented whenever it finds
+                # a new element of that value. 
+                currentIndex = self.start.copy().astype(numpy.uint32)
+
+                _valueindexes.valndxFunc(a, self.indexes, valrange[0], valrange[1], 
+                            self.valLU, currentIndex)
 
-            _valueindexes.valndxFunc(a, self.indexes, valrange[0], valrange[1], 
-                        self.valLU, currentIndex)
+    def sortedOffsets(self, a):
+        """
+        Flat offsets of the elements of a which are not nulls, sorted by value 
+        (in the order of self.values), and in array order within each value. 
+        Same order as the indexes found by _valueindexes. 
+        
+        """
+        offsetType = numpy.int32 if a.size < 2**31 else numpy.int64
+        if len(self.values) == 0:
+            return numpy.zeros(0, dtype=offsetType)
+        
+        # The position in self.values of each element, len(self.values) for the nulls
+        flat = a.ravel()
+        posType = numpy.uint16 if len(self.values) < 2**16 else numpy.uint32
+        pos = numpy.full(flat.shape, len(self.values), dtype=posType)
+        inRange = (flat >= self.values[0]) & (flat <= self.values[-1])
+        lookup = self.valLU[flat[inRange].astype(numpy.int64) - int(self.values[0])]
+        lookup[lookup == 2**32 - 1] = len(self.values)
+        pos[inRange] = lookup
+        del inRange, lookup
+        
+        # a stable sort keeps the array order within each value, and is a 
+        # radix sort for the 16bit positions
+        offsets = numpy.argsort(pos, kind='stable')[:self.end[-1]]
+        return offsets.astype(offsetType)
 
     def getIndexes(self, val):
         """
@@ -154,22 +200,51 @@ class ValueIndexes(object):
         value in the array is equal to val. 
         
         """
-        # Find where this value is listed. 
-        valNdx = (self.values == val).nonzero()[0]
+        # Find where this value is listed, from the lookup table 
+        valNdx = None
+        if self.valLU is not None and self.values[0] <= val <= self.values[-1]:
+            valNdx = int(self.valLU[int(val) - int(self.values[0])])
         
         # If this value is not actually in those listed, then we 
         # must return empty indexes
-        if len(valNdx) == 0:
+        if valNdx is None or valNdx == 2**32 - 1:
             start = 0
             end = 0
         else:
             # The index into counts, etc. for this value. 
-            valNdx = valNdx[0]
             start = self.start[valNdx]
             end = self.end[valNdx]
-            
-        # Create a tuple of index arrays, one for each index of the original array. 
+        
+        return self.indexesSlice(start, end)
+
+    def indexesSlice(self, start, end):
+        """
+        Return the tuple of index arrays, one for each index of the original 
+        array, of the packed indexes from start to end. 
+        
+        """
+        if self.compact:
+            return numpy.unravel_index(self.indexes[start:end], self.shape)
+        
         ndx = ()
         for i in range(self.nDims):
             ndx += (self.indexes[start:end, i], )
         return ndx
+
+    def getAllIndexes(self):
+        """
+        Return the indexes of all the values, as one tuple of index arrays, 
+        packed value by value in the order of the values. So the indexes of 
+        self.values[i] are the elements self.start[i] to self.end[i]. 
+        
+        """
+        return self.indexesSlice(0, len(self.indexes))
+
+    def iterIndexes(self):
+        """
+        Iterate over all the values, giving (value, indexes) pairs, where 
+        indexes is the tuple of index arrays returned by getIndexes(). 
+        
+        """
+        for (val, start, end) in zip(self.values, self.start, self.end):
+            yield (val, self.indexesSlice(start, end))
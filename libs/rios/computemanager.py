@@ -0,0 +1,174 @@
+"""
+Managers for the compute workers of :func:`rios.applier.apply`. Each
+kind of compute worker (see :class:`rios.structures.ConcurrencyStyle`)
+has its own sub-class of :class:`ComputeWorkerManager`, and the right
+one is given by :func:`getComputeWorkerManager`.
+
+Only the CW_THREADS kind is available in this version. The batch queue
+and sub-process kinds need the rios_computeworker command and its
+network data channel, which are not included.
+
+"""
+# This file is part of RIOS - Raster I/O Simplification
+# Copyright (C) 2012  Sam Gillingham, Neil Flood
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import copy
+import threading
+from abc import ABC, abstractmethod
+from concurrent import futures
+
+from . import rioserrors
+from .structures import CW_NONE, CW_THREADS, WorkerErrorRecord
+
+
+def getComputeWorkerManager(cwKind):
+    """
+    Return a compute worker manager object of the type
+    appropriate to the given cwKind.
+    """
+    cwMgrClasses = {
+        CW_THREADS: ThreadsComputeWorkerMgr
+    }
+    if cwKind not in cwMgrClasses:
+        msg = "Compute worker kind {} is not available".format(cwKind)
+        raise rioserrors.UnavailableError(msg)
+
+    return cwMgrClasses[cwKind]()
+
+
+class ComputeWorkerManager(ABC):
+    """
+    Abstract base class for all compute-worker manager subclasses
+
+    A subclass implements a particular way of managing RIOS
+    compute-workers. It should over-ride all abstract methods given here.
+
+    After the workers are shut down, the outObjList attribute holds the
+    objects returned by all the workers, i.e. their otherArgs and their
+    :class:`rios.structures.Timers` objects.
+
+    """
+    computeWorkerKind = CW_NONE
+
+    def __init__(self):
+        self.outObjList = []
+        self.jobName = None
+
+    def setJobName(self, jobName):
+        """
+        Sets the job name string, which is made available to worker
+        processes. Defaults to None, and has only cosmetic effects.
+        """
+        self.jobName = jobName
+
+    @abstractmethod
+    def startWorkers(self, numWorkers=None, userFunction=None,
+            infiles=None, outfiles=None, otherArgs=None, controls=None,
+            blockList=None, inBlockBuffer=None, outBlockBuffer=None,
+            workinggrid=None, allInfo=None, computeWorkersRead=False,
+            singleBlockComputeWorkers=False, tmpfileMgr=None,
+            haveSharedTemp=True, exceptionQue=None):
+        """
+        Start the specified compute workers
+        """
+
+    @abstractmethod
+    def shutdown(self):
+        """
+        Shutdown the computeWorkerManager
+        """
+
+
+class ThreadsComputeWorkerMgr(ComputeWorkerManager):
+    """
+    Manage compute workers using threads within the current process.
+
+    Each worker processes its own share of the blocks, taking them from
+    the inBlockBuffer (or reading them itself, with computeWorkersRead),
+    and puts the outputs into the outBlockBuffer. Each worker is given its
+    own copy of otherArgs.
+
+    """
+    computeWorkerKind = CW_THREADS
+
+    def __init__(self):
+        super().__init__()
+        self.threadPool = None
+        self.workerList = None
+        self.forceExit = None
+        self.lock = threading.Lock()
+
+    def startWorkers(self, numWorkers=None, userFunction=None,
+            infiles=None, outfiles=None, otherArgs=None, controls=None,
+            blockList=None, inBlockBuffer=None, outBlockBuffer=None,
+            workinggrid=None, allInfo=None, computeWorkersRead=False,
+            singleBlockComputeWorkers=False, tmpfileMgr=None,
+            haveSharedTemp=True, exceptionQue=None):
+        """
+        Start <numWorkers> threads to process blocks of data
+        """
+        self.threadPool = futures.ThreadPoolExecutor(max_workers=numWorkers)
+        self.forceExit = threading.Event()
+
+        # Divide the blocks between the workers. When the blocks come from
+        # the inBlockBuffer, this only decides how many each worker
+        # processes, as each takes whichever block is ready.
+        subBlocksList = [blockList[i::numWorkers] for i in range(numWorkers)]
+
+        self.workerList = []
+        for workerID in range(numWorkers):
+            # Each worker has its own copy of otherArgs, so the user
+            # function can accumulate things on it without locking
+            otherArgsCopy = copy.deepcopy(otherArgs)
+            worker = self.threadPool.submit(self.worker, userFunction,
+                infiles, outfiles, otherArgsCopy, controls, allInfo,
+                workinggrid, subBlocksList[workerID], inBlockBuffer,
+                outBlockBuffer, workerID, exceptionQue)
+            self.workerList.append(worker)
+
+    def worker(self, userFunction, infiles, outfiles, otherArgs, controls,
+            allInfo, workinggrid, blockList, inBlockBuffer, outBlockBuffer,
+            workerID, exceptionQue):
+        """
+        This function is a worker for a single thread, with no reading
+        or writing going on. All I/O is via the inBlockBuffer and
+        outBlockBuffer objects, or the worker's own reading.
+
+        """
+        # Avoid a circular import
+        from . import applier
+
+        try:
+            rtn = applier.apply_singleCompute(userFunction, infiles,
+                outfiles, otherArgs, controls, allInfo, workinggrid,
+                blockList, outBlockBuffer, inBlockBuffer, workerID,
+                self.forceExit)
+            with self.lock:
+                self.outObjList.extend(rtn.otherArgsList)
+                self.outObjList.append(rtn.timings)
+        except Exception as e:
+            workerErr = WorkerErrorRecord(e, 'compute', workerID)
+            exceptionQue.put(workerErr)
+
+    def shutdown(self):
+        """
+        Shut down the thread pool
+        """
+        if self.forceExit is not None:
+            self.forceExit.set()
+        if self.threadPool is not None:
+            self.threadPool.shutdown()
+            self.threadPool = None
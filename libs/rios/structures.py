@@ -0,0 +1,565 @@
+"""
+Data structures used by :func:`rios.applier.apply`. Some of these are
+created by the user (e.g. :class:`FilenameAssociations`,
+:class:`OtherInputs` and :class:`ConcurrencyStyle`), others are only
+used internally, to pass data between the main thread and the
+read and compute workers.
+
+"""
+# This file is part of RIOS - Raster I/O Simplification
+# Copyright (C) 2012  Sam Gillingham, Neil Flood
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+import traceback
+import contextlib
+
+from osgeo import gdal
+
+from . import rioserrors
+
+
+#: No compute workers, all computation is done in the main thread
+CW_NONE = "CW_NONE"
+#: Compute workers are threads within the main process
+CW_THREADS = "CW_THREADS"
+#: Compute workers are jobs on a PBS batch queue
+CW_PBS = "CW_PBS"
+#: Compute workers are jobs on a SLURM batch queue
+CW_SLURM = "CW_SLURM"
+#: Compute workers are AWS Batch jobs
+CW_AWSBATCH = "CW_AWSBATCH"
+#: Compute workers are sub-processes of the main process
+CW_SUBPROC = "CW_SUBPROC"
+
+ALL_CW_KINDS = (CW_NONE, CW_THREADS, CW_PBS, CW_SLURM, CW_AWSBATCH,
+    CW_SUBPROC)
+
+
+class FilenameAssociations(object):
+    """
+    Class for associating external image filenames with internal
+    names, which are then the same names used inside a function given
+    to the :func:`rios.applier.apply` function.
+
+    Each attribute created on this object should be a filename, or a
+    list of filenames. The corresponding attribute names will appear
+    on the 'inputs' or 'outputs' objects inside the applied function.
+    Each such attribute will be an image data block or a list of image
+    data blocks, accordingly.
+
+    Iterating over the object gives tuples of
+    (symbolicName, seqNum, filename), one for each file, where seqNum
+    is the position of the file within a list of filenames, or None
+    for a single filename.
+
+    """
+    def __iter__(self):
+        for symbolicName in self.__dict__:
+            val = self.__dict__[symbolicName]
+            if isinstance(val, list):
+                for (seqNum, filename) in enumerate(val):
+                    yield (symbolicName, seqNum, filename)
+            else:
+                yield (symbolicName, None, val)
+
+    def __contains__(self, symbolicName):
+        return symbolicName in self.__dict__
+
+    def __len__(self):
+        """
+        The total number of files, counting every filename in each list
+        """
+        return len(list(iter(self)))
+
+
+class BlockAssociations(object):
+    """
+    Generic object to store the image blocks used within
+    the applied function. The attributes are named the same way as in
+    the corresponding :class:`FilenameAssociations` object, but are
+    blocks of image data, instead of filenames. Where lists of filenames
+    were used, lists of image blocks are used here.
+
+    Also supports indexing with a (symbolicName, seqNum) tuple, as given
+    by iterating over a :class:`FilenameAssociations` object.
+
+    """
+    def __init__(self, filenameAssoc=None):
+        if filenameAssoc is not None:
+            # Make the lists, so each block can be put in its place
+            for (symbolicName, val) in filenameAssoc.__dict__.items():
+                if isinstance(val, list):
+                    setattr(self, symbolicName, [None] * len(val))
+
+    def __getitem__(self, key):
+        (symbolicName, seqNum) = key
+        val = getattr(self, symbolicName)
+        if seqNum is not None:
+            val = val[seqNum]
+        return val
+
+    def __setitem__(self, key, arr):
+        (symbolicName, seqNum) = key
+        if seqNum is None:
+            setattr(self, symbolicName, arr)
+        else:
+            if symbolicName not in self.__dict__:
+                setattr(self, symbolicName, [])
+            arrList = getattr(self, symbolicName)
+            if seqNum >= len(arrList):
+                arrList.extend([None] * (seqNum + 1 - len(arrList)))
+            arrList[seqNum] = arr
+
+
+class OtherInputs(object):
+    """
+    Generic object to store any extra inputs and outputs used
+    inside the function being applied. This class was originally
+    named for inputs, but in fact works just as well for outputs,
+    too. Any items stored on this will be persistent between
+    iterations of the block loop.
+
+    When compute workers are used (see :class:`ConcurrencyStyle`), each
+    worker has its own copy of this object, and the copies are returned
+    in the otherArgsList attribute of the :class:`ApplierReturn` object.
+    Any values accumulated on it by the applied function must then be
+    combined from those copies.
+
+    """
+    pass
+
+
+class ApplierBlockDefn(object):
+    """
+    Defines a single block of the working grid, in pixel coordinates,
+    not including any overlap margin.
+
+    """
+    def __init__(self, top, left, nrows, ncols):
+        self.top = top
+        self.left = left
+        self.nrows = nrows
+        self.ncols = ncols
+
+    def _key(self):
+        return (self.top, self.left, self.nrows, self.ncols)
+
+    def __eq__(self, other):
+        return (isinstance(other, ApplierBlockDefn) and
+            self._key() == other._key())
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __repr__(self):
+        return "ApplierBlockDefn({}, {}, {}, {})".format(*self._key())
+
+
+class ConcurrencyStyle(object):
+    """
+    Class to hold all the parameters controlling the concurrency of
+    :func:`rios.applier.apply`. An instance is given to
+    :meth:`rios.applier.ApplierControls.setConcurrencyStyle`. The default
+    has no concurrency at all.
+
+    Read workers are threads in the main process, which read blocks of
+    the input files, in parallel with the computation. This helps when
+    the reading is slow, e.g. with compressed files, or when inputs are
+    resampled. Each read worker reads one block of one input file at a
+    time.
+
+    Compute workers run the applied function on whole blocks, in parallel
+    with each other. The computeWorkerKind selects what sort of compute
+    workers to use, one of the CW_* constants. Only CW_THREADS is
+    available in this version, which is useful when the applied function
+    spends most of its time in code which releases the GIL (most of
+    numpy, scipy and GDAL). With compute workers, reading is done by the
+    read workers, unless computeWorkersRead is True, in which case each
+    compute worker reads its own blocks.
+
+    Each compute worker calls the applied function with its own copy of
+    the otherArgs object, and these copies are returned in the
+    otherArgsList of the :class:`ApplierReturn` object.
+
+    The various timeouts are in seconds, and are how long to wait on the
+    buffers passing blocks between the workers, before deciding that
+    something has gone wrong. Once the buffers are full, a worker waits
+    for another to take a block out, so these must be longer than the
+    time taken to process a single block.
+
+    Parameters:
+        * **numReadWorkers**             Number of read worker threads
+        * **numComputeWorkers**          Number of compute workers
+        * **computeWorkerKind**          One of the CW_* constants
+        * **computeWorkersRead**         If True, compute workers do their own reading
+        * **singleBlockComputeWorkers**  If True, each batch compute worker does a single block (batch queue kinds only)
+        * **haveSharedTemp**             If True, the compute workers share the temp directory of the main process
+        * **readBufferInsertTimeout**    Timeout on inserting blocks into the read buffer
+        * **readBufferPopTimeout**       Timeout on taking blocks out of the read buffer
+        * **computeBufferInsertTimeout** Timeout on inserting blocks into the compute buffer
+        * **computeBufferPopTimeout**    Timeout on taking blocks out of the compute buffer
+
+    New in version 2.0
+
+    """
+    def __init__(self, numReadWorkers=0, numComputeWorkers=0,
+            computeWorkerKind=CW_NONE, computeWorkersRead=False,
+            singleBlockComputeWorkers=False, haveSharedTemp=True,
+            readBufferInsertTimeout=10, readBufferPopTimeout=10,
+            computeBufferInsertTimeout=10, computeBufferPopTimeout=20):
+        self.numReadWorkers = numReadWorkers
+        self.numComputeWorkers = numComputeWorkers
+        self.computeWorkerKind = computeWorkerKind
+        self.computeWorkersRead = computeWorkersRead
+        self.singleBlockComputeWorkers = singleBlockComputeWorkers
+        self.haveSharedTemp = haveSharedTemp
+        self.readBufferInsertTimeout = readBufferInsertTimeout
+        self.readBufferPopTimeout = readBufferPopTimeout
+        self.computeBufferInsertTimeout = computeBufferInsertTimeout
+        self.computeBufferPopTimeout = computeBufferPopTimeout
+
+        if computeWorkerKind not in ALL_CW_KINDS:
+            msg = "Unknown computeWorkerKind '{}'".format(computeWorkerKind)
+            raise ValueError(msg)
+        if numReadWorkers < 0 or numComputeWorkers < 0:
+            msg = "Number of workers cannot be negative"
+            raise ValueError(msg)
+        if computeWorkerKind == CW_NONE:
+            if numComputeWorkers > 0:
+                msg = "Compute workers need a computeWorkerKind other than CW_NONE"
+                raise ValueError(msg)
+            if computeWorkersRead:
+                msg = "computeWorkersRead needs compute workers"
+                raise ValueError(msg)
+        else:
+            if numComputeWorkers == 0:
+                msg = ("computeWorkerKind {} needs numComputeWorkers " +
+                    "greater than 0").format(computeWorkerKind)
+                raise ValueError(msg)
+            if not computeWorkersRead and numReadWorkers == 0:
+                msg = ("Compute workers need read workers, unless " +
+                    "computeWorkersRead is True")
+                raise ValueError(msg)
+
+
+class BlockBuffer(object):
+    """
+    Thread-safe buffer of complete blocks of data, passed from one set of
+    workers to another. For input ('read') buffers, each block is built up
+    from the arrays of the separate input files, given by the read workers,
+    and is complete when all files have been read. For output ('compute')
+    buffers, the compute workers insert whole blocks of outputs.
+
+    Complete blocks are taken out in the order in which they were
+    completed, which is not necessarily the order of the blocks in the
+    image.
+
+    The buffer holds a limited number of blocks (complete or not), so the
+    memory used stays bounded when the workers putting blocks in are
+    faster than those taking them out. Inserting a new block waits until
+    there is room, and taking one out waits until one is complete. If
+    either wait is longer than the corresponding timeout, a
+    :class:`rios.rioserrors.TimeoutError` is raised.
+
+    """
+    def __init__(self, filenameAssoc, numWorkers, insertTimeout, popTimeout,
+            bufferType):
+        self.filenameAssoc = filenameAssoc
+        self.numFiles = len(filenameAssoc)
+        self.maxBlocks = max(2 * numWorkers, 2)
+        self.insertTimeout = insertTimeout
+        self.popTimeout = popTimeout
+        self.bufferType = bufferType
+
+        self.condition = threading.Condition()
+        # Keyed by ApplierBlockDefn, values are [BlockAssociations, count]
+        self.incomplete = {}
+        # List of (ApplierBlockDefn, BlockAssociations)
+        self.complete = []
+
+    def _numBlocks(self):
+        return len(self.incomplete) + len(self.complete)
+
+    def _waitForSpace(self):
+        """
+        Wait until there is room for another block. Must be called with
+        the condition held.
+        """
+        hasSpace = self.condition.wait_for(
+            lambda: self._numBlocks() < self.maxBlocks, self.insertTimeout)
+        if not hasSpace:
+            msg = "Timeout inserting into {} buffer".format(self.bufferType)
+            raise rioserrors.TimeoutError(msg)
+
+    def addBlockData(self, blockDefn, symbolicName, seqNum, arr):
+        """
+        Add the array for the given block of one input file. When all
+        files have been added for that block, it becomes complete.
+        """
+        with self.condition:
+            if blockDefn not in self.incomplete:
+                self._waitForSpace()
+                self.incomplete[blockDefn] = [
+                    BlockAssociations(self.filenameAssoc), 0]
+
+            blockData = self.incomplete[blockDefn]
+            blockData[0][symbolicName, seqNum] = arr
+            blockData[1] += 1
+            if blockData[1] == self.numFiles:
+                del self.incomplete[blockDefn]
+                self.complete.append((blockDefn, blockData[0]))
+                self.condition.notify_all()
+
+    def insertCompleteBlock(self, blockDefn, blockData):
+        """
+        Insert a whole block of data, as a BlockAssociations object
+        """
+        with self.condition:
+            self._waitForSpace()
+            self.complete.append((blockDefn, blockData))
+            self.condition.notify_all()
+
+    def popNextBlock(self):
+        """
+        Take the next complete block out of the buffer, waiting for one
+        if necessary. Returns a tuple of (blockDefn, blockData), where
+        blockData is a BlockAssociations object.
+        """
+        with self.condition:
+            hasBlock = self.condition.wait_for(lambda: len(self.complete) > 0,
+                self.popTimeout)
+            if not hasBlock:
+                msg = "Timeout popping from {} buffer".format(self.bufferType)
+                raise rioserrors.TimeoutError(msg)
+
+            (blockDefn, blockData) = self.complete.pop(0)
+            self.condition.notify_all()
+        return (blockDefn, blockData)
+
+
+class Timers(object):
+    """
+    Manage multiple named timers, recording the start and end time of
+    each interval timed. The intervals can be timed from several threads
+    at once.
+
+    Use as::
+
+        timings = Timers()
+        with timings.interval('reading'):
+            ...
+
+    """
+    def __init__(self):
+        self.pairs = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def interval(self, intervalName):
+        """
+        Context manager to time the enclosed block of code, under
+        the given name
+        """
+        startTime = time.time()
+        try:
+            yield
+        finally:
+            endTime = time.time()
+            with self.lock:
+                self.pairs.setdefault(intervalName, []).append(
+                    (startTime, endTime))
+
+    def getDurationsForName(self, intervalName):
+        """
+        Return a list of the durations of all intervals with the given
+        name, or None if there are none
+        """
+        with self.lock:
+            pairs = self.pairs.get(intervalName)
+            if pairs is None:
+                return None
+            return [(endTime - startTime) for (startTime, endTime) in pairs]
+
+    def merge(self, other):
+        """
+        Merge the intervals of another Timers object into this one
+        """
+        with other.lock:
+            otherPairs = {name: list(pairs)
+                for (name, pairs) in other.pairs.items()}
+        with self.lock:
+            for (name, pairs) in otherPairs.items():
+                self.pairs.setdefault(name, []).extend(pairs)
+
+    def makeSummaryDict(self):
+        """
+        Return a dictionary, keyed by interval name, of the total
+        duration (in seconds) of each named interval. When the intervals
+        overlap (e.g. timed in different workers), they are each counted.
+        """
+        summary = {}
+        with self.lock:
+            for (name, pairs) in self.pairs.items():
+                summary[name] = sum([(endTime - startTime)
+                    for (startTime, endTime) in pairs])
+        return summary
+
+    def formatReport(self, level=0):
+        """
+        Return a string of the summary of the timings, one line per name
+        """
+        summary = self.makeSummaryDict()
+        indent = ' ' * level
+        lines = []
+        for name in sorted(summary):
+            lines.append("{}{:25s} {:10.2f}".format(indent, name,
+                summary[name]))
+        return '\n'.join(lines)
+
+    def __getstate__(self):
+        # The lock cannot be pickled
+        with self.lock:
+            return {'pairs': self.pairs}
+
+    def __setstate__(self, state):
+        self.pairs = state['pairs']
+        self.lock = threading.Lock()
+
+
+class TempfileManager(object):
+    """
+    Make temporary files, in a directory of their own inside the given
+    tempdir. The directory, and all files in it, are removed when the
+    manager is cleaned up, or deleted.
+
+    The directory is only created when the first file is made.
+
+    """
+    def __init__(self, tempdir):
+        self.tempdir = tempdir
+        self.subdir = None
+        self.lock = threading.Lock()
+
+    def mktempfile(self, prefix=None, suffix=None):
+        """
+        Make a new temporary file, and return its name. The file is
+        created empty.
+        """
+        with self.lock:
+            if self.subdir is None:
+                self.subdir = tempfile.mkdtemp(prefix='rios_',
+                    dir=self.tempdir)
+            (fd, filename) = tempfile.mkstemp(prefix=prefix, suffix=suffix,
+                dir=self.subdir)
+        os.close(fd)
+        return filename
+
+    def cleanup(self):
+        """
+        Remove all the temporary files
+        """
+        with self.lock:
+            if self.subdir is not None:
+                shutil.rmtree(self.subdir, ignore_errors=True)
+                self.subdir = None
+
+    def __del__(self):
+        "Destructor"
+        self.cleanup()
+
+
+class RasterizationMgr(object):
+    """
+    Rasterize vector input files, once only for each file, even when
+    requested from several read workers. The rasterized files are
+    temporary files, made with the given TempfileManager.
+
+    """
+    def __init__(self):
+        self.rasterizedFiles = {}
+        self.lock = threading.Lock()
+
+    def rasterize(self, vectorfile, rasterizeOptions, tmpfileMgr):
+        """
+        Rasterize the given vector file, with the given
+        gdal.RasterizeOptions object. Return the name of the rasterized
+        file.
+        """
+        with self.lock:
+            if vectorfile not in self.rasterizedFiles:
+                tmpraster = tmpfileMgr.mktempfile(prefix='rios_vecrast_',
+                    suffix='.tif')
+                try:
+                    ds = gdal.Rasterize(tmpraster, vectorfile,
+                        options=rasterizeOptions)
+                except RuntimeError as e:
+                    msg = "Failed to rasterize '{}': {}".format(vectorfile, e)
+                    raise rioserrors.VectorRasterizationError(msg)
+                if ds is None:
+                    msg = "Failed to rasterize '{}'".format(vectorfile)
+                    raise rioserrors.VectorRasterizationError(msg)
+                # Close the file
+                del ds
+                self.rasterizedFiles[vectorfile] = tmpraster
+            return self.rasterizedFiles[vectorfile]
+
+
+class WorkerErrorRecord(object):
+    """
+    Record of an exception raised in a worker, with its traceback, so it
+    can be reported from the main thread.
+
+    The workerType is one of 'read', 'compute' or 'main'.
+
+    """
+    def __init__(self, exc, workerType, workerID=None):
+        self.exc = exc
+        self.workerType = workerType
+        self.workerID = workerID
+        self.formattedTraceback = traceback.format_exception(type(exc), exc,
+            exc.__traceback__)
+
+    def __str__(self):
+        header = "Error in {} worker".format(self.workerType)
+        if self.workerID is not None:
+            header += " {}".format(self.workerID)
+        lines = [header]
+        lines.extend([line.rstrip('\n') for line in self.formattedTraceback])
+        return '\n'.join(lines)
+
+
+class ApplierReturn(object):
+    """
+    Hold all the things returned by :func:`rios.applier.apply`.
+
+    Attributes are:
+        * **timings**        :class:`Timers` object, with the time spent in each part of the processing
+        * **otherArgsList**  List of the otherArgs objects, one for each compute worker (or just the given otherArgs)
+        * **singlePassMgr**  The :class:`rios.calcstats.SinglePassManager` used for the outputs
+        * **workinggrid**    :class:`rios.pixelgrid.PixelGridDefn` of the working grid
+
+    New in version 2.0
+
+    """
+    def __init__(self):
+        self.timings = None
+        self.otherArgsList = None
+        self.singlePassMgr = None
+        self.workinggrid = None
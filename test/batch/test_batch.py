@@ -0,0 +1,112 @@
+import json
+import os
+import shutil
+
+import pytest
+
+MTL_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "mtl",
+                        "LC08_L1TP_007059_20161115_20170318_01_T2_MTL.txt")
+
+
+class FakeMaskingResult:
+    """Record the filters applied by the recipe, as the CloudMaskingResult"""
+
+    def __init__(self, mtl_path, landsat_version=8, collection=1, processing_level="L1TP"):
+        self.mtl_path = str(mtl_path)
+        self.landsat_version = landsat_version
+        self.collection = collection
+        self.mtl_file = {"PROCESSING_LEVEL": processing_level,
+                         "FILE_NAME_BAND_1": "LC08_L1TP_007059_20161115_20170318_01_T2_B1.TIF",
+                         "FILE_NAME_BAND_QUALITY": "LC08_L1TP_007059_20161115_20170318_01_T2_BQA.TIF",
+                         "FILE_NAME_QUALITY_L1_PIXEL": "LC08_L1TP_007059_20161115_20170318_02_T2_QA_PIXEL.TIF"}
+        self.calls = []
+
+    def __getattr__(self, name):
+        if not name.startswith("do_"):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self.calls.append((name, args, kwargs))
+
+
+def write_recipe(file_path, recipe):
+    with open(file_path, 'w') as f:
+        json.dump(recipe, f)
+    return str(file_path)
+
+
+def test_load_recipe(tmp_path, plugin_package):
+    from CloudMasking.core.batch import load_recipe
+
+    recipe = {"fmask": {"cloud_prob_thresh": 0.225}, "blue_band": {"threshold": 14000}, "qaband_c2": {}}
+    assert load_recipe(write_recipe(tmp_path / "recipe.json", recipe)) == recipe
+
+    with pytest.raises(ValueError, match="No filters enabled"):
+        load_recipe(write_recipe(tmp_path / "empty.json", {}))
+
+    with pytest.raises(ValueError, match="Unknown filters in the recipe: cirrus, thermal"):
+        load_recipe(write_recipe(tmp_path / "unknown.json", {"fmask": {}, "cirrus": {}, "thermal": {}}))
+
+
+def test_apply_recipe(tmp_path, plugin_package):
+    from CloudMasking.core.batch import apply_recipe
+
+    masking_result = FakeMaskingResult(tmp_path / "LC08_L1TP_007059_20161115_20170318_01_T2_MTL.txt")
+    aerosol_file = str(tmp_path / "LC08_L1TP_007059_20161115_20170318_01_T2_sr_aerosol.tif")
+    open(aerosol_file, 'w').close()
+
+    # applied in the blending order, not in the order of the recipe
+    recipe = {"qaband_c2": {}, "aerosol": {"checked_items": {"Cloud": True}, "specific_values": ["2", 8]},
+              "cloud_qa": {}, "blue_band": {}, "fmask": {"cloud_buffer_size": 4}}
+    skipped = apply_recipe(masking_result, recipe)
+
+    # the QA filters that not apply for a Landsat 8 of the collection 1
+    assert skipped == ["cloud_qa", "qaband_c2"]
+    assert [name for (name, _, _) in masking_result.calls] == ["do_fmask", "do_blue_band", "do_aerosol_l89"]
+    (_, _, fmask_params) = masking_result.calls[0]
+    assert fmask_params["cloud_buffer_size"] == 4
+    assert dict(fmask_params["filters_enabled"]) == {"Fmask Cloud": True, "Fmask Shadow": True,
+                                                     "Fmask Snow": True, "Fmask Water": False}
+    assert fmask_params["filters_enabled"]["Fmask Cirrus"] is False
+    assert masking_result.calls[1][1] == (14000,)
+    assert masking_result.calls[2][1] == (aerosol_file, {"Cloud": True}, [2, 8])
+
+    # the default threshold of the blue band for Landsat 7
+    masking_result = FakeMaskingResult(masking_result.mtl_path, landsat_version=7)
+    assert apply_recipe(masking_result, {"blue_band": {}}) == []
+    assert masking_result.calls == [("do_blue_band", (110,), {})]
+
+
+def test_apply_recipe_qa_file_not_exists(tmp_path, plugin_package):
+    from CloudMasking.core.batch import apply_recipe
+
+    masking_result = FakeMaskingResult(tmp_path / "LC08_L1TP_007059_20161115_20170318_01_T2_MTL.txt")
+    with pytest.raises(FileNotFoundError, match="The QA file for the pixel_qa filter not exists"):
+        apply_recipe(masking_result, {"pixel_qa": {}})
+    assert masking_result.calls == []
+
+
+def test_process_scene_task_error(tmp_path, plugin_package):
+    from CloudMasking.core.batch import process_scene_task
+
+    mtl_path = shutil.copy(MTL_FILE, str(tmp_path))
+    output_dir = tmp_path / "output"
+    output_dir.mkdir()
+    tmp_dir = tmp_path / "tmp"
+    tmp_dir.mkdir()
+
+    # the scene is of the collection 1, the only filter of the recipe not apply,
+    # the error is reported in the result instead of raised
+    result = process_scene_task((mtl_path, {"qaband_c2": {}}, str(output_dir), str(tmp_dir)))
+    assert result["mtl_path"] == mtl_path
+    assert result["output_file"] is None
+    assert result["skipped"] == []
+    assert result["error"].startswith("Traceback")
+    assert "ValueError: None of the filters in the recipe apply for this scene" in result["error"]
+    # without the temporal dir of the scene, nor the output mask
+    assert os.listdir(str(tmp_dir)) == []
+    assert os.listdir(str(output_dir)) == []
+
+    # the MTL file not exists
+    result = process_scene_task((str(tmp_path / "missing_MTL.txt"), {"fmask": {}}, str(output_dir), str(tmp_dir)))
+    assert result["output_file"] is None
+    assert "missing_MTL.txt" in result["error"]
+    assert os.listdir(str(tmp_dir)) == []
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ CloudMasking Benchmark
+                                 A QGIS plugin
+ Cloud masking for landsat products using different process suck as fmask
+                             -------------------
+        copyright            : (C) 2016-2022 by Xavier Corredor Llano, SMByC
+        email                : xcorredorl@ideam.gov.co
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 3 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy
+
+# from plugins
+from CloudMasking import fmask_libs
+from CloudMasking.test.conftest import make_surface, fill_tiled
+
+
+def run(size, tile_size, num_workers, seed=0):
+    fmask_libs()
+    from CloudMasking.libs.fmask import fillminima
+
+    surface = make_surface(size, seed)
+    boundary_val = float(numpy.percentile(surface[surface != 0], 17.5))
+    print("Surface of {0}x{0} pixels, tiles of {1} pixels, {2} workers".format(size, tile_size, num_workers))
+
+    start = time.time()
+    filled = fillminima.fillMinima(surface, 0, boundary_val)
+    whole_time = time.time() - start
+    print("  whole image:        {:8.2f} s".format(whole_time))
+
+    results = []
+    for (name, workers) in (("tiled, serial", 1), ("tiled, processes", num_workers)):
+        if workers <= 1 and results:
+            continue
+        start = time.time()
+        tiled = fill_tiled(fillminima, surface, boundary_val, tile_size, workers)
+        elapsed = time.time() - start
+        results.append(elapsed)
+        print("  {:19s} {:8.2f} s  speedup {:5.2f} (vs whole {:5.2f})  {}".format(
+            name + ":", elapsed, results[0] / elapsed, whole_time / elapsed,
+            "same" if numpy.array_equal(tiled, filled) else "DIFFERENT"))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m CloudMasking.test.benchmarks.benchmark_fillminima",
+        description="Benchmark the filling of the local minima of Fmask (whole image, and tiled "
+                    "in serial and in a pool of processes) on a synthetic DEM-like surface")
+    parser.add_argument("--size", type=int, default=4000, help="size of the surface in pixels (default 4000)")
+    parser.add_argument("--tile-size", type=int, default=1000, help="size of the tiles in pixels (default 1000)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="number of parallel workers (default the number of CPUs)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random surface")
+    args = parser.parse_args(argv)
+
+    run(args.size, args.tile_size, args.workers, args.seed)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ CloudMasking Benchmark
+                                 A QGIS plugin
+ Cloud masking for landsat products using different process suck as fmask
+                             -------------------
+        copyright            : (C) 2016-2022 by Xavier Corredor Llano, SMByC
+        email                : xcorredorl@ideam.gov.co
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 3 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import argparse
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+import numpy
+
+# from plugins
+from CloudMasking import fmask_libs
+from CloudMasking.test.conftest import PASS1_LAYERS, make_block, make_otherargs, first_pass_float64, \
+    unpack_pass1
+
+
+def run_kernel(kernel, inputs, otherargs, repeats):
+    """Time per block (s) and peak allocated memory (bytes) of the kernel, and its outputs"""
+    outputs = SimpleNamespace()
+    # the first run allocates the scratch buffers
+    kernel(inputs, outputs, otherargs)
+    start = time.time()
+    for _ in range(repeats):
+        kernel(inputs, SimpleNamespace(), otherargs)
+    block_time = (time.time() - start) / repeats
+
+    tracemalloc.start()
+    kernel(inputs, SimpleNamespace(), otherargs)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return block_time, peak, outputs
+
+
+def run(size, repeats, seed=0):
+    fmask_libs()
+    from CloudMasking.libs.fmask import fmask, config
+
+    inputs = make_block(size, seed)
+    print("Block of {0}x{0} pixels, {1} repeats, numexpr {2}".format(
+        size, repeats, "yes" if fmask.numexpr is not None else "no"))
+
+    results = {}
+    for (name, kernel) in (
+            ("float64", lambda inputs, outputs, otherargs: first_pass_float64(fmask, config, inputs, outputs, otherargs)),
+            ("float32", lambda inputs, outputs, otherargs: fmask.potentialCloudFirstPass(None, inputs, outputs, otherargs))):
+        otherargs = make_otherargs(fmask, config)
+        block_time, peak, outputs = run_kernel(kernel, inputs, otherargs, repeats)
+        results[name] = (outputs, otherargs)
+        print("  {:8s} {:8.1f} ms/block  peak {:6.1f} MB".format(name + ":", block_time * 1000, peak / 2 ** 20))
+
+    (old_outputs, old_otherargs) = results["float64"]
+    (new_outputs, new_otherargs) = results["float32"]
+    new_pass1 = unpack_pass1(fmask, new_outputs.pass1)
+    for (idx, layer) in enumerate(PASS1_LAYERS):
+        diff = numpy.abs(old_outputs.pass1[idx].astype(int) - new_pass1[idx]).max()
+        print("  {:18s} {}".format(layer + ":", "same" if diff == 0 else "max difference {}".format(diff)))
+    for name in ("waterBT_hist", "clearLandBT_hist", "clearLandB4_hist", "nonNullCount"):
+        same = numpy.array_equal(getattr(old_otherargs, name), getattr(new_otherargs, name))
+        print("  {:18s} {}".format(name + ":", "same" if same else "DIFFERENT"))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m CloudMasking.test.benchmarks.benchmark_first_pass",
+        description="Benchmark the kernel of the first pass of Fmask by RIOS block, against the "
+                    "previous float64 kernel, on a synthetic Landsat 8 OLI block")
+    parser.add_argument("--size", type=int, default=512, help="size of the block in pixels (default 512)")
+    parser.add_argument("--repeats", type=int, default=20, help="number of runs timed (default 20)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random block")
+    args = parser.parse_args(argv)
+
+    run(args.size, args.repeats, args.seed)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ CloudMasking Benchmark
+                                 A QGIS plugin
+ Cloud masking for landsat products using different process suck as fmask
+                             -------------------
+        copyright            : (C) 2016-2022 by Xavier Corredor Llano, SMByC
+        email                : xcorredorl@ideam.gov.co
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 3 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import argparse
+import sys
+import time
+import tracemalloc
+
+import numpy
+from osgeo import gdal
+
+# from plugins
+from CloudMasking import fmask_libs
+
+
+def make_clouds(size, num_clouds, seed=0):
+    """
+    Synthetic 3d clouds of a scene of size x size pixels: the clumps of the
+    clouds (uint32) and their height above the cloud base (uint8, in units of
+    100 m as the Fmask cloud shape). Most clouds are domes of several sizes,
+    and some are thin diagonal streaks, sparse in their bounding box
+    """
+    rng = numpy.random.default_rng(seed)
+    clumps = numpy.zeros((size, size), dtype=numpy.uint32)
+    cloud_shape = numpy.zeros((size, size), dtype=numpy.uint8)
+    for cloud_id in range(1, num_clouds + 1):
+        if cloud_id % 5 == 0:
+            # streak
+            length = int(rng.integers(size // 20, size // 4))
+            row, col = rng.integers(0, size - length, size=2)
+            steps = numpy.arange(length)
+            rows, cols = row + steps, col + steps
+            for width in range(3):
+                clumps[rows, numpy.minimum(cols + width, size - 1)] = cloud_id
+                cloud_shape[rows, numpy.minimum(cols + width, size - 1)] = rng.integers(5, 40)
+            continue
+        radius = int(rng.integers(10, size // 15))
+        row, col = rng.integers(radius, size - radius, size=2)
+        (rows, cols) = numpy.ogrid[-radius:radius + 1, -radius:radius + 1]
+        dome = 1 - (rows ** 2 + cols ** 2) / radius ** 2
+        inside = dome > 0
+        window = (slice(row - radius, row + radius + 1), slice(col - radius, col + radius + 1))
+        clumps[window][inside] = cloud_id
+        cloud_shape[window][inside] = numpy.round(dome[inside] * rng.integers(10, 60))
+    return clumps, cloud_shape
+
+
+def make_toa_ref(size):
+    """Empty TOA reflectance file of size x size pixels of 30 m, for its pixel grid"""
+    toa_ref = "/vsimem/benchmark_shadow_shapes_toa.tif"
+    ds = gdal.GetDriverByName("GTiff").Create(toa_ref, size, size, 1, gdal.GDT_Byte, ["SPARSE_OK=TRUE"])
+    ds.SetGeoTransform([500000, 30, 0, 100000, 0, -30])
+    ds = None
+    return toa_ref
+
+
+def shapes_memory(shadow_shapes):
+    """Bytes of the shadow indexes kept in the shadow shapes dictionary, and their number"""
+    num_bytes = num_indexes = 0
+    for (shadow_ndx, _, _, _, _) in shadow_shapes.values():
+        num_bytes += shadow_ndx[0].nbytes + shadow_ndx[1].nbytes
+        num_indexes += len(shadow_ndx[0])
+    return num_bytes, num_indexes
+
+
+def run(size, num_clouds, repeats, seed=0):
+    fmask_libs()
+    from CloudMasking.libs.fmask import fmask, config, valueindexes
+
+    clumps, cloud_shape = make_clouds(size, num_clouds, seed)
+    cloud_clump_ndx = valueindexes.ValueIndexes(clumps, nullVals=[0])
+    fmask_filenames = config.FmaskFilenames(make_toa_ref(size))
+    fmask_config = config.FmaskConfig(config.FMASK_LANDSAT8)
+    fmask_config.setAnglesInfo(config.AngleConstantInfo(0.6, 2.5, 0.05, 1.8))
+    print("Scene of {0}x{0} pixels, {1} clouds of {2} pixels".format(
+        size, len(cloud_clump_ndx.values), cloud_clump_ndx.counts.sum()))
+
+    unique_indexes = fmask.uniqueIndexes
+    results = {}
+    for (name, dedup, dedup_func) in (("no dedup", False, unique_indexes),
+                                      ("dedup dense", True, unique_indexes),
+                                      ("dedup all", True,
+                                       lambda rows, cols, denseOnly=False: unique_indexes(rows, cols))):
+        fmask_config.setDedupShadowShapes(dedup)
+        fmask.uniqueIndexes = dedup_func
+        try:
+            elapsed = numpy.inf
+            for _ in range(repeats):
+                start = time.time()
+                shadow_shapes = fmask.makeCloudShadowShapes(fmask_filenames, fmask_config, cloud_shape,
+                                                            cloud_clump_ndx)
+                elapsed = min(elapsed, time.time() - start)
+            tracemalloc.start()
+            fmask.makeCloudShadowShapes(fmask_filenames, fmask_config, cloud_shape, cloud_clump_ndx)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        finally:
+            fmask.uniqueIndexes = unique_indexes
+        results[name] = shadow_shapes
+        num_bytes, num_indexes = shapes_memory(shadow_shapes)
+        print("  {:12s} {:8.3f} s  shapes {:7.1f} MB ({} indexes)  peak {:7.1f} MB".format(
+            name + ":", elapsed, num_bytes / 2 ** 20, num_indexes, peak / 2 ** 20))
+
+    # the same shadow shapes, without their duplicates
+    same = all(numpy.array_equal(numpy.array(unique_indexes(*results["no dedup"][cloud_id][0])),
+                                 numpy.array(unique_indexes(*results[name][cloud_id][0])))
+               for name in ("dedup dense", "dedup all") for cloud_id in results["no dedup"])
+    print("  shapes:      {}".format("same" if same else "DIFFERENT"))
+    gdal.Unlink(fmask_filenames.toaRef)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m CloudMasking.test.benchmarks.benchmark_shadow_shapes",
+        description="Benchmark the cloud shadow shapes of Fmask without and with the removal of "
+                    "the duplicated shadow indexes, on synthetic 3d clouds")
+    parser.add_argument("--size", type=int, default=7000, help="size of the scene in pixels (default 7000)")
+    parser.add_argument("--clouds", type=int, default=200, help="number of clouds (default 200)")
+    parser.add_argument("--repeats", type=int, default=3, help="number of runs, the fastest is reported (default 3)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random clouds")
+    args = parser.parse_args(argv)
+
+    run(args.size, args.clouds, args.repeats, args.seed)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,118 @@
+import os
+import time
+
+
+def make_file(file_path, size):
+    with open(file_path, "wb") as f:
+        f.write(b"0" * size)
+    return file_path
+
+
+def test_cache_key_and_reuse(tmp_path):
+    from core.cache import ProductsCache
+
+    cache = ProductsCache(str(tmp_path / "cache"), max_size=1)
+    band = make_file(str(tmp_path / "band.tif"), 10)
+
+    key = cache.key("toa", "LC08", [band], clip=None, params={"sensor": 1})
+    assert key == cache.key("toa", "LC08", [band], clip=None, params={"sensor": 1})
+    assert key != cache.key("toa", "LC08", [band], clip={"geometries": ["POINT (0 0)"]}, params={"sensor": 1})
+    assert key != cache.key("angles", "LC08", [band], clip=None, params={"sensor": 1})
+    assert cache.get(key) is None
+
+    product = make_file(str(tmp_path / "toa.tif"), 100)
+    cached_file = cache.put(key, product)
+    assert not os.path.exists(product)
+    assert cache.contains(cached_file)
+    assert cache.get(key) == cached_file
+
+    # the input file changed
+    make_file(band, 20)
+    assert cache.key("toa", "LC08", [band], clip=None, params={"sensor": 1}) != key
+
+
+def test_cache_lru_eviction(tmp_path):
+    from core.cache import ProductsCache
+
+    cache = ProductsCache(str(tmp_path / "cache"), max_size=1)
+    band = make_file(str(tmp_path / "band.tif"), 10)
+    half_mb = 512 * 1024
+
+    keys = [cache.key("stage_{}".format(n), "LC08", [band]) for n in range(3)]
+    for n, key in enumerate(keys[:2]):
+        cache.put(key, make_file(str(tmp_path / "product_{}.tif".format(n)), half_mb))
+        time.sleep(0.01)
+    cache.release()
+    # the first product is used again, the second is the least recently used
+    time.sleep(0.01)
+    cache.get(keys[0])
+    cache.put(keys[2], make_file(str(tmp_path / "product_2.tif"), half_mb))
+
+    assert cache.get(keys[0]) is not None
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[2]) is not None
+    assert cache.size() <= 1024 * 1024
+
+
+def test_toa_not_made_when_cached(tmp_path, monkeypatch, fmask_libs):
+    from CloudMasking.core import cloud_filters
+    from CloudMasking.core.cache import ProductsCache
+    from CloudMasking.core.cloud_filters import CloudMaskingResult
+
+    # the products are written by fakes, recording the files made
+    made = []
+
+    def make_toa_reflectance(infile, mtlFile, anglesfile, outfile, anglesModel=None, saturationMaskFile=None,
+                             fmaskConfig=None):
+        for file_path in (outfile, saturationMaskFile):
+            if file_path is not None:
+                made.append(os.path.basename(file_path))
+                make_file(file_path, 10)
+
+    def make_saturation_mask(fmaskConfig, radiancefile, outMask):
+        made.append(os.path.basename(outMask))
+        make_file(outMask, 10)
+
+    monkeypatch.setattr(cloud_filters.landsatTOA, "makeTOAReflectance", make_toa_reflectance)
+    monkeypatch.setattr(cloud_filters.saturationcheck, "makeSaturationMask", make_saturation_mask)
+    monkeypatch.setattr(cloud_filters, "update_process_bar", lambda *args: None)
+
+    tmp_dir = tmp_path / "tmp"
+    tmp_dir.mkdir()
+    band = make_file(str(tmp_path / "band.tif"), 10)
+    masking_result = CloudMaskingResult.__new__(CloudMaskingResult)
+    masking_result.products_cache = ProductsCache(str(tmp_path / "cache"))
+    masking_result.session_products = {}
+    (masking_result.tmp_dir, masking_result.landsat_scene) = (str(tmp_dir), "LC08")
+    (masking_result.reflective_stack_for_process, masking_result.mtl_path) = (band, None)
+    (masking_result.angles_model, masking_result.process_bar, masking_result.process_status) = (None, None, None)
+    masking_result.fmask_config = lambda sensor: None
+    masking_result.tr = lambda text: text
+
+    def run(clip=None):
+        del made[:]
+        masking_result.make_saturation_and_toa(1, [band], clip, {"preview_factor": None})
+        return sorted(made)
+
+    # both in one pass, then both from the cache
+    assert run() == ["saturationmask.tif", "toa.tif"]
+    assert masking_result.products_cache.contains(masking_result.toa_file)
+    assert masking_result.products_cache.contains(masking_result.saturationmask_file)
+    assert run() == []
+
+    # only the saturation mask is made when the TOA is in the cache, no TOA
+    # is left in the tmp dir
+    os.remove(masking_result.saturationmask_file)
+    assert run() == ["saturationmask.tif"]
+    assert os.listdir(str(tmp_dir)) == []
+    # and the TOA alone
+    os.remove(masking_result.toa_file)
+    assert run() == ["toa.tif"]
+    assert os.listdir(str(tmp_dir)) == []
+
+    # without cache, the products of the previous run are reused
+    masking_result.products_cache = None
+    assert run(clip={"aoi": True}) == ["saturationmask.tif", "toa.tif"]
+    os.remove(masking_result.saturationmask_file)
+    assert run(clip={"aoi": True}) == ["saturationmask.tif"]
+    assert masking_result.toa_file == str(tmp_dir / "toa.tif")
@@ -1,5 +1,8 @@
 import os
 import sys
+from types import SimpleNamespace
+
+import numpy
 import pytest
 
 
@@ -24,3 +27,214 @@ def init_qgis(set_qgis_in_pythonpath):
     from .qgis_interface import QgisInterface
     iface = QgisInterface(None)
     return iface
+
+
+@pytest.fixture(scope="session")
+def plugin_package(set_project_in_pythonpath):
+    # the plugin package (CloudMasking), from the dir of the plugins
+    project_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    plugins_dir = os.path.dirname(project_dir)
+    if plugins_dir not in sys.path:
+        sys.path.append(plugins_dir)
+
+
+@pytest.fixture(scope="session")
+def fmask_libs(plugin_package):
+    # the binary libs of fmask, and the vendored fmask and rios libs as the
+    # plugin imports them
+    from CloudMasking import fmask_libs
+    fmask_libs()
+    project_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    libs_dir = os.path.join(project_dir, "libs")
+    if libs_dir not in sys.path:
+        sys.path.append(libs_dir)
+
+
+# synthetic data and reference kernels shared by the tests and the benchmarks
+# (test/benchmarks) of fmask
+
+# layers of the pass1 output of the float64 kernel
+PASS1_LAYERS = ["pcp", "waterTest", "clearLand", "variabilityProb", "nullmask", "snowmask",
+                "refNullmask", "thermNullmask"]
+
+
+def make_block(size, seed=0):
+    """
+    Synthetic inputs of a RIOS block of size x size pixels of a Landsat 8 OLI
+    scene: the TOA reflectance (scaled by 10000), the thermal and the
+    saturation mask, with a null corner
+    """
+    rng = numpy.random.default_rng(seed)
+    toaref = rng.integers(-100, 6000, (8, size, size)).astype(numpy.int16)
+    toaref[:, :size // 25, :size // 25] = 0
+    thermal = rng.integers(20000, 35000, (2, size, size)).astype(numpy.int16)
+    saturation = (rng.random((3, size, size)) < 0.05).astype(numpy.uint8)
+    return SimpleNamespace(toaref=toaref, thermal=thermal, saturationMask=saturation)
+
+
+def make_otherargs(fmask, config):
+    """The otherargs of the first pass for a Landsat 8 OLI scene"""
+    fmaskConfig = config.FmaskConfig(config.FMASK_LANDSATOLI)
+    fmaskConfig.setThermalInfo(config.ThermalFileInfo(0, 0.0003342, 0.1, 774.8853, 1321.0789))
+    return SimpleNamespace(
+        fmaskConfig=fmaskConfig, refBands=fmaskConfig.bands, thermalInfo=fmaskConfig.thermalInfo,
+        refNull=0, thermalNull=0, bandsForRefNull=numpy.arange(7),
+        waterBT_hist=numpy.zeros(fmask.BT_HISTSIZE, dtype=numpy.uint32),
+        clearLandBT_hist=numpy.zeros(fmask.BT_HISTSIZE, dtype=numpy.uint32),
+        clearLandB4_hist=numpy.zeros(fmask.BT_HISTSIZE, dtype=numpy.uint32),
+        nonNullCount=0, scratch=fmask.ScratchBuffers())
+
+
+def first_pass_float64(fmask, config, inputs, outputs, otherargs):
+    """
+    The previous kernel of the first pass of Fmask (fmask.potentialCloudFirstPass),
+    with the whiteness and the variability probability in float64, new arrays
+    for every temporary, and the layers as a stack of 8 bytes layers (see
+    PASS1_LAYERS). Without the Sentinel-2 displacement test
+    """
+    fmaskConfig = otherargs.fmaskConfig
+
+    ref = fmask.refDNtoUnits(inputs.toaref, fmaskConfig)
+    ref[ref <= 0] = 0.00001
+
+    blue = otherargs.refBands[config.BAND_BLUE]
+    green = otherargs.refBands[config.BAND_GREEN]
+    red = otherargs.refBands[config.BAND_RED]
+    nir = otherargs.refBands[config.BAND_NIR]
+    swir1 = otherargs.refBands[config.BAND_SWIR1]
+    swir2 = otherargs.refBands[config.BAND_SWIR2]
+    if hasattr(inputs, 'thermal'):
+        THERM = otherargs.thermalInfo.thermalBand1040um
+
+    refNullmask = (inputs.toaref[otherargs.bandsForRefNull] == otherargs.refNull).any(axis=0)
+    if hasattr(inputs, 'thermal'):
+        thermNullmask = (inputs.thermal[THERM] == otherargs.thermalNull)
+        nullmask = (refNullmask | thermNullmask)
+        bt = otherargs.thermalInfo.scaleThermalDNtoC(inputs.thermal)
+    else:
+        thermNullmask = numpy.zeros_like(ref[0], dtype=bool)
+        nullmask = refNullmask
+
+    # Equation 1
+    ndsi = (ref[green] - ref[swir1]) / (ref[green] + ref[swir1])
+    ndvi = (ref[nir] - ref[red]) / (ref[nir] + ref[red])
+    basicTest = (ref[swir2] > fmaskConfig.Eqn1Swir2Thresh) & (ndsi < 0.8) & (ndvi < 0.8)
+    if hasattr(inputs, 'thermal'):
+        basicTest = (basicTest & (bt < fmaskConfig.Eqn1ThermThresh))
+
+    # Equation 2
+    meanVis = (ref[blue] + ref[green] + ref[red]) / 3.0
+    whiteness = numpy.zeros(ref[0].shape)
+    for n in [blue, green, red]:
+        whiteness = whiteness + numpy.absolute((ref[n] - meanVis) / meanVis)
+    whitenessTest = (whiteness < fmaskConfig.Eqn2WhitenessThresh)
+
+    # Equation 3, 4 and 5
+    hazeTest = ((ref[blue] - 0.5 * ref[red] - 0.08) > 0)
+    b45test = ((ref[nir] / ref[swir1]) > 0.75)
+    waterTest = numpy.logical_or(
+        numpy.logical_and(ndvi < 0.01, ref[nir] < 0.11),
+        numpy.logical_and(ndvi < 0.1, ref[nir] < 0.05)
+    )
+    waterTest[nullmask] = False
+
+    if config.BAND_CIRRUS in otherargs.refBands:
+        cirrus = otherargs.refBands[config.BAND_CIRRUS]
+        cirrusBandTest = (ref[cirrus] > fmaskConfig.cirrusBandTestThresh)
+
+    # Equation 6
+    pcp = basicTest & whitenessTest & hazeTest & b45test
+    if config.BAND_CIRRUS in otherargs.refBands:
+        pcp = (pcp | cirrusBandTest)
+
+    if hasattr(inputs, 'saturationMask'):
+        saturatedVis = (inputs.saturationMask != 0).any(axis=0)
+        veryBright = (meanVis > 0.45)
+        saturatedAndBright = saturatedVis & veryBright
+        pcp[saturatedAndBright] = True
+        whiteness[saturatedAndBright] = 0
+
+    pcp[nullmask] = False
+
+    # Equation 7 and 12
+    clearSkyWater = numpy.logical_and(waterTest, ref[swir2] < fmaskConfig.Eqn7Swir2Thresh)
+    clearSkyWater[nullmask] = False
+    clearLand = numpy.logical_and(numpy.logical_not(pcp), numpy.logical_not(waterTest))
+    clearLand[nullmask] = False
+
+    # Equation 15
+    if hasattr(inputs, 'saturationMask'):
+        modNdvi = numpy.where((inputs.saturationMask[fmask.SATURATION_GREEN] != 0), 0, ndvi)
+        modNdsi = numpy.where((inputs.saturationMask[fmask.SATURATION_RED] != 0), 0, ndsi)
+    else:
+        modNdvi = ndvi
+        modNdsi = ndsi
+    maxNdx = numpy.absolute(modNdvi)
+    maxNdx = numpy.maximum(maxNdx, numpy.absolute(modNdsi))
+    maxNdx = numpy.maximum(maxNdx, whiteness)
+    variabilityProb = 1 - maxNdx
+    variabilityProb[nullmask] = 0
+    variabilityProbPcnt = numpy.round(variabilityProb * fmask.PROB_SCALE)
+    variabilityProbPcnt = variabilityProbPcnt.clip(fmask.BYTE_MIN, fmask.BYTE_MAX).astype(numpy.uint8)
+
+    # Equation 20
+    snowmask = ((ndsi > 0.15) & (ref[nir] > fmaskConfig.Eqn20NirSnowThresh) &
+        (ref[green] > fmaskConfig.Eqn20GreenSnowThresh))
+    if hasattr(inputs, 'thermal'):
+        snowmask = snowmask & (bt < fmaskConfig.Eqn20ThermThresh)
+    snowmask[nullmask] = False
+
+    outputs.pass1 = numpy.array([pcp, waterTest, clearLand, variabilityProbPcnt,
+        nullmask, snowmask, refNullmask, thermNullmask])
+
+    if hasattr(inputs, 'thermal'):
+        scaledBT = (bt + fmask.BT_OFFSET).clip(0, fmask.BT_HISTSIZE)
+        otherargs.waterBT_hist = fmask.accumHist(otherargs.waterBT_hist, scaledBT[clearSkyWater])
+        otherargs.clearLandBT_hist = fmask.accumHist(otherargs.clearLandBT_hist, scaledBT[clearLand])
+    scaledB4 = (ref[nir] * fmask.B4_SCALE).astype(numpy.uint8)
+    otherargs.clearLandB4_hist = fmask.accumHist(otherargs.clearLandB4_hist, scaledB4[clearLand])
+    otherargs.nonNullCount += numpy.count_nonzero(~nullmask)
+
+
+def unpack_pass1(fmask, pass1):
+    """The pass1 output of fmask.potentialCloudFirstPass as the 8 layers of the float64 kernel"""
+    flags = {"pcp": fmask.PASS1_PCP, "waterTest": fmask.PASS1_WATERTEST, "clearLand": fmask.PASS1_CLEARLAND,
+             "nullmask": fmask.PASS1_NULLMASK, "snowmask": fmask.PASS1_SNOWMASK,
+             "refNullmask": fmask.PASS1_REFNULLMASK, "thermNullmask": fmask.PASS1_THERMNULLMASK}
+    return numpy.array([pass1[fmask.PASS1_PROB_LAYER] if layer == "variabilityProb"
+                        else fmask.pass1Flag(pass1, flags[layer]) for layer in PASS1_LAYERS])
+
+
+def make_surface(size, seed=0):
+    """
+    Synthetic DEM-like surface (int16) of size x size pixels: a sum of noise
+    interpolated at several scales, inside a rotated swath with null (0)
+    corners as the Landsat scenes
+    """
+    from scipy.ndimage import zoom
+
+    rng = numpy.random.default_rng(seed)
+    surface = numpy.zeros((size, size), dtype=numpy.float32)
+    for scale in (8, 32, 128, 512):
+        noise = rng.random((size // scale + 2, size // scale + 2), dtype=numpy.float32)
+        surface += zoom(noise, scale, order=1)[:size, :size] * scale
+    surface = (surface / surface.max() * 4000 + 500).astype(numpy.int16)
+
+    (rows, cols) = numpy.mgrid[:size, :size]
+    margin = size // 5
+    swath = ((rows + cols >= margin) & (rows + cols < 2 * size - margin) &
+             (rows - cols < size - margin // 2) & (cols - rows < size - margin // 2))
+    surface[~swath] = 0
+    return surface
+
+
+def fill_tiled(fillminima, surface, boundary_val, tile_size, num_workers=1):
+    """Fill the minima of the surface in tiles, return the filled surface"""
+    def read_tile(row, col, num_rows, num_cols):
+        return surface[row:row + num_rows, col:col + num_cols].copy()
+
+    filled = numpy.zeros_like(surface)
+    for (row, col, _, tile_filled) in fillminima.fillMinimaTiled(
+            read_tile, surface.shape, 0, boundary_val, tile_size, num_workers):
+        filled[row:row + tile_filled.shape[0], col:col + tile_filled.shape[1]] = tile_filled
+    return filled
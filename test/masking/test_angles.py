@@ -0,0 +1,174 @@
+from types import SimpleNamespace
+
+import numpy
+import pytest
+
+GEOTRANSFORM = [500000, 30, 0, 100000, 0, -30]
+
+
+def make_clumps(size=150, num_clouds=40, seed=0):
+    """Clumps of clouds (discs) with one pixel clouds"""
+    rng = numpy.random.default_rng(seed)
+    (rows, cols) = numpy.mgrid[:size, :size]
+    clumps = numpy.zeros((size, size), dtype=numpy.uint32)
+    for cloud_id in range(1, num_clouds + 1):
+        radius = rng.integers(0, 12)
+        (row, col) = rng.integers(0, size, size=2)
+        clumps[numpy.hypot(rows - row, cols - col) <= radius] = cloud_id
+    clumps[0, 0] = num_clouds + 1
+    return clumps
+
+
+def make_img_info(size):
+    """Image info of the pixel grid of the clumps, in UTM 18N near 0.9N 75W"""
+    return SimpleNamespace(xMin=GEOTRANSFORM[0], xMax=GEOTRANSFORM[0] + size * GEOTRANSFORM[1],
+                           yMin=GEOTRANSFORM[3] + size * GEOTRANSFORM[5], yMax=GEOTRANSFORM[3],
+                           xRes=GEOTRANSFORM[1], yRes=-GEOTRANSFORM[5], nodataval=[0],
+                           getCorners=lambda outEPSG: (-75.0, 0.91, -74.96, 0.91, -74.96, 0.87, -75.0, 0.87))
+
+
+def model_angles_info(landsatangles, size):
+    img_info = make_img_info(size)
+    # a swath descending to the south-southwest, through the image
+    corners = numpy.array([[img_info.xMin + 1800, img_info.yMax], [img_info.xMax, img_info.yMax - 1200],
+                           [img_info.xMin, img_info.yMin + 900], [img_info.xMax - 1500, img_info.yMin]])
+    nadir_line = landsatangles.findNadirLine(corners)
+    extent_sun_angles = numpy.array([[2.1, 0.61], [2.12, 0.6], [2.09, 0.63], [2.11, 0.62]])
+    return landsatangles.LandsatAnglesModelInfo(img_info, nadir_line, extent_sun_angles,
+                                                landsatangles.satAzLeftRight(nadir_line))
+
+
+def per_cloud_angles(angles_info, value_indexes):
+    """The mean angles cloud by cloud, with the getters queried by makeCloudShadowShapes before"""
+    angles = ([], [], [], [])
+    for value in value_indexes.values:
+        indices = value_indexes.getIndexes(value)
+        angles[0].append(angles_info.getSolarZenithAngle(indices))
+        angles[1].append(angles_info.getSolarAzimuthAngle(indices))
+        angles[2].append(angles_info.getViewZenithAngle(indices))
+        angles[3].append(angles_info.getViewAzimuthAngle(indices))
+    return angles
+
+
+def make_angles_infos(config, landsatangles, size):
+    rng = numpy.random.default_rng(1)
+    file_info = config.AnglesFileInfo("angles.img", 3, "angles.img", 2, "angles.img", 1, "angles.img", 0)
+    # angles images as written by makeAnglesImage (radians * 100, int16)
+    (file_info.solarZenithData, file_info.solarAzimuthData, file_info.viewZenithData,
+     file_info.viewAzimuthData) = rng.integers(-314, 314, size=(4, size, size)).astype(numpy.int16)
+    constant_info = config.AngleConstantInfo(0.6, 2.1, 0.05, 1.8)
+    return [file_info, constant_info, model_angles_info(landsatangles, size)]
+
+
+@pytest.mark.parametrize("info_idx", [0, 1, 2])
+def test_mean_angles_same_as_per_cloud(fmask_libs, info_idx):
+    from CloudMasking.libs.fmask import config, landsatangles, valueindexes
+
+    clumps = make_clumps()
+    angles_info = make_angles_infos(config, landsatangles, clumps.shape[0])[info_idx]
+    for value_indexes in (valueindexes.ValueIndexes(clumps, nullVals=[0]),
+                          valueindexes.ValueIndexes(clumps, nullVals=[0], compact=True)):
+        mean_angles = angles_info.getMeanAngles(value_indexes)
+        expected = per_cloud_angles(angles_info, value_indexes)
+        assert len(mean_angles) == 4
+        for (angle, expected_angle) in zip(mean_angles, expected):
+            assert angle.dtype == numpy.float64
+            assert len(angle) == len(value_indexes.values)
+            numpy.testing.assert_allclose(angle, expected_angle, rtol=1e-12, atol=0)
+
+        # the default of the base class, value by value
+        default = config.AnglesInfo.getMeanAngles(angles_info, value_indexes)
+        for (angle, default_angle) in zip(mean_angles, default):
+            numpy.testing.assert_allclose(angle, default_angle, rtol=1e-12, atol=0)
+
+
+@pytest.mark.parametrize("info_idx", [0, 1, 2])
+def test_mean_angles_without_clouds(fmask_libs, info_idx):
+    from CloudMasking.libs.fmask import config, landsatangles, valueindexes
+
+    value_indexes = valueindexes.ValueIndexes(numpy.zeros((150, 150), dtype=numpy.uint32), nullVals=[0])
+    angles_info = make_angles_infos(config, landsatangles, 150)[info_idx]
+    for angle in angles_info.getMeanAngles(value_indexes):
+        assert angle.shape == (0,)
+
+
+def write_swath(file_path, nrows=700, ncols=600, angle=0.2):
+    """Synthetic image of two bands with a swath rotated by angle (radians), as
+    the Landsat scenes, with null (0) corners"""
+    from osgeo import gdal
+
+    (rows, cols) = numpy.mgrid[:nrows, :ncols]
+    (drow, dcol) = (rows - nrows / 2, cols - ncols / 2)
+    across = dcol * numpy.cos(angle) - drow * numpy.sin(angle)
+    along = dcol * numpy.sin(angle) + drow * numpy.cos(angle)
+    swath = (numpy.abs(across) < ncols * 0.4) & (numpy.abs(along) < nrows * 0.4)
+    data = numpy.random.default_rng(0).integers(1, 10000, size=(2, nrows, ncols)).astype(numpy.int16)
+    data[:, ~swath] = 0
+
+    ds = gdal.GetDriverByName("GTiff").Create(str(file_path), ncols, nrows, 2, gdal.GDT_Int16)
+    ds.SetGeoTransform(GEOTRANSFORM)
+    ds.SetProjection('EPSG:32618')
+    for band_idx in range(2):
+        ds.GetRasterBand(band_idx + 1).WriteArray(data[band_idx])
+    ds = None
+    return str(file_path)
+
+
+@pytest.mark.parametrize("decimated_size", [1024, 64])
+def test_find_corners_fast_same_as_full_pass(tmp_path, monkeypatch, fmask_libs, decimated_size):
+    from rios import fileinfo
+    from CloudMasking.libs.fmask import landsatangles
+
+    monkeypatch.setattr(landsatangles, "CORNERS_DECIMATED_SIZE", decimated_size)
+    for angle in (0.2, -0.15):
+        img = write_swath(tmp_path / "swath_{}.tif".format(angle), angle=angle)
+        img_info = fileinfo.ImageInfo(img)
+        corners = landsatangles.findImgCorners(img, img_info)
+        fast_corners = landsatangles.findImgCornersFast(img, img_info)
+        # the centres of the same pixels
+        numpy.testing.assert_allclose(fast_corners.astype(numpy.float64), corners.astype(numpy.float64),
+                                      rtol=0, atol=1e-6)
+        # null corners, the swath is inside the image
+        assert corners[0][1] < img_info.yMax - GEOTRANSFORM[1] and corners[3][1] > img_info.yMin
+
+
+def test_angles_model_same_as_angles_image(tmp_path, fmask_libs):
+    from osgeo import gdal
+    from rios import fileinfo
+    from CloudMasking.libs.fmask import config, landsatangles, valueindexes
+
+    img = write_swath(tmp_path / "swath.tif")
+    img_info = fileinfo.ImageInfo(img)
+    corners = landsatangles.findImgCorners(img, img_info)
+    nadir_line = landsatangles.findNadirLine(corners)
+    sat_azimuth = landsatangles.satAzLeftRight(nadir_line)
+    extent_sun_angles = numpy.array([[2.1, 0.61], [2.12, 0.6], [2.09, 0.63], [2.11, 0.62]])
+
+    angles_file = str(tmp_path / "angles.tif")
+    landsatangles.makeAnglesImage(img, angles_file, nadir_line, extent_sun_angles, sat_azimuth, img_info)
+    ds = gdal.Open(angles_file)
+    # satAzimuth, satZenith, sunAzimuth, sunZenith in radians * 100
+    angles_image = ds.ReadAsArray() / 100.0
+    ds = None
+
+    model = landsatangles.LandsatAnglesModelInfo(img_info, nadir_line, extent_sun_angles, sat_azimuth)
+    (rows, cols) = numpy.mgrid[:img_info.nrows, :img_info.ncols]
+    indices = (rows.ravel(), cols.ravel())
+    (sat_az, sat_zen) = model.satAngles(indices)
+    (sun_az, sun_zen) = model.sunAngles(indices)
+    # the angles image is rounded to 0.01 radians
+    tolerance = 0.005 + 1e-9
+    (x, y) = model.coordsForIndices(indices)
+    (b, m) = nadir_line
+    off_nadir = numpy.abs(m * x - y + b) / numpy.sqrt(m**2 + 1) > 1
+    numpy.testing.assert_allclose(sat_az[off_nadir], angles_image[0].ravel()[off_nadir], rtol=0, atol=tolerance)
+    for (angle, image_angle) in ((sat_zen, angles_image[1]), (sun_az, angles_image[2]), (sun_zen, angles_image[3])):
+        numpy.testing.assert_allclose(angle, image_angle.ravel(), rtol=0, atol=tolerance)
+
+    # the mean angles of the clouds, as read from the angles image
+    file_info = config.AnglesFileInfo(angles_file, 3, angles_file, 2, angles_file, 1, angles_file, 0)
+    file_info.prepareForQuerying()
+    value_indexes = valueindexes.ValueIndexes(make_clumps(size=min(img_info.nrows, img_info.ncols)), nullVals=[0])
+    for (angle, file_angle) in zip(model.getMeanAngles(value_indexes), file_info.getMeanAngles(value_indexes)):
+        numpy.testing.assert_allclose(angle, file_angle, rtol=0, atol=tolerance)
+    file_info.releaseMemory()
@@ -0,0 +1,66 @@
+import numpy
+import pytest
+
+
+def euclidean_buffer(mask, buffsize):
+    """The pixels within buffsize pixels (Euclidean distance) of any pixel of the mask"""
+    (rows, cols) = numpy.nonzero(mask)
+    (img_rows, img_cols) = numpy.mgrid[:mask.shape[0], :mask.shape[1]]
+    buffered = numpy.zeros(mask.shape, dtype=bool)
+    for (row, col) in zip(rows, cols):
+        buffered |= (img_rows - row)**2 + (img_cols - col)**2 <= buffsize**2
+    return buffered
+
+
+def random_masks(num_cases, seed=0):
+    rng = numpy.random.default_rng(seed)
+    for _ in range(num_cases):
+        (nrows, ncols) = rng.integers(1, 40, size=2)
+        buffsize = int(rng.integers(1, 25))
+        mask = rng.random((nrows, ncols)) < rng.choice([0, 0.001, 0.01, 0.05, 0.3])
+        yield mask, buffsize
+
+
+@pytest.mark.parametrize("engine", ["runs", "distance"])
+def test_buffer_mask_same_as_kernel(fmask_libs, engine):
+    from scipy.ndimage import maximum_filter
+    from CloudMasking.libs.fmask import fmask
+
+    num_compared = 0
+    for (mask, buffsize) in random_masks(400):
+        buffered = fmask.bufferMask(mask, buffsize, engine)
+        assert buffered.dtype == bool
+        # the exact buffer, for any size of the footprint
+        numpy.testing.assert_array_equal(buffered, euclidean_buffer(mask, buffsize))
+        # the maximum_filter of the circular footprint, while the footprint is not
+        # more than twice the size of the image (its reflected border is wrong beyond)
+        if 2 * buffsize + 1 <= 2 * min(mask.shape):
+            kernel = maximum_filter(mask, footprint=fmask.makeBufferKernel(buffsize))
+            numpy.testing.assert_array_equal(buffered, kernel)
+            numpy.testing.assert_array_equal(fmask.bufferMask(mask, buffsize, 'kernel'), kernel)
+            num_compared += 1
+    assert num_compared > 100
+
+
+@pytest.mark.parametrize("engine", ["runs", "distance"])
+def test_buffer_mask_footprint_larger_than_image(fmask_libs, engine):
+    from CloudMasking.libs.fmask import fmask
+
+    # a footprint of 19 pixels over an image of 2 rows
+    mask = numpy.zeros((2, 30), dtype=bool)
+    assert not fmask.bufferMask(mask, 9, engine).any()
+    mask[1, 12] = True
+    buffered = fmask.bufferMask(mask, 9, engine)
+    numpy.testing.assert_array_equal(buffered, euclidean_buffer(mask, 9))
+    assert buffered[0].sum() == 2 * 8 + 1
+    assert buffered[1].sum() == 2 * 9 + 1
+
+
+def test_buffer_mask_size_zero_and_engine(fmask_libs):
+    from CloudMasking.libs.fmask import fmask, fmaskerrors
+
+    mask = numpy.zeros((10, 10), dtype=numpy.uint8)
+    mask[5, 5] = 1
+    assert fmask.bufferMask(mask, 0) is mask
+    with pytest.raises(fmaskerrors.FmaskParameterError):
+        fmask.bufferMask(mask, 3, 'circle')
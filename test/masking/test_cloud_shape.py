@@ -0,0 +1,90 @@
+from types import SimpleNamespace
+
+import numpy
+import pytest
+import scipy.stats
+
+
+def reference_base_temperature(bt_cloud):
+    """Equation 22 for one cloud, as the previous loop of cloudShapeFunc"""
+    R = numpy.sqrt(len(bt_cloud) / (2 * numpy.pi))
+    if R >= 8:
+        percentile = 100.0 * (R - 8.0)**2 / (R**2)
+        return scipy.stats.scoreatpercentile(bt_cloud, percentile)
+    return bt_cloud.min()
+
+
+def make_temperatures(rng, dtype):
+    """Temperatures of clouds below and above R=8 (403 pixels), of one pixel, and
+    with tied temperatures, packed cloud by cloud"""
+    counts = numpy.array([1, 1, 5, 402, 403, 404, 500, 1000, 1, 3000, 403, 2000, 7], dtype=numpy.int64)
+    clouds = [rng.uniform(-40, 10, size=count) for count in counts]
+    # tied temperatures, few distinct values and all the same
+    clouds[10] = numpy.round(clouds[10] / 5) * 5
+    clouds[11] = numpy.full(counts[11], -12.5)
+    bt_clouds = numpy.concatenate(clouds).astype(dtype)
+    start = numpy.concatenate([[0], numpy.cumsum(counts)[:-1]])
+    return bt_clouds, start, counts
+
+
+@pytest.mark.parametrize("dtype", [numpy.float64, numpy.float32])
+def test_cloud_base_temperatures_same_as_scoreatpercentile(fmask_libs, dtype):
+    from CloudMasking.libs.fmask import fmask
+
+    rng = numpy.random.default_rng(0)
+    for _ in range(5):
+        bt_clouds, start, counts = make_temperatures(rng, dtype)
+        # the clouds in random order
+        order = rng.permutation(len(counts))
+        bt_clouds = numpy.concatenate([bt_clouds[start[i]:start[i] + counts[i]] for i in order])
+        counts = counts[order]
+        start = numpy.concatenate([[0], numpy.cumsum(counts)[:-1]])
+
+        Tcloudbase = fmask.cloudBaseTemperatures(bt_clouds, start, counts)
+        expected = [reference_base_temperature(bt_clouds[s:s + c]) for (s, c) in zip(start, counts)]
+        numpy.testing.assert_array_equal(Tcloudbase, expected)
+
+
+@pytest.mark.parametrize("dtype", [numpy.float64, numpy.float32])
+def test_cloud_shape_same_as_loop(fmask_libs, dtype):
+    from CloudMasking.libs.fmask import fmask, valueindexes
+
+    rng = numpy.random.default_rng(1)
+    size = 320
+    (rows, cols) = numpy.mgrid[:size, :size]
+    clumps = numpy.zeros((size, size), dtype=numpy.uint32)
+    for (cloud_id, (row, col, radius)) in enumerate([(40, 40, 30), (150, 60, 12), (60, 150, 5),
+                                                       (150, 150, 0), (100, 100, 9)], start=1):
+        clumps[numpy.hypot(rows - row, cols - col) <= radius] = cloud_id
+    # one pixel clouds
+    clumps[5, 190] = 6
+    clumps[190, 5] = 7
+    bt = rng.uniform(-40, 20, size=(size, size)).astype(dtype)
+    bt[clumps == 5] = numpy.round(bt[clumps == 5])
+    # a large cloud with a pixel whose height is rounded differently in float32
+    # and in float64
+    large = numpy.hypot(rows - 220, cols - 220) <= 60
+    clumps[large] = 8
+    bt[large] = numpy.random.default_rng(75).uniform(-40, 20, size=large.sum()).astype(numpy.float32)
+
+    cloud_clump_ndx = valueindexes.ValueIndexes(clumps, nullVals=[0])
+    inputs = SimpleNamespace(thermal=None)
+    otherargs = SimpleNamespace(cloudClumpNdx=cloud_clump_ndx,
+                                thermalInfo=SimpleNamespace(scaleThermalDNtoC=lambda thermal: bt.copy()))
+    fmask.cloudShapeFunc(None, inputs, None, otherargs)
+
+    # the previous loop, cloud by cloud, in the data type of bt
+    cloud_shape = numpy.zeros(bt.shape, dtype=numpy.uint8)
+    cloud_base_temp = {}
+    for cloud_id in cloud_clump_ndx.values:
+        cloud_ndx = cloud_clump_ndx.getIndexes(cloud_id)
+        bt_cloud = bt[cloud_ndx]
+        Tcloudbase = reference_base_temperature(bt_cloud)
+        bt_cloud[bt_cloud > Tcloudbase] = Tcloudbase
+        Htop_relative = (bt.dtype.type(Tcloudbase) - bt_cloud) / 6.5
+        cloud_shape[cloud_ndx] = numpy.round(Htop_relative * fmask.CLOUD_HEIGHT_SCALE).astype(numpy.uint8)
+        cloud_base_temp[cloud_id] = Tcloudbase
+
+    numpy.testing.assert_array_equal(otherargs.cloudShape, cloud_shape)
+    assert otherargs.cloudBaseTemp == cloud_base_temp
+    assert cloud_shape.any()
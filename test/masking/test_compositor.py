@@ -0,0 +1,218 @@
+import numpy
+
+GEOTRANSFORM = [500000, 30, 0, 100000, 0, -30]
+PROJECTION = 'EPSG:32618'
+
+
+def write_raster(file_path, data, geotransform=GEOTRANSFORM, data_type=None):
+    from osgeo import gdal
+    ds = gdal.GetDriverByName("GTiff").Create(str(file_path), data.shape[1], data.shape[0], 1,
+                                              data_type or gdal.GDT_Byte)
+    ds.SetGeoTransform(geotransform)
+    ds.SetProjection(PROJECTION)
+    ds.GetRasterBand(1).WriteArray(data)
+    ds = None
+    return str(file_path)
+
+
+def read_raster(file_path):
+    from osgeo import gdal
+    ds = gdal.Open(file_path)
+    data = ds.GetRasterBand(1).ReadAsArray()
+    ds = None
+    return data
+
+
+def write_cutline(file_path, row0, row1, col0, col1):
+    """Rectangle on the pixel edges of the rows and cols [row0, row1) and [col0, col1)"""
+    from osgeo import ogr, osr
+    (x0, y0) = (GEOTRANSFORM[0] + col0 * GEOTRANSFORM[1], GEOTRANSFORM[3] + row0 * GEOTRANSFORM[5])
+    (x1, y1) = (GEOTRANSFORM[0] + col1 * GEOTRANSFORM[1], GEOTRANSFORM[3] + row1 * GEOTRANSFORM[5])
+    srs = osr.SpatialReference()
+    srs.SetFromUserInput(PROJECTION)
+    ds = ogr.GetDriverByName("GPKG").CreateDataSource(str(file_path))
+    layer = ds.CreateLayer("cutline", srs, ogr.wkbPolygon)
+    feature = ogr.Feature(layer.GetLayerDefn())
+    feature.SetGeometry(ogr.CreateGeometryFromWkt(
+        "POLYGON (({0} {1}, {2} {1}, {2} {3}, {0} {3}, {0} {1}))".format(x0, y0, x1, y1)))
+    layer.CreateFeature(feature)
+    ds = None
+    return str(file_path)
+
+
+def old_blend(masks):
+    """Blend of the masks with the previous gdal_calc expression, e.g. for three
+    masks: A*(A>1)+B*logical_and(A==1,B>1)+C*logical_and(A==1,B==1)"""
+    blended = numpy.zeros(masks[0].shape, dtype=numpy.int64)
+    for x, mask in enumerate(masks):
+        condition = numpy.ones(mask.shape, dtype=bool)
+        for previous in masks[:x]:
+            condition &= (previous == 1)
+        if x < len(masks) - 1:
+            condition &= (mask > 1)
+        blended += mask * condition
+    return blended
+
+
+def old_nodata_mask(blended, band_1):
+    """Nodata as 255 with the previous gdal_calc expression"""
+    return blended * (band_1 > 0) + 255 * numpy.logical_or(band_1 == 0, blended == 0)
+
+
+def make_scene(shape=(300, 200), seed=0):
+    rng = numpy.random.default_rng(seed)
+    band_1 = rng.integers(1, 255, size=shape).astype(numpy.uint8)
+    band_1[:40, :30] = 0
+    # masks with codes 0 (nodata), 1 (valid data) and others
+    masks = [rng.choice([0, 1, 1, 1, 2, 3, 4], size=shape).astype(numpy.uint8) for _ in range(3)]
+    return band_1, masks
+
+
+def test_composite_masks_same_as_old_blend(tmp_path, plugin_package):
+    from core.compositor import composite_masks
+
+    band_1, masks = make_scene()
+    band_1_file = write_raster(tmp_path / "band_1.tif", band_1)
+    mask_files = [write_raster(tmp_path / "mask_{}.tif".format(idx), mask) for idx, mask in enumerate(masks)]
+
+    # of more than one block of rows
+    out_file = str(tmp_path / "blended.tif")
+    composite_masks(mask_files, out_file, band_1_file)
+    expected = old_nodata_mask(old_blend(masks), band_1)
+    numpy.testing.assert_array_equal(read_raster(out_file), expected)
+
+    # fused filter evaluated over the block of its source file, and the same
+    # source file used twice
+    fused_masks = [(band_1_file, lambda block: numpy.where(block > 200, 2, 1).astype(numpy.uint8)),
+                   mask_files[0], mask_files[1], (band_1_file, lambda block: numpy.where(block < 10, 3, 1))]
+    composite_masks(fused_masks, out_file, band_1_file)
+    expected = old_nodata_mask(old_blend([numpy.where(band_1 > 200, 2, 1), masks[0], masks[1],
+                                          numpy.where(band_1 < 10, 3, 1)]), band_1)
+    numpy.testing.assert_array_equal(read_raster(out_file), expected)
+
+
+def test_composite_masks_clipped_mask(tmp_path, plugin_package):
+    from core.compositor import composite_masks
+
+    band_1, masks = make_scene()
+    band_1_file = write_raster(tmp_path / "band_1.tif", band_1)
+    # the first mask only covers a window of the scene (clipped), outside it is valid data
+    (row0, row1, col0, col1) = (50, 280, 20, 150)
+    clipped_geotransform = [GEOTRANSFORM[0] + col0 * GEOTRANSFORM[1], GEOTRANSFORM[1], 0,
+                            GEOTRANSFORM[3] + row0 * GEOTRANSFORM[5], 0, GEOTRANSFORM[5]]
+    clipped_file = write_raster(tmp_path / "clipped.tif", masks[0][row0:row1, col0:col1], clipped_geotransform)
+    mask_files = [clipped_file, write_raster(tmp_path / "mask_1.tif", masks[1])]
+
+    out_file = str(tmp_path / "blended.tif")
+    composite_masks(mask_files, out_file, band_1_file)
+    clipped = numpy.ones_like(masks[0])
+    clipped[row0:row1, col0:col1] = masks[0][row0:row1, col0:col1]
+    expected = old_nodata_mask(old_blend([clipped, masks[1]]), band_1)
+    numpy.testing.assert_array_equal(read_raster(out_file), expected)
+
+
+def test_composite_masks_other_pixel_size(tmp_path, plugin_package):
+    import pytest
+    from core.compositor import composite_masks
+
+    band_1, masks = make_scene()
+    band_1_file = write_raster(tmp_path / "band_1.tif", band_1)
+    out_file = str(tmp_path / "blended.tif")
+
+    # a mask in other pixel size is not aligned to the grid of band_1
+    geotransform = [GEOTRANSFORM[0], 60, 0, GEOTRANSFORM[3], 0, -60]
+    coarse_file = write_raster(tmp_path / "coarse.tif", masks[0][::2, ::2], geotransform)
+    with pytest.raises(ValueError, match="pixel size"):
+        composite_masks([coarse_file, write_raster(tmp_path / "mask_1.tif", masks[1])], out_file, band_1_file)
+
+    # the same pixel size up to the rounding of the geotransform
+    geotransform = [GEOTRANSFORM[0], 30.000000001, 0, GEOTRANSFORM[3], 0, -29.999999999]
+    mask_file = write_raster(tmp_path / "mask_0.tif", masks[0], geotransform)
+    composite_masks([mask_file], out_file, band_1_file)
+    numpy.testing.assert_array_equal(read_raster(out_file), old_nodata_mask(masks[0], band_1))
+
+
+def test_composite_masks_cutline(tmp_path, plugin_package):
+    from core.compositor import composite_masks, NODATA
+
+    band_1, masks = make_scene()
+    band_1_file = write_raster(tmp_path / "band_1.tif", band_1)
+    mask_files = [write_raster(tmp_path / "mask_{}.tif".format(idx), mask) for idx, mask in enumerate(masks)]
+    (row0, row1, col0, col1) = (20, 270, 10, 180)
+    cutline_file = write_cutline(tmp_path / "cutline.gpkg", row0, row1, col0, col1)
+    inside = numpy.zeros(band_1.shape, dtype=bool)
+    inside[row0:row1, col0:col1] = True
+    blended = old_blend(masks)
+
+    # cropping to the cutline: outside is nodata
+    out_file = str(tmp_path / "blended_crop.tif")
+    composite_masks(mask_files, out_file, band_1_file, cutline_file=cutline_file)
+    expected = old_nodata_mask(blended, band_1)
+    expected[~inside] = NODATA
+    numpy.testing.assert_array_equal(read_raster(out_file), expected)
+
+    # keeping the outside of the cutline as valid data, and the nodata inside too
+    out_file = str(tmp_path / "blended_keep.tif")
+    composite_masks(mask_files, out_file, band_1_file, cutline_file=cutline_file, keep_outside_cutline=True)
+    expected = blended.copy()
+    expected[(expected == 0) | ~inside] = 1
+    numpy.testing.assert_array_equal(read_raster(out_file), expected)
+
+
+def test_qa_histogram_computed_in_the_blend(tmp_path, monkeypatch, fmask_libs):
+    from osgeo import gdal
+    from CloudMasking.core import raster_utils
+    from CloudMasking.core.cloud_filters import CloudMaskingResult
+    from CloudMasking.core.compositor import composite_masks
+
+    monkeypatch.setattr(raster_utils, "HISTOGRAM_CACHE_DIR", str(tmp_path / "histograms"))
+    monkeypatch.setattr(raster_utils, "_histograms", {})
+
+    band_1, _ = make_scene()
+    rng = numpy.random.default_rng(1)
+    qa = rng.choice([1, 322, 480, 2720], size=band_1.shape).astype(numpy.uint16)
+    band_1_file = write_raster(tmp_path / "band_1.tif", band_1)
+    qa_file = write_raster(tmp_path / "qa.tif", qa, data_type=gdal.GDT_UInt16)
+    codes_lut = numpy.ones(65536, dtype=numpy.uint8)
+    codes_lut[480] = 7
+
+    def fused_masking_result():
+        masking_result = CloudMaskingResult.__new__(CloudMaskingResult)
+        (masking_result.fused, masking_result.mask_sources, masking_result.histogram_files) = (True, [], [])
+        return masking_result
+
+    # first run, the histogram is computed when the masks are blended
+    masking_result = fused_masking_result()
+    masking_result.do_qa_mask(qa_file, str(tmp_path / "unused.tif"), codes_lut)
+    assert masking_result.histogram_files == [qa_file]
+    out_file = str(tmp_path / "blended.tif")
+    composite_masks(masking_result.mask_sources, out_file, band_1_file,
+                    histogram_files=masking_result.histogram_files)
+    expected = old_nodata_mask(old_blend([numpy.take(codes_lut, qa)]), band_1)
+    numpy.testing.assert_array_equal(read_raster(out_file), expected)
+    numpy.testing.assert_array_equal(raster_utils.get_cached_histogram(qa_file),
+                                     numpy.bincount(qa.ravel(), minlength=65536))
+
+    # second run (other session): the QA file is not read again when none of
+    # the values to mask are in the file
+    monkeypatch.setattr(raster_utils, "_histograms", {})
+    opened = []
+    gdal_open = gdal.Open
+    monkeypatch.setattr(gdal, "Open", lambda file_path, *args: opened.append(file_path) or gdal_open(file_path, *args))
+    codes_lut = numpy.ones(65536, dtype=numpy.uint8)
+    codes_lut[[2, 481]] = 7
+    masking_result = fused_masking_result()
+    masking_result.do_qa_mask(qa_file, str(tmp_path / "unused.tif"), codes_lut)
+    assert masking_result.mask_sources == []
+    assert masking_result.histogram_files == []
+    composite_masks(masking_result.mask_sources, out_file, band_1_file,
+                    histogram_files=masking_result.histogram_files)
+    numpy.testing.assert_array_equal(read_raster(out_file), old_nodata_mask(numpy.ones_like(band_1), band_1))
+    assert qa_file not in opened
+
+    # with values to mask the lookup table is applied, but the histogram is not computed again
+    codes_lut[322] = 7
+    masking_result = fused_masking_result()
+    masking_result.do_qa_mask(qa_file, str(tmp_path / "unused.tif"), codes_lut)
+    assert len(masking_result.mask_sources) == 1
+    assert masking_result.histogram_files == []
@@ -0,0 +1,29 @@
+import numpy
+import pytest
+
+
+@pytest.mark.parametrize("tile_size, num_workers", [(128, 1), (200, 1), (128, 2)])
+def test_fill_minima_tiled_same_as_whole_image(fmask_libs, tile_size, num_workers):
+    from CloudMasking.libs.fmask import fillminima
+    from CloudMasking.test.conftest import make_surface, fill_tiled
+
+    # DEM-like surface with null corners, in whole and partial tiles
+    surface = make_surface(500, seed=1)
+    boundary_val = float(numpy.percentile(surface[surface != 0], 17.5))
+
+    filled = fillminima.fillMinima(surface, 0, boundary_val)
+    tiled = fill_tiled(fillminima, surface, boundary_val, tile_size, num_workers)
+    assert (filled != surface).any()
+    numpy.testing.assert_array_equal(tiled, filled)
+
+
+def test_fill_minima_tiled_only_nulls(fmask_libs):
+    from CloudMasking.libs.fmask import fillminima
+
+    surface = numpy.zeros((100, 100), dtype=numpy.int16)
+
+    def read_tile(row, col, num_rows, num_cols):
+        return surface[row:row + num_rows, col:col + num_cols]
+
+    with pytest.raises(ValueError):
+        list(fillminima.fillMinimaTiled(read_tile, surface.shape, 0, 100, 50))
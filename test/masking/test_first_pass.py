@@ -0,0 +1,61 @@
+from types import SimpleNamespace
+
+import numpy
+import pytest
+
+
+@pytest.mark.parametrize("use_numexpr", [True, False])
+def test_first_pass_same_as_float64_kernel(monkeypatch, fmask_libs, use_numexpr):
+    from CloudMasking.libs.fmask import fmask, config
+    from CloudMasking.test.conftest import PASS1_LAYERS, make_block, make_otherargs, first_pass_float64, \
+        unpack_pass1
+
+    if not use_numexpr:
+        monkeypatch.setattr(fmask, "numexpr", None)
+    inputs = make_block(512)
+
+    old_outputs, old_otherargs = SimpleNamespace(), make_otherargs(fmask, config)
+    first_pass_float64(fmask, config, inputs, old_outputs, old_otherargs)
+    new_outputs, new_otherargs = SimpleNamespace(), make_otherargs(fmask, config)
+    # another block leaves its values in the scratch buffers reused by the kernel
+    previous_otherargs = make_otherargs(fmask, config)
+    previous_otherargs.scratch = new_otherargs.scratch
+    fmask.potentialCloudFirstPass(None, make_block(512, seed=1), SimpleNamespace(), previous_otherargs)
+    fmask.potentialCloudFirstPass(None, inputs, new_outputs, new_otherargs)
+
+    assert new_outputs.pass1.dtype == numpy.uint8
+    new_pass1 = unpack_pass1(fmask, new_outputs.pass1)
+    for (idx, layer) in enumerate(PASS1_LAYERS):
+        if layer == "variabilityProb":
+            # float32 rounding of the probability (percent)
+            diff = numpy.abs(old_outputs.pass1[idx].astype(int) - new_pass1[idx])
+            assert diff.max() <= 1
+            assert numpy.count_nonzero(diff) < 10
+        else:
+            numpy.testing.assert_array_equal(old_outputs.pass1[idx], new_pass1[idx], err_msg=layer)
+    assert old_outputs.pass1[0].any() and old_outputs.pass1[1].any() and old_outputs.pass1[2].any()
+
+    for name in ("waterBT_hist", "clearLandBT_hist", "clearLandB4_hist", "nonNullCount"):
+        numpy.testing.assert_array_equal(getattr(old_otherargs, name), getattr(new_otherargs, name), err_msg=name)
+
+
+def test_pass1_flags_round_trip(fmask_libs):
+    from CloudMasking.libs.fmask import fmask
+
+    flags = [fmask.PASS1_PCP, fmask.PASS1_WATERTEST, fmask.PASS1_CLEARLAND, fmask.PASS1_NULLMASK,
+             fmask.PASS1_SNOWMASK, fmask.PASS1_REFNULLMASK, fmask.PASS1_THERMNULLMASK]
+    # one bit by flag
+    assert sorted(flags) == [2 ** bit for bit in range(len(flags))]
+
+    rng = numpy.random.default_rng(0)
+    masks = [rng.random((64, 48)) < 0.5 for _ in flags]
+    # with the values of a previous block in the buffer
+    pass1 = numpy.full((2, 64, 48), 255, dtype=numpy.uint8)
+    fmask.packFlags(pass1[fmask.PASS1_FLAGS_LAYER], list(zip(flags, masks)))
+    pass1[fmask.PASS1_PROB_LAYER] = 42
+
+    for (flag, mask) in zip(flags, masks):
+        unpacked = fmask.pass1Flag(pass1, flag)
+        assert unpacked.dtype == bool
+        numpy.testing.assert_array_equal(unpacked, mask)
+    assert (pass1[fmask.PASS1_PROB_LAYER] == 42).all()
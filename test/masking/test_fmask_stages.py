@@ -0,0 +1,121 @@
+import os
+import types
+
+import pytest
+
+
+#: config fields of the fake runs, all the fields the stages depend on
+CONFIG_FIELDS = dict(
+    sensor=0, bands={'red': 2, 'nir': 3}, thermalInfo=None, TOARefScaling=10000.0, TOARefDNoffsetDict=None,
+    Eqn1Swir2Thresh=0.03, Eqn1ThermThresh=27, Eqn2WhitenessThresh=0.7, cirrusBandTestThresh=0.01,
+    Eqn7Swir2Thresh=0.03, Eqn20ThermThresh=3.8, Eqn20NirSnowThresh=0.11, Eqn20GreenSnowThresh=0.1,
+    sen2displacementTest=False, sen2cdiWindow=7, cirrusProbRatio=0.04, Eqn17CloudProbThresh=0.2,
+    minCloudSize_pixels=0, Eqn19NIRFillThresh=0.02, anglesInfo=None, shadowBufferSize=3,
+    bufferEngine='auto')
+
+ALL_STAGES = {'pass1', 'pass2', 'landThreshold', 'cloud', 'potentialShadows', 'clumps', 'clouds3D',
+              'shadowShapes', 'matchedShadows', 'shadowBuffer'}
+
+
+@pytest.fixture
+def fake_stages(tmp_path, monkeypatch, fmask_libs):
+    """The stages of doFmask replaced by fakes that record their calls and
+    write an intermediate file for the kept ones"""
+    from CloudMasking.libs.fmask import fmask
+
+    calls = []
+
+    def fake_stage(name, keep):
+        def stage(fmaskFilenames, fmaskConfig, missingThermal, *dependencies):
+            calls.append(name)
+            files = []
+            if keep:
+                file_path = tmp_path / "{}_{}.img".format(name, len(calls))
+                file_path.write_text(name)
+                files.append(str(file_path))
+            return ((name, len(calls)), files)
+        return stage
+
+    for (name, (func, depends_on, fields, keep)) in list(fmask.FMASK_STAGES.items()):
+        monkeypatch.setitem(fmask.FMASK_STAGES, name, (fake_stage(name, keep), depends_on, fields, keep))
+    # the intermediate files of the fakes are not rasters
+    monkeypatch.setattr(fmask, "deleteRaster", os.remove)
+
+    toa_ref = tmp_path / "toa_ref.img"
+    toa_ref.write_text("toa")
+    fmask_filenames = types.SimpleNamespace(toaRef=str(toa_ref), thermal=None, saturationMask=None)
+    stage_cache = fmask.FmaskStageCache()
+
+    def run(**fields):
+        """Run all the stages with the config fields changed, and return the
+        stages computed"""
+        fmask_config = types.SimpleNamespace(**dict(CONFIG_FIELDS, **fields))
+        del calls[:]
+        stages = fmask.FmaskStages(stage_cache, fmask_filenames, fmask_config, False)
+        stages.get('shadowBuffer')
+        return set(calls)
+
+    yield (run, stage_cache, toa_ref)
+    stage_cache.clear()
+
+
+def test_stages_computed_once(fake_stages):
+    (run, stage_cache, toa_ref) = fake_stages
+    assert run() == ALL_STAGES
+    assert run() == set()
+
+
+@pytest.mark.parametrize("field, value, expected", [
+    ('shadowBufferSize', 5, {'shadowBuffer'}),
+    ('bufferEngine', 'direct', {'shadowBuffer'}),
+    ('Eqn19NIRFillThresh', 0.05,
+     # the stages not kept are recomputed for matchedShadows
+     {'potentialShadows', 'clumps', 'clouds3D', 'shadowShapes', 'matchedShadows', 'shadowBuffer'}),
+    ('anglesInfo', types.SimpleNamespace(sunZenith=0.5),
+     {'clumps', 'clouds3D', 'shadowShapes', 'matchedShadows', 'shadowBuffer'}),
+    ('Eqn17CloudProbThresh', 0.3,
+     {'landThreshold', 'cloud', 'clumps', 'clouds3D', 'shadowShapes', 'matchedShadows', 'shadowBuffer'}),
+    ('cirrusProbRatio', 0.05,
+     {'pass2', 'landThreshold', 'cloud', 'clumps', 'clouds3D', 'shadowShapes', 'matchedShadows',
+      'shadowBuffer'}),
+    ('Eqn1Swir2Thresh', 0.04, ALL_STAGES),
+])
+def test_stages_invalidated_by_config(fake_stages, field, value, expected):
+    (run, stage_cache, toa_ref) = fake_stages
+    run()
+    assert run(**{field: value}) == expected
+    # the upstream results are reused, and the recomputed ones replace the
+    # kept ones
+    assert run(**{field: value}) == set()
+    assert run() == expected
+
+
+def test_stages_invalidated_by_inputs(fake_stages):
+    (run, stage_cache, toa_ref) = fake_stages
+    run()
+    stat = os.stat(toa_ref)
+    os.utime(toa_ref, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert run() == ALL_STAGES
+
+
+def test_stage_recomputed_without_its_files(fake_stages):
+    (run, stage_cache, toa_ref) = fake_stages
+    run()
+
+    def remove_files(name):
+        os.remove(stage_cache.results[name][2][0])
+
+    # only the stages needed for the final output
+    remove_files('potentialShadows')
+    assert run() == set()
+    remove_files('shadowBuffer')
+    assert run() == {'shadowBuffer'}
+    remove_files('matchedShadows')
+    assert run(shadowBufferSize=5) == {'potentialShadows', 'clumps', 'clouds3D', 'shadowShapes',
+                                       'matchedShadows', 'shadowBuffer'}
+    files = [stage_cache.results[name][2][0] for name in ('pass1', 'potentialShadows', 'shadowBuffer')]
+    assert all(os.path.exists(f) for f in files)
+
+    stage_cache.clear()
+    assert stage_cache.results == {}
+    assert not any(os.path.exists(f) for f in files)
@@ -0,0 +1,124 @@
+import numpy
+
+
+def make_scene(tmp_dir, size=1100, seed=0):
+    """Synthetic Landsat 8 TOA reflectance (scaled by 10000) and thermal images of
+    several RIOS blocks, with clouds, water, snow and null corners
+    """
+    from osgeo import gdal
+
+    rng = numpy.random.default_rng(seed)
+    rows, cols = numpy.mgrid[0:size, 0:size]
+
+    def noisy(values, mask):
+        values = numpy.array(values)[:, numpy.newaxis]
+        return values + rng.integers(-100, 100, size=(len(values), mask.sum()))
+
+    # vegetated land: coastal, blue, green, red, nir, swir1, swir2, cirrus
+    toa = (numpy.array([500, 400, 600, 300, 3000, 1500, 700, 10])[:, numpy.newaxis, numpy.newaxis] +
+           rng.integers(-250, 250, size=(8, size, size))).astype(numpy.int16)
+    thermal = rng.integers(24000, 30000, size=(size, size)).astype(numpy.int16)
+    # bare soil, warmer
+    soil = (rows > size * 0.45) & (cols > size * 0.5)
+    toa[:, soil] = noisy([1200, 1300, 1600, 2000, 2600, 3200, 2800, 10], soil)
+    thermal[soil] += 2000
+    # water, dark in the infrared
+    water = (rows > size * 0.7) & (cols < size * 0.4)
+    toa[:, water] = noisy([900, 800, 700, 500, 250, 150, 120, 10], water)
+    # snow, bright in the visible and dark in the swir
+    snow = (rows < size * 0.2) & (cols < size * 0.2)
+    toa[:, snow] = noisy([8500, 8500, 8000, 7500, 7000, 600, 500, 10], snow)
+    thermal[snow] = rng.integers(15000, 18000, size=snow.sum())
+    # bright and cold clouds
+    clouds = numpy.hypot(rows - size * 0.3, cols - size * 0.6) < size * 0.15
+    toa[:, clouds] = noisy([5500, 5500, 5400, 5300, 5600, 4200, 3500, 300], clouds)
+    thermal[clouds] = rng.integers(10000, 18000, size=clouds.sum())
+
+    nulls = (rows + cols < size // 5) | (rows + cols > 2 * size - size // 5)
+    toa[:, nulls] = 0
+    thermal[nulls] = 0
+
+    files = []
+    for name, data in (("toa.tif", toa), ("thermal.tif", thermal[numpy.newaxis])):
+        file_path = str(tmp_dir / name)
+        ds = gdal.GetDriverByName("GTiff").Create(file_path, size, size, data.shape[0], gdal.GDT_Int16)
+        ds.SetGeoTransform([500000, 30, 0, 100000, 0, -30])
+        ds.SetProjection('EPSG:32618')
+        for band_idx in range(data.shape[0]):
+            ds.GetRasterBand(band_idx + 1).WriteArray(data[band_idx])
+        ds = None
+        files.append(file_path)
+    return files
+
+
+def read_raster(file_path):
+    from osgeo import gdal
+    ds = gdal.Open(file_path)
+    data = ds.ReadAsArray()
+    ds = None
+    return data
+
+
+def run_passes(toa_file, thermal_file, tmp_dir, read_workers, compute_workers, monkeypatch):
+    from fmask import config, fmask
+
+    # keep the histograms of the first pass, summed over the compute workers
+    hists = {}
+    calcBTthresholds = fmask.calcBTthresholds
+
+    def keep_hists(otherargs):
+        for name in ('waterBT_hist', 'clearLandBT_hist', 'clearLandB4_hist'):
+            hists[name] = getattr(otherargs, name).copy()
+        return calcBTthresholds(otherargs)
+    monkeypatch.setattr(fmask, "calcBTthresholds", keep_hists)
+
+    fmaskFilenames = config.FmaskFilenames(toa_file, thermal_file)
+    fmaskConfig = config.FmaskConfig(config.FMASK_LANDSAT8)
+    fmaskConfig.setThermalInfo(config.ThermalFileInfo(0, 0.0003342, 0.1, 774.8853, 1321.0789))
+    fmaskConfig.setTempDir(str(tmp_dir))
+    fmaskConfig.setVerbose(False)
+    fmaskConfig.setRiosWorkers(read_workers, compute_workers)
+
+    (pass1file, Twater, Tlow, Thigh, b4_17, nonNullCount) = fmask.doPotentialCloudFirstPass(
+        fmaskFilenames, fmaskConfig, False)
+    (pass2file, lCloudProb_hist) = fmask.doPotentialCloudSecondPassLayer(
+        fmaskFilenames, fmaskConfig, pass1file, Twater, Tlow, Thigh, False)
+
+    return {"pass1": read_raster(pass1file), "pass2": read_raster(pass2file),
+            "thresholds": (Twater, Tlow, Thigh, b4_17), "nonNullCount": nonNullCount,
+            "lCloudProb_hist": lCloudProb_hist, **hists}
+
+
+def test_rios_workers_same_as_serial(tmp_path, monkeypatch, fmask_libs):
+    toa_file, thermal_file = make_scene(tmp_path)
+
+    serial = run_passes(toa_file, thermal_file, tmp_path, 0, 0, monkeypatch)
+    # the blocks of the image are split between the compute workers, each
+    # accumulates its own histograms which are summed at the end
+    threaded = run_passes(toa_file, thermal_file, tmp_path, 1, 3, monkeypatch)
+
+    assert serial["nonNullCount"] > 0
+    assert serial["clearLandBT_hist"].sum() > 0 and serial["waterBT_hist"].sum() > 0
+    assert serial["lCloudProb_hist"].sum() > 0
+    numpy.testing.assert_array_equal(serial["pass1"], threaded["pass1"])
+    numpy.testing.assert_array_equal(serial["pass2"], threaded["pass2"])
+    assert serial["thresholds"] == threaded["thresholds"]
+    assert serial["nonNullCount"] == threaded["nonNullCount"]
+    for hist in ("waterBT_hist", "clearLandBT_hist", "clearLandB4_hist", "lCloudProb_hist"):
+        assert serial[hist].dtype == threaded[hist].dtype
+        numpy.testing.assert_array_equal(serial[hist], threaded[hist])
+
+
+def test_fmask_config_rios_workers(fmask_libs):
+    from fmask import config
+
+    fmaskConfig = config.FmaskConfig(config.FMASK_LANDSAT8)
+    concurrency = config.makeConcurrencyStyle(fmaskConfig)
+    assert (concurrency.numReadWorkers, concurrency.numComputeWorkers) == (0, 0)
+
+    fmaskConfig.setRiosWorkers(0, 4)
+    concurrency = config.makeConcurrencyStyle(fmaskConfig)
+    # compute workers need a read worker
+    assert (concurrency.numReadWorkers, concurrency.numComputeWorkers) == (1, 4)
+    concurrency = config.makeConcurrencyStyle(fmaskConfig, computeWorkers=False)
+    assert (concurrency.numReadWorkers, concurrency.numComputeWorkers) == (0, 0)
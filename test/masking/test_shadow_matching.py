@@ -0,0 +1,141 @@
+import numpy
+import pytest
+
+# sun and satellite angles (radians) of the synthetic scene
+(SAT_AZ, SAT_ZEN, SUN_AZ, SUN_ZEN) = (0.3, 0.05, 2.5, 0.6)
+(X_RES, Y_RES) = (30, -30)
+(T_LOW, T_HIGH) = (20, 30)
+
+
+def make_clouds(size=300, num_clouds=90, seed=0):
+    """
+    Synthetic clouds (discs) with their shadows, a copy of the cloud shifted
+    along the sun vector as a cloud at 3 km, in the potential shadows with
+    noise. Returns the (cloudID, shadowEntry, Tcloudbase) of each cloud, and the
+    cloudmask, potentialShadow and nullmask images
+    """
+    rng = numpy.random.default_rng(seed)
+    cloudmask = numpy.zeros((size, size), dtype=bool)
+    potentialShadow = rng.random((size, size)) < 0.1
+    (rows, cols) = numpy.mgrid[:size, :size]
+    nullmask = (rows + cols < size // 6)
+    shift = 3000 * numpy.tan(SUN_ZEN)
+    (rowShift, colShift) = (int(shift * numpy.cos(SUN_AZ) / Y_RES), int(shift * numpy.sin(SUN_AZ) / X_RES))
+
+    clouds = []
+    for cloudID in range(1, num_clouds + 1):
+        radius = rng.integers(2, 9)
+        (row, col) = rng.integers(radius, size - radius, size=2)
+        disc = numpy.hypot(rows - row, cols - col) <= radius
+        cloudmask |= disc
+        shapeNdx = numpy.nonzero(disc)
+        shadowRows, shadowCols = shapeNdx[0] - rowShift, shapeNdx[1] - colShift
+        inside = (shadowRows >= 0) & (shadowRows < size) & (shadowCols >= 0) & (shadowCols < size)
+        potentialShadow[shadowRows[inside], shadowCols[inside]] = True
+        clouds.append((cloudID, (shapeNdx, SAT_AZ, SAT_ZEN, SUN_AZ, SUN_ZEN), rng.uniform(-10, 10)))
+    return clouds, cloudmask, potentialShadow, nullmask
+
+
+def match_shadows(fmask, config, clouds, images, num_workers=1, use_processes=False):
+    fmask_config = config.FmaskConfig(config.FMASK_LANDSAT8)
+    fmask_config.setShadowMatchWorkers(num_workers, use_processes)
+    return fmask.matchAllShadows(fmask_config, clouds, *images, T_LOW, T_HIGH, X_RES, Y_RES)
+
+
+def test_match_shadows_parallel_same_as_serial(fmask_libs):
+    from CloudMasking.libs.fmask import fmask, config
+
+    clouds, *images = make_clouds()
+    assert len(clouds) >= fmask.SHADOWMATCH_MIN_PARALLEL
+
+    # the loop of matchOneShadow over the clouds
+    serial = [fmask.matchOneShadow(images[0], shadowEntry, images[1], Tcloudbase, T_LOW, T_HIGH,
+                                   X_RES, Y_RES, cloudID, images[2])
+              for (cloudID, shadowEntry, Tcloudbase) in clouds]
+    matched = [ndx for ndx in serial if ndx is not None]
+    assert len(matched) > len(clouds) // 2
+    assert len(matched) < len(clouds)
+
+    for (num_workers, use_processes) in ((1, False), (3, False), (3, True)):
+        results = match_shadows(fmask, config, clouds, images, num_workers, use_processes)
+        assert len(results) == len(serial)
+        for (ndx, serial_ndx) in zip(results, serial):
+            if serial_ndx is None:
+                assert ndx is None
+            else:
+                for (dim, serial_dim) in zip(ndx, serial_ndx):
+                    numpy.testing.assert_array_equal(dim, serial_dim)
+
+
+def test_match_shadows_processes_release_shared_memory(monkeypatch, fmask_libs):
+    from multiprocessing import shared_memory
+    from CloudMasking.libs.fmask import fmask, config
+
+    shared_images = []
+
+    class SharedImage(fmask.SharedImage):
+        def __init__(self, img):
+            super().__init__(img)
+            shared_images.append(self.shm.name)
+
+    monkeypatch.setattr(fmask, "SharedImage", SharedImage)
+    clouds, *images = make_clouds()
+
+    match_shadows(fmask, config, clouds, images, 3, True)
+    assert len(shared_images) == 3
+
+    # a cloud without shadow shape fails in a worker
+    (cloudID, shadowEntry, Tcloudbase) = clouds[0]
+    clouds[0] = (cloudID, ((numpy.array([], dtype=int), numpy.array([], dtype=int)),) + shadowEntry[1:], Tcloudbase)
+    with pytest.raises(ValueError):
+        match_shadows(fmask, config, clouds, images, 3, True)
+    assert len(shared_images) == 6
+
+    for name in shared_images:
+        with pytest.raises(FileNotFoundError):
+            shared_memory.SharedMemory(name=name)
+
+
+def test_shadow_overlap_engines_same_areas(monkeypatch, fmask_libs):
+    from CloudMasking.libs.fmask import fmask
+
+    rng = numpy.random.default_rng(1)
+    (img_rows, img_cols) = (120, 150)
+    cloudmask = rng.random((img_rows, img_cols)) < 0.2
+    potentialShadow = rng.random((img_rows, img_cols)) < 0.4
+    (rows, cols) = numpy.mgrid[:img_rows, :img_cols]
+    # null corners, and a null stripe across the image
+    nullmask = (rows + cols < 40) | (rows + cols > img_rows + img_cols - 40) | ((cols >= 70) & (cols < 74))
+
+    for n in range(60):
+        (nrows, ncols) = rng.integers(1, 30, size=2)
+        # random templates with several runs by row, or full rectangles
+        shadowTemplate = rng.random((nrows, ncols)) < (0.6 if n % 3 else 1.1)
+        # steps anywhere, and touching the borders of the image
+        stepsRC = [tuple(rc) for rc in zip(rng.integers(0, img_rows - nrows + 1, size=20),
+                                          rng.integers(0, img_cols - ncols + 1, size=20))]
+        stepsRC += [(0, 0), (img_rows - nrows, img_cols - ncols), (0, img_cols - ncols), (img_rows - nrows, 0)]
+
+        direct = fmask.shadowOverlapAreasDirect(shadowTemplate, stepsRC, cloudmask, potentialShadow, nullmask)
+        for chunk in (fmask.SHADOWMATCH_RUNS_CHUNK, 7):
+            # also evaluating a few (step, run) pairs at once
+            monkeypatch.setattr(fmask, "SHADOWMATCH_RUNS_CHUNK", chunk)
+            runs = fmask.shadowOverlapAreasRuns(shadowTemplate, stepsRC, cloudmask, potentialShadow, nullmask)
+            numpy.testing.assert_array_equal(runs[0], direct[0])
+            numpy.testing.assert_array_equal(runs[1], direct[1])
+
+
+def test_match_one_shadow_engines_same_match(fmask_libs):
+    from CloudMasking.libs.fmask import fmask
+
+    clouds, cloudmask, potentialShadow, nullmask = make_clouds(size=200, num_clouds=40, seed=2)
+    engines = ("direct", "runs", "auto")
+    for (cloudID, shadowEntry, Tcloudbase) in clouds:
+        matches = [fmask.matchOneShadow(cloudmask, shadowEntry, potentialShadow, Tcloudbase, T_LOW, T_HIGH,
+                                        X_RES, Y_RES, cloudID, nullmask, engine=engine) for engine in engines]
+        for ndx in matches[1:]:
+            if matches[0] is None:
+                assert ndx is None
+            else:
+                for (dim, direct_dim) in zip(ndx, matches[0]):
+                    numpy.testing.assert_array_equal(dim, direct_dim)
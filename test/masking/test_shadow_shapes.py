@@ -0,0 +1,70 @@
+import numpy
+import pytest
+
+
+def unique_reference(rows, cols):
+    """The unique (row, col) pairs in row-major order, by sorting them"""
+    pairs = numpy.unique(numpy.column_stack((rows, cols)), axis=0)
+    return (pairs[:, 0], pairs[:, 1])
+
+
+def make_indexes(num_points, box_size, dtype, seed=0):
+    rng = numpy.random.default_rng(seed)
+    rows = rng.integers(0, box_size, num_points).astype(dtype) + 1000
+    cols = rng.integers(0, box_size, num_points).astype(dtype) + 200
+    return (rows, cols)
+
+
+@pytest.mark.parametrize("dtype", [numpy.uint32, numpy.int64])
+@pytest.mark.parametrize("dense_only", [False, True])
+def test_unique_indexes_dense(fmask_libs, dtype, dense_only):
+    from CloudMasking.libs.fmask import fmask
+
+    # many duplicates in a small box, by the bitmap of the box
+    (rows, cols) = make_indexes(5000, 40, dtype)
+    assert 40 * 40 <= fmask.UNIQUE_BITMAP_MAX_RATIO * len(rows)
+    (unique_rows, unique_cols) = fmask.uniqueIndexes(rows, cols, denseOnly=dense_only)
+    assert unique_rows.dtype == dtype and unique_cols.dtype == dtype
+    assert len(unique_rows) < len(rows)
+    for (unique, expected) in zip((unique_rows, unique_cols), unique_reference(rows, cols)):
+        numpy.testing.assert_array_equal(unique, expected)
+
+
+@pytest.mark.parametrize("dtype", [numpy.uint32, numpy.int64])
+def test_unique_indexes_sparse(fmask_libs, dtype):
+    from CloudMasking.libs.fmask import fmask
+
+    # few points in a large box, with some duplicates
+    (rows, cols) = make_indexes(500, 1000, dtype)
+    (rows, cols) = (numpy.concatenate((rows, rows[:50])), numpy.concatenate((cols, cols[:50])))
+    assert 1000 * 1000 > fmask.UNIQUE_BITMAP_MAX_RATIO * len(rows)
+
+    (unique_rows, unique_cols) = fmask.uniqueIndexes(rows, cols)
+    assert unique_rows.dtype == dtype and unique_cols.dtype == dtype
+    for (unique, expected) in zip((unique_rows, unique_cols), unique_reference(rows, cols)):
+        numpy.testing.assert_array_equal(unique, expected)
+
+    # kept as they are
+    (same_rows, same_cols) = fmask.uniqueIndexes(rows, cols, denseOnly=True)
+    assert same_rows is rows and same_cols is cols
+
+
+@pytest.mark.parametrize("dense_only", [False, True])
+def test_unique_indexes_empty(fmask_libs, dense_only):
+    from CloudMasking.libs.fmask import fmask
+
+    rows = numpy.array([], dtype=numpy.uint32)
+    cols = numpy.array([], dtype=numpy.uint32)
+    (unique_rows, unique_cols) = fmask.uniqueIndexes(rows, cols, denseOnly=dense_only)
+    assert len(unique_rows) == 0 and len(unique_cols) == 0
+    assert unique_rows.dtype == numpy.uint32 and unique_cols.dtype == numpy.uint32
+
+
+def test_unique_indexes_one_pixel(fmask_libs):
+    from CloudMasking.libs.fmask import fmask
+
+    rows = numpy.full(10, 7, dtype=numpy.uint32)
+    cols = numpy.full(10, 3, dtype=numpy.uint32)
+    (unique_rows, unique_cols) = fmask.uniqueIndexes(rows, cols, denseOnly=True)
+    numpy.testing.assert_array_equal(unique_rows, [7])
+    numpy.testing.assert_array_equal(unique_cols, [3])
@@ -0,0 +1,87 @@
+import numpy
+import pytest
+
+
+def reference_indexes(a, val):
+    """Indexes of the value in the array, as the previous ValueIndexes by
+    searching the values in the whole array"""
+    return numpy.nonzero(a == val)
+
+
+def make_arrays():
+    rng = numpy.random.default_rng(0)
+    # clumps of clouds, with nulls and gaps in the values
+    clumps = rng.choice([0, 0, 0, 1, 2, 5, 9, 300, 301], size=(120, 90)).astype(numpy.uint32)
+    # negative values
+    signed = rng.integers(-20, 20, size=(60, 70)).astype(numpy.int16)
+    # three dimensions
+    cube = rng.integers(0, 6, size=(5, 30, 40)).astype(numpy.uint8)
+    return [(clumps, [0]), (signed, [-3, 4]), (cube, [])]
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_valueindexes_lookups(fmask_libs, compact):
+    from CloudMasking.libs.fmask import valueindexes
+
+    for (a, null_vals) in make_arrays():
+        vi = valueindexes.ValueIndexes(a, nullVals=null_vals, compact=compact)
+        expected_values = numpy.array([val for val in numpy.unique(a) if val not in null_vals])
+        numpy.testing.assert_array_equal(vi.values, expected_values)
+        numpy.testing.assert_array_equal(vi.counts, [numpy.count_nonzero(a == val) for val in expected_values])
+
+        for val in range(int(a.min()) - 2, int(a.max()) + 3):
+            ndx = vi.getIndexes(val)
+            assert len(ndx) == a.ndim
+            if val in null_vals or val not in expected_values:
+                assert all(len(dim) == 0 for dim in ndx)
+            else:
+                for (dim, expected_dim) in zip(ndx, reference_indexes(a, val)):
+                    numpy.testing.assert_array_equal(dim, expected_dim)
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_valueindexes_iteration(fmask_libs, compact):
+    from CloudMasking.libs.fmask import valueindexes
+
+    for (a, null_vals) in make_arrays():
+        vi = valueindexes.ValueIndexes(a, nullVals=null_vals, compact=compact)
+        values = []
+        for (val, ndx) in vi.iterIndexes():
+            values.append(val)
+            for (dim, expected_dim) in zip(ndx, reference_indexes(a, val)):
+                numpy.testing.assert_array_equal(dim, expected_dim)
+        numpy.testing.assert_array_equal(values, vi.values)
+
+        # all the indexes, packed value by value
+        all_ndx = vi.getAllIndexes()
+        for (i, val) in enumerate(vi.values):
+            ndx = tuple(dim[vi.start[i]:vi.end[i]] for dim in all_ndx)
+            assert len(ndx[0]) == vi.counts[i]
+            assert (a[ndx] == val).all()
+
+
+def test_valueindexes_compact_same_as_default(fmask_libs):
+    from CloudMasking.libs.fmask import valueindexes
+
+    for (a, null_vals) in make_arrays():
+        vi = valueindexes.ValueIndexes(a, nullVals=null_vals)
+        compact_vi = valueindexes.ValueIndexes(a, nullVals=null_vals, compact=True)
+        assert vi.indexes.dtype == numpy.uint32
+        assert compact_vi.indexes.ndim == 1
+        for (dim, compact_dim) in zip(vi.getAllIndexes(), compact_vi.getAllIndexes()):
+            numpy.testing.assert_array_equal(dim, compact_dim)
+        # the flat offsets sorted by value, used for arrays of more than 4G
+        # elements, are in the same order as the indexes of _valueindexes
+        numpy.testing.assert_array_equal(vi.sortedOffsets(a),
+                                         numpy.ravel_multi_index(tuple(vi.indexes.T), a.shape))
+
+
+def test_valueindexes_all_nulls(fmask_libs):
+    from CloudMasking.libs.fmask import valueindexes
+
+    a = numpy.zeros((20, 30), dtype=numpy.uint32)
+    for compact in (False, True):
+        vi = valueindexes.ValueIndexes(a, nullVals=[0], compact=compact)
+        assert len(vi.values) == 0
+        assert all(len(dim) == 0 for dim in vi.getIndexes(0))
+        assert list(vi.iterIndexes()) == []
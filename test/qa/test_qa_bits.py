@@ -0,0 +1,45 @@
+import numpy
+
+
+def test_qa_bits_lut_as_binary_combination():
+    from core import qa_bits
+    from core.cloud_masking_utils import binary_combination
+
+    # all items of 8 bits QA and some items of 16 bits QA (slow enumeration)
+    for qa_fields, items in [(qa_bits.CLOUD_QA_L457, None), (qa_bits.AEROSOL_L89, None),
+                             (qa_bits.QABAND_C2, ["Cloud (bit 3)", "Cloud Confidence (bits 8-9)"]),
+                             (qa_bits.QABAND_C1_L89, ["Radiometric Saturation (bits 2-3)"])]:
+        n_bits = qa_fields["n_bits"]
+        # one bit items
+        for item, bits in qa_fields["items_1b"].items():
+            if items and item not in items:
+                continue
+            binary = [0] * n_bits
+            binary[(n_bits - 1) - bits[0]] = 1
+            values = set(binary_combination(binary, qa_fields["static_bits"] + bits))
+
+            lut = qa_bits.compile_checked_items(qa_fields, {item: True})
+            assert set(numpy.flatnonzero(lut)) == values
+        # two bits items
+        for item, (bits, levels) in qa_fields["items_2b"].items():
+            if items and item not in items:
+                continue
+            for level in levels:
+                binary = [0] * n_bits
+                binary[bits[0]:bits[1] + 1] = (levels[level])[::-1]
+                binary.reverse()
+                values = set(binary_combination(binary, qa_fields["static_bits"] + bits))
+
+                lut = qa_bits.compile_checked_items(qa_fields, {item: [level]})
+                assert set(numpy.flatnonzero(lut)) == values
+
+
+def test_qa_bits_codes():
+    from core import qa_bits
+
+    lut = qa_bits.compile_checked_items(qa_bits.QABAND_C2, {"Cloud (bit 3)": True, "Water (bit 7)": False},
+                                        specific_values=[21952])
+    codes_lut = qa_bits.lut_to_codes(lut, 10, nodata=1)
+
+    qa = numpy.array([[1, 8, 21824], [21952, 136, 8 + 64]], dtype=numpy.uint16)
+    assert numpy.take(codes_lut, qa).tolist() == [[1, 10, 1], [10, 10, 1]]
@@ -0,0 +1,153 @@
+import numpy
+
+GEOTRANSFORM = [500000, 30, 0, 100000, 0, -30]
+PROJECTION = 'EPSG:32618'
+
+
+def write_raster(file_path, data, data_type=None, nodata=None):
+    from osgeo import gdal, gdal_array
+    data = data if data.ndim == 3 else data[numpy.newaxis]
+    data_type = data_type or gdal_array.NumericTypeCodeToGDALTypeCode(data.dtype)
+    ds = gdal.GetDriverByName("GTiff").Create(str(file_path), data.shape[2], data.shape[1], data.shape[0], data_type)
+    ds.SetGeoTransform(GEOTRANSFORM)
+    ds.SetProjection(PROJECTION)
+    for band_idx in range(data.shape[0]):
+        band = ds.GetRasterBand(band_idx + 1)
+        band.WriteArray(data[band_idx])
+        if nodata is not None:
+            band.SetNoDataValue(nodata)
+    ds = None
+    return str(file_path)
+
+
+def read_raster(file_path):
+    from osgeo import gdal
+    ds = gdal.Open(str(file_path))
+    data = ds.ReadAsArray()
+    info = {"geotransform": ds.GetGeoTransform(), "nodata": ds.GetRasterBand(1).GetNoDataValue(),
+            "data_type": gdal.GetDataTypeName(ds.GetRasterBand(1).DataType)}
+    ds = None
+    return data, info
+
+
+def write_cutline(file_path, row0, row1, col0, col1):
+    """Rectangle on the pixel edges of the rows and cols [row0, row1) and [col0, col1)"""
+    from osgeo import ogr, osr
+    (x0, y0) = (GEOTRANSFORM[0] + col0 * GEOTRANSFORM[1], GEOTRANSFORM[3] + row0 * GEOTRANSFORM[5])
+    (x1, y1) = (GEOTRANSFORM[0] + col1 * GEOTRANSFORM[1], GEOTRANSFORM[3] + row1 * GEOTRANSFORM[5])
+    srs = osr.SpatialReference()
+    srs.SetFromUserInput(PROJECTION)
+    ds = ogr.GetDriverByName("GPKG").CreateDataSource(str(file_path))
+    layer = ds.CreateLayer("cutline", srs, ogr.wkbPolygon)
+    feature = ogr.Feature(layer.GetLayerDefn())
+    feature.SetGeometry(ogr.CreateGeometryFromWkt(
+        "POLYGON (({0} {1}, {2} {1}, {2} {3}, {0} {3}, {0} {1}))".format(x0, y0, x1, y1)))
+    layer.CreateFeature(feature)
+    ds = None
+    return str(file_path)
+
+
+def test_unset_nodata(tmp_path, plugin_package):
+    from core.raster_ops import unset_nodata
+
+    img = write_raster(tmp_path / "img.tif", numpy.ones((2, 10, 12), dtype=numpy.uint8), nodata=0)
+    unset_nodata(img)
+    data, info = read_raster(img)
+    assert info["nodata"] is None
+    numpy.testing.assert_array_equal(data, 1)
+
+
+def test_calc(tmp_path, plugin_package):
+    from core.raster_ops import calc
+
+    rng = numpy.random.default_rng(0)
+    blue = rng.integers(0, 6000, size=(50, 60)).astype(numpy.uint16)
+    blue_file = write_raster(tmp_path / "blue.tif", blue)
+
+    # blue band filter (as gdal_calc.py --type=Byte --co COMPRESS=PACKBITS)
+    out_file = str(tmp_path / "blue_band.tif")
+    calc("1*(A<{threshold})+6*(A>={threshold})".format(threshold=3000), out_file, out_type="Byte",
+         creation_options=["COMPRESS=PACKBITS"], A=blue_file)
+    data, info = read_raster(out_file)
+    assert info["data_type"] == "Byte"
+    numpy.testing.assert_array_equal(data, numpy.where(blue < 3000, 1, 6))
+
+    # apply the mask to all the bands of the stack, overwriting the output
+    stack = rng.integers(1, 6000, size=(3, 50, 60)).astype(numpy.uint16)
+    mask = rng.choice([0, 1, 2], size=(50, 60)).astype(numpy.uint8)
+    stack_file = write_raster(tmp_path / "stack.tif", stack)
+    mask_file = write_raster(tmp_path / "mask.tif", mask)
+    calc("A*(B==1)", out_file, nodata=0, all_bands='A', A=stack_file, B=mask_file)
+    data, info = read_raster(out_file)
+    assert info["nodata"] == 0
+    numpy.testing.assert_array_equal(data, stack * (mask == 1))
+
+
+def test_clip_with_cutline(tmp_path, plugin_package):
+    from osgeo import gdal
+    from core.raster_ops import clip_with_cutline
+
+    rng = numpy.random.default_rng(0)
+    stack = rng.integers(1, 6000, size=(2, 80, 70)).astype(numpy.uint16)
+    stack_file = write_raster(tmp_path / "stack.tif", stack)
+    cutline_file = write_cutline(tmp_path / "cutline.gpkg", 10, 60, 5, 50)
+
+    for (nodata, crop_to_cutline) in ((1, False), (0, True)):
+        out_file = str(tmp_path / "clip_{}.tif".format(nodata))
+        clip_with_cutline(stack_file, out_file, cutline_file, nodata, crop_to_cutline)
+        # as the previous gdalwarp command
+        old_file = str(tmp_path / "old_clip_{}.tif".format(nodata))
+        gdal.Warp(old_file, stack_file, options="-multi -wo NUM_THREADS=ALL_CPUS -cutline {} {}-dstnodata {}".format(
+            cutline_file, "-crop_to_cutline " if crop_to_cutline else "", nodata))
+
+        data, info = read_raster(out_file)
+        old_data, old_info = read_raster(old_file)
+        numpy.testing.assert_array_equal(data, old_data)
+        assert info == old_info
+        if crop_to_cutline:
+            numpy.testing.assert_array_equal(data, stack[:, 10:60, 5:50])
+        else:
+            expected = numpy.full_like(stack, nodata)
+            expected[:, 10:60, 5:50] = stack[:, 10:60, 5:50]
+            numpy.testing.assert_array_equal(data, expected)
+
+
+def test_build_stack(tmp_path, plugin_package):
+    from core.raster_ops import build_stack
+
+    rng = numpy.random.default_rng(0)
+    bands = [rng.integers(0, 6000, size=(40, 30)).astype(numpy.uint16) for _ in range(3)]
+    band_files = [write_raster(tmp_path / "b{}.tif".format(idx), band) for idx, band in enumerate(bands)]
+
+    # as virtual raster, referencing the bands
+    stack_file = build_stack(band_files, str(tmp_path / "stack.tif"))
+    assert stack_file == str(tmp_path / "stack.vrt")
+    data, info = read_raster(stack_file)
+    numpy.testing.assert_array_equal(data, numpy.array(bands))
+    assert info["geotransform"] == tuple(GEOTRANSFORM)
+
+    # written as GeoTIFF (as gdal_merge.py -separate), with the data type changed
+    stack_file = build_stack(band_files, str(tmp_path / "stack.tif"), materialize=True, out_type="Int16")
+    assert stack_file == str(tmp_path / "stack.tif")
+    data, info = read_raster(stack_file)
+    numpy.testing.assert_array_equal(data, numpy.array(bands))
+    assert info["data_type"] == "Int16"
+    assert info["geotransform"] == tuple(GEOTRANSFORM)
+
+
+def test_decimate(tmp_path, plugin_package):
+    from core.raster_ops import decimate
+
+    stack = numpy.arange(2 * 100 * 80, dtype=numpy.uint16).reshape(2, 100, 80)
+    stack_file = write_raster(tmp_path / "stack.tif", stack)
+
+    decimated_file = decimate(stack_file, str(tmp_path / "decimated.tif"), 4)
+    assert decimated_file == str(tmp_path / "decimated.vrt")
+    data, info = read_raster(decimated_file)
+    # the nearest neighbour of the center of each decimated pixel
+    numpy.testing.assert_array_equal(data, stack[:, 2::4, 2::4])
+    assert info["geotransform"] == (GEOTRANSFORM[0], GEOTRANSFORM[1] * 4, 0, GEOTRANSFORM[3], 0, GEOTRANSFORM[5] * 4)
+
+    # not a multiple of the factor
+    data, _ = read_raster(decimate(stack_file, str(tmp_path / "decimated_3.tif"), 3))
+    assert data.shape == (2, 34, 27)
@@ -0,0 +1,37 @@
+import os
+import time
+
+import numpy
+
+
+def test_histograms_cache_eviction(tmp_path, monkeypatch, plugin_package):
+    from CloudMasking.core import raster_utils
+
+    monkeypatch.setattr(raster_utils, "HISTOGRAM_CACHE_DIR", str(tmp_path / "histograms"))
+    monkeypatch.setattr(raster_utils, "HISTOGRAM_CACHE_MAX_FILES", 3)
+    monkeypatch.setattr(raster_utils, "_histograms", {})
+
+    files = []
+    for n in range(3):
+        files.append(str(tmp_path / "qa_{}.tif".format(n)))
+        with open(files[-1], "wb") as f:
+            f.write(b"0" * 10)
+        raster_utils.save_histogram(files[-1], numpy.full(raster_utils.HISTOGRAM_SIZE, n, dtype=numpy.int64))
+        time.sleep(0.01)
+    assert len(os.listdir(raster_utils.HISTOGRAM_CACHE_DIR)) == 3
+
+    # the first histogram is used again (other session), the second is the least recently used
+    monkeypatch.setattr(raster_utils, "_histograms", {})
+    assert raster_utils.get_cached_histogram(files[0])[0] == 0
+    time.sleep(0.01)
+
+    # the input file is rewritten (e.g. a clip file), it is a new histogram
+    with open(files[2], "wb") as f:
+        f.write(b"1" * 20)
+    raster_utils.save_histogram(files[2], numpy.full(raster_utils.HISTOGRAM_SIZE, 3, dtype=numpy.int64))
+    assert len(os.listdir(raster_utils.HISTOGRAM_CACHE_DIR)) == 3
+
+    monkeypatch.setattr(raster_utils, "_histograms", {})
+    assert raster_utils.get_cached_histogram(files[0])[0] == 0
+    assert raster_utils.get_cached_histogram(files[1]) is None
+    assert raster_utils.get_cached_histogram(files[2])[0] == 3